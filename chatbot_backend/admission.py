@@ -0,0 +1,400 @@
+"""
+Admission control for upstream LLM calls.
+
+A controller caps the number of generations in flight, overall and per
+user. Requests beyond the caps wait in a bounded queue ordered by priority
+class and arrival, so questionnaire completions are admitted ahead of
+ordinary chat and bulk traffic. Waiting is bounded by a deadline: a request
+is rejected right away if the estimated wait already exceeds it, and is
+shed if it expires in the queue, instead of piling onto a saturated
+gateway and timing out together with everything else. Rejections carry
+the HTTP status to answer with (429 for a user over their share, 503 for
+an overloaded service) and a Retry-After estimate.
+
+The controller is thread-safe and serves blocking and asyncio callers
+alike.
+"""
+
+import os
+import math
+import time
+import asyncio
+import bisect
+import itertools
+import logging
+import threading
+from contextlib import asynccontextmanager, contextmanager
+from typing import Any, AsyncIterator, Callable, Dict, Iterator, List, Optional
+
+logger = logging.getLogger(__name__)
+
+# Priority classes; lower values are admitted first
+PRIORITY_HIGH = 0
+PRIORITY_NORMAL = 1
+PRIORITY_LOW = 2
+PRIORITY_NAMES = {PRIORITY_HIGH: "high", PRIORITY_NORMAL: "normal", PRIORITY_LOW: "low"}
+
+DEFAULT_MAX_CONCURRENCY = 64
+DEFAULT_MAX_PER_USER = 4
+DEFAULT_MAX_QUEUE = 256
+# Seconds a request may wait for admission
+DEFAULT_QUEUE_TIMEOUT = 10.0
+# Weight of the newest sample in the average time a slot is held
+SERVICE_TIME_ALPHA = 0.2
+
+# Statuses of rejected requests
+STATUS_USER_LIMIT = 429
+STATUS_OVERLOADED = 503
+
+class AdmissionRejected(Exception):
+    """
+    Raised when a request is not admitted to call the LLM.
+    """
+    
+    def __init__(self, message: str, status: int, retry_after: float):
+        """
+        Initialize the rejection.
+        
+        Args:
+            message: Reason for the rejection
+            status: HTTP status to answer with
+            retry_after: Seconds after which a retry is likely to be admitted
+        """
+        super().__init__(message)
+        self.status = status
+        self.retry_after = retry_after
+    
+    @property
+    def retry_after_header(self) -> str:
+        """Retry-After header value, in whole seconds."""
+        return str(max(int(math.ceil(self.retry_after)), 1))
+
+class _Waiter:
+    """
+    A queued request, woken through notify once admitted or rejected.
+    """
+    
+    __slots__ = ("user_id", "priority", "seq", "deadline", "notify", "granted", "error")
+    
+    def __init__(self, user_id: str, priority: int, seq: int, deadline: float, notify: Callable[[], None]):
+        self.user_id = user_id
+        self.priority = priority
+        self.seq = seq
+        self.deadline = deadline
+        self.notify = notify
+        self.granted = False
+        self.error: Optional[AdmissionRejected] = None
+    
+    def __lt__(self, other: "_Waiter") -> bool:
+        return (self.priority, self.seq) < (other.priority, other.seq)
+
+class AdmissionController:
+    """
+    Global and per-user concurrency caps with a prioritized, deadline-aware wait queue.
+    """
+    
+    def __init__(
+        self,
+        max_concurrency: int = None,
+        max_per_user: int = None,
+        max_queue: int = None,
+        queue_timeout: float = None
+    ):
+        """
+        Initialize the controller.
+        
+        Args:
+            max_concurrency: Upstream calls in flight at once
+            max_per_user: Upstream calls in flight at once for one user; the
+                same number of further requests per user may wait
+            max_queue: Requests waiting at once
+            queue_timeout: Default seconds a request may wait for admission
+        """
+        self.max_concurrency = max_concurrency or DEFAULT_MAX_CONCURRENCY
+        self.max_per_user = max_per_user or DEFAULT_MAX_PER_USER
+        self.max_queue = DEFAULT_MAX_QUEUE if max_queue is None else max_queue
+        self.queue_timeout = DEFAULT_QUEUE_TIMEOUT if queue_timeout is None else queue_timeout
+        
+        self.active = 0
+        self._active_by_user: Dict[str, int] = {}
+        self._waiting_by_user: Dict[str, int] = {}
+        # Waiters ordered by (priority, arrival)
+        self._queue: List[_Waiter] = []
+        self._seq = itertools.count()
+        # Average seconds a slot is held; None until the first release
+        self._service_time: Optional[float] = None
+        self._lock = threading.Lock()
+        
+        self.admitted = 0
+        self.queued = 0
+        self.rejected_user = 0
+        self.rejected_overload = 0
+        self.shed = 0
+    
+    @contextmanager
+    def slot(self, user_id: Optional[str] = None, priority: int = PRIORITY_NORMAL, timeout: float = None) -> Iterator[None]:
+        """
+        Hold an upstream call slot for the duration of the block, waiting for one if needed.
+        
+        Args:
+            user_id: ID of the user the call is made for
+            priority: PRIORITY_HIGH, PRIORITY_NORMAL or PRIORITY_LOW
+            timeout: Seconds to wait for admission, instead of the default
+            
+        Raises:
+            AdmissionRejected: If the request is not admitted in time
+        """
+        user_id = user_id or "anonymous"
+        self.acquire(user_id, priority, timeout)
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.release(user_id, time.monotonic() - started)
+    
+    @asynccontextmanager
+    async def aslot(self, user_id: Optional[str] = None, priority: int = PRIORITY_NORMAL, timeout: float = None) -> AsyncIterator[None]:
+        """
+        Awaitable counterpart of slot; waiting does not block the event loop.
+        
+        Raises:
+            AdmissionRejected: If the request is not admitted in time
+        """
+        user_id = user_id or "anonymous"
+        await self.acquire_async(user_id, priority, timeout)
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.release(user_id, time.monotonic() - started)
+    
+    def acquire(self, user_id: str, priority: int = PRIORITY_NORMAL, timeout: float = None) -> None:
+        """
+        Take a slot, blocking until one is granted.
+        
+        Args:
+            user_id: ID of the user the call is made for
+            priority: Priority class of the request
+            timeout: Seconds to wait for admission, instead of the default
+            
+        Raises:
+            AdmissionRejected: If the request is not admitted in time
+        """
+        event = threading.Event()
+        waiter = self._admit(user_id, priority, timeout, event.set)
+        if waiter is None:
+            return
+        
+        event.wait(max(waiter.deadline - time.monotonic(), 0))
+        self._settle(waiter)
+    
+    async def acquire_async(self, user_id: str, priority: int = PRIORITY_NORMAL, timeout: float = None) -> None:
+        """
+        Take a slot, awaiting until one is granted.
+        
+        Raises:
+            AdmissionRejected: If the request is not admitted in time
+        """
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        
+        def notify() -> None:
+            loop.call_soon_threadsafe(lambda: future.done() or future.set_result(None))
+        
+        waiter = self._admit(user_id, priority, timeout, notify)
+        if waiter is None:
+            return
+        
+        try:
+            await asyncio.wait_for(future, max(waiter.deadline - time.monotonic(), 0))
+        except asyncio.TimeoutError:
+            pass
+        except asyncio.CancelledError:
+            # Give back a slot granted while the caller was going away
+            with self._lock:
+                if waiter.granted:
+                    self._release(waiter.user_id)
+                elif waiter in self._queue:
+                    self._dequeue(waiter)
+            raise
+        self._settle(waiter)
+    
+    def release(self, user_id: str, held: Optional[float] = None) -> None:
+        """
+        Give back a slot and admit waiting requests.
+        
+        Args:
+            user_id: ID of the user the slot was taken for
+            held: Seconds the slot was held, for the wait estimate
+        """
+        with self._lock:
+            if held is not None:
+                if self._service_time is None:
+                    self._service_time = held
+                else:
+                    self._service_time += SERVICE_TIME_ALPHA * (held - self._service_time)
+            self._release(user_id)
+    
+    def _admit(self, user_id: str, priority: int, timeout: Optional[float], notify: Callable[[], None]) -> Optional[_Waiter]:
+        """
+        Grant a slot right away, reject the request or queue it.
+        
+        Returns:
+            None if a slot was granted, otherwise the queued waiter
+            
+        Raises:
+            AdmissionRejected: If the request cannot be admitted in time
+        """
+        now = time.monotonic()
+        deadline = now + (self.queue_timeout if timeout is None else timeout)
+        
+        with self._lock:
+            # Queued requests are all blocked, so a free slot is free for this one
+            if self.active < self.max_concurrency and self._active_by_user.get(user_id, 0) < self.max_per_user:
+                self._grant(user_id)
+                return None
+            
+            if self._waiting_by_user.get(user_id, 0) >= self.max_per_user:
+                self.rejected_user += 1
+                raise AdmissionRejected(
+                    f"Too many concurrent requests for user {user_id}",
+                    STATUS_USER_LIMIT,
+                    self._service_time or 1.0
+                )
+            
+            ahead = sum(1 for waiter in self._queue if waiter.priority <= priority)
+            expected_wait = self._expected_wait(ahead)
+            if expected_wait is not None and now + expected_wait > deadline:
+                self.rejected_overload += 1
+                raise AdmissionRejected(
+                    f"Estimated wait of {expected_wait:.1f}s exceeds the deadline",
+                    STATUS_OVERLOADED,
+                    expected_wait
+                )
+            
+            if len(self._queue) >= self.max_queue:
+                # Make room by shedding the newest request of a lower priority class
+                victim = self._queue[-1] if self._queue else None
+                if victim is None or victim.priority <= priority:
+                    self.rejected_overload += 1
+                    raise AdmissionRejected("Admission queue is full", STATUS_OVERLOADED, expected_wait or 1.0)
+                self._dequeue(victim)
+                self.shed += 1
+                victim.error = AdmissionRejected("Shed for a higher-priority request", STATUS_OVERLOADED, expected_wait or 1.0)
+                victim.notify()
+            
+            waiter = _Waiter(user_id, priority, next(self._seq), deadline, notify)
+            bisect.insort(self._queue, waiter)
+            self._waiting_by_user[user_id] = self._waiting_by_user.get(user_id, 0) + 1
+            self.queued += 1
+            return waiter
+    
+    def _settle(self, waiter: _Waiter) -> None:
+        """Return if the waiter was granted a slot, raise otherwise."""
+        with self._lock:
+            if waiter.granted:
+                return
+            if waiter.error is None:
+                # Still queued at its deadline
+                self._dequeue(waiter)
+                self.shed += 1
+                waiter.error = AdmissionRejected(
+                    "Timed out waiting for admission",
+                    STATUS_OVERLOADED,
+                    self._expected_wait(len(self._queue)) or 1.0
+                )
+        raise waiter.error
+    
+    def _expected_wait(self, ahead: int) -> Optional[float]:
+        """Estimate the wait behind a number of queued requests; None without measurements."""
+        if self._service_time is None:
+            return None
+        return (ahead + 1) * self._service_time / self.max_concurrency
+    
+    def _grant(self, user_id: str) -> None:
+        """Count a slot as taken; the caller holds the lock."""
+        self.active += 1
+        self._active_by_user[user_id] = self._active_by_user.get(user_id, 0) + 1
+        self.admitted += 1
+    
+    def _release(self, user_id: str) -> None:
+        """Free a slot and hand free slots to waiters; the caller holds the lock."""
+        self.active -= 1
+        remaining = self._active_by_user.get(user_id, 0) - 1
+        if remaining > 0:
+            self._active_by_user[user_id] = remaining
+        else:
+            self._active_by_user.pop(user_id, None)
+        self._dispatch()
+    
+    def _dequeue(self, waiter: _Waiter) -> None:
+        """Remove a waiter from the queue; the caller holds the lock."""
+        self._queue.remove(waiter)
+        remaining = self._waiting_by_user.get(waiter.user_id, 0) - 1
+        if remaining > 0:
+            self._waiting_by_user[waiter.user_id] = remaining
+        else:
+            self._waiting_by_user.pop(waiter.user_id, None)
+    
+    def _dispatch(self) -> None:
+        """Admit queued requests in order while slots are free; the caller holds the lock."""
+        now = time.monotonic()
+        index = 0
+        while self.active < self.max_concurrency and index < len(self._queue):
+            waiter = self._queue[index]
+            if waiter.deadline <= now:
+                # Expired; it will notice and give up
+                index += 1
+                continue
+            if self._active_by_user.get(waiter.user_id, 0) >= self.max_per_user:
+                index += 1
+                continue
+            
+            self._dequeue(waiter)
+            self._grant(waiter.user_id)
+            waiter.granted = True
+            waiter.notify()
+    
+    def stats(self) -> Dict[str, Any]:
+        """
+        Get admission statistics.
+        
+        Returns:
+            Limits, slots in use, queue length per priority class, admission
+            and rejection counters and the average time a slot is held
+        """
+        with self._lock:
+            waiting = {name: 0 for name in PRIORITY_NAMES.values()}
+            for waiter in self._queue:
+                name = PRIORITY_NAMES.get(waiter.priority, str(waiter.priority))
+                waiting[name] = waiting.get(name, 0) + 1
+            return {
+                "maxConcurrency": self.max_concurrency,
+                "maxPerUser": self.max_per_user,
+                "active": self.active,
+                "waiting": waiting,
+                "admitted": self.admitted,
+                "queued": self.queued,
+                "rejectedUserLimit": self.rejected_user,
+                "rejectedOverload": self.rejected_overload,
+                "shed": self.shed,
+                "serviceMs": round(self._service_time * 1000, 1) if self._service_time is not None else None
+            }
+
+def create_admission_controller_from_env() -> Optional[AdmissionController]:
+    """
+    Create the admission controller from LLM_MAX_CONCURRENCY, LLM_MAX_PER_USER and LLM_ADMISSION_* environment variables.
+    
+    Returns:
+        The controller, or None if LLM_MAX_CONCURRENCY is 0
+    """
+    max_concurrency = int(os.environ.get("LLM_MAX_CONCURRENCY", DEFAULT_MAX_CONCURRENCY))
+    if max_concurrency <= 0:
+        return None
+    
+    return AdmissionController(
+        max_concurrency=max_concurrency,
+        max_per_user=int(os.environ.get("LLM_MAX_PER_USER", DEFAULT_MAX_PER_USER)),
+        max_queue=int(os.environ.get("LLM_ADMISSION_QUEUE", DEFAULT_MAX_QUEUE)),
+        queue_timeout=float(os.environ.get("LLM_ADMISSION_TIMEOUT", DEFAULT_QUEUE_TIMEOUT))
+    )
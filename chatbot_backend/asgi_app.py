@@ -0,0 +1,236 @@
+"""
+ASGI application serving the chat API on an asyncio event loop.
+
+Run with an ASGI server, for example:
+
+    uvicorn asgi_app:app --port 3000
+    
+Unlike the Flask app in main.py, a generation in flight only holds a
+coroutine, so one process can keep hundreds of upstream calls open at once.
+"""
+
+import os
+import sys
+import logging
+from typing import Any, AsyncIterator, Callable
+
+from fastapi import FastAPI, Request
+from fastapi.concurrency import run_in_threadpool
+from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse, StreamingResponse
+
+# Add the current directory to the path
+sys.path.insert(0, os.path.abspath(os.path.dirname(__file__)))
+
+# Import our modules
+from conversation import conversation_manager
+from conversation_store import create_conversation_store_from_env
+from prompt_manager import PromptManager
+from async_llm_service import AsyncLLMService
+from chat_flow import ChatFlow, ChatTurn, format_sse
+from models import ChatRequest
+from admission import AdmissionRejected
+from resilience import LLMUnavailableError
+
+logger = logging.getLogger(__name__)
+
+# Create ASGI app
+app = FastAPI(title="Chatbot Backend API", version="1.0.0")
+app.add_middleware(CORSMiddleware, allow_origins=["*"], allow_methods=["*"], allow_headers=["*"])
+
+# Initialize services
+prompt_manager = PromptManager()
+llm_service = AsyncLLMService()
+conversation_manager.store = create_conversation_store_from_env()
+chat_flow = ChatFlow(conversation_manager, prompt_manager)
+
+def get_current_user_id() -> str:
+    """Get the current user ID (placeholder for authentication)."""
+    return "anonymous"
+
+async def with_store(fn: Callable[..., Any], *args: Any, **kwargs: Any) -> Any:
+    """
+    Call fn, which may read or write the conversation store.
+    
+    With a store configured the call runs in the thread pool, so SQLite I/O
+    does not block the event loop; in-memory calls run inline.
+    """
+    if conversation_manager.store is None:
+        return fn(*args, **kwargs)
+    return await run_in_threadpool(fn, *args, **kwargs)
+
+def admission_rejected_response(e: AdmissionRejected) -> JSONResponse:
+    """Answer a request that was not admitted to call the LLM."""
+    logger.warning(f"Request not admitted: {e}")
+    return JSONResponse(
+        {"error": str(e), "retryAfter": int(e.retry_after_header)},
+        status_code=e.status,
+        headers={"Retry-After": e.retry_after_header}
+    )
+
+def llm_unavailable_response(e: LLMUnavailableError) -> JSONResponse:
+    """Answer a request whose reply could not be generated; the turn is not recorded."""
+    logger.error(f"LLM unavailable: {e}")
+    return JSONResponse(
+        {"error": "The assistant is temporarily unavailable", "retryAfter": int(e.retry_after_header)},
+        status_code=503,
+        headers={"Retry-After": e.retry_after_header}
+    )
+
+async def stream_chat_response(turn: ChatTurn, user_id: str) -> StreamingResponse:
+    """
+    Stream an LLM response to the client as server-sent events.
+    
+    The first delta is awaited before the response starts, so that a
+    request that is not admitted, or finds the gateway unavailable, still
+    gets a plain error status.
+    
+    Args:
+        turn: The chat turn to generate
+        user_id: ID of the user, for admission control
+        
+    Returns:
+        Streaming response using the same events as the Flask app
+        
+    Raises:
+        AdmissionRejected: If the request was not admitted to call the LLM
+        LLMUnavailableError: If the gateway could not be reached
+    """
+    deltas = llm_service.generate_response_stream(
+        system_instruction=turn.system_instruction,
+        message=turn.prompt,
+        prefix=turn.prefix,
+        user_id=user_id,
+        priority=turn.priority
+    )
+    first = []
+    async for delta in deltas:
+        first.append(delta)
+        break
+    
+    async def generate() -> AsyncIterator[str]:
+        yield format_sse(turn.start_event(), event="start")
+        
+        parts = first[:]
+        for delta in first:
+            yield format_sse({"delta": delta})
+        async for delta in deltas:
+            parts.append(delta)
+            yield format_sse({"delta": delta})
+        
+        yield format_sse(await with_store(turn.complete, "".join(parts)), event="done")
+    
+    return StreamingResponse(
+        generate(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+@app.post('/api/chat')
+async def handle_chat(chat_request: ChatRequest, request: Request):
+    """
+    Chat endpoint with prompt mode support.
+    """
+    try:
+        user_id = get_current_user_id()
+        
+        logger.info(f"Chat request: user={user_id}, persona={chat_request.personaId}, promptMode={chat_request.promptMode}")
+        
+        turn = await with_store(
+            chat_flow.prepare_turn,
+            user_id=user_id,
+            message=chat_request.message,
+            persona_id=chat_request.personaId,
+            prompt_mode=chat_request.promptMode,
+            conversation_id=chat_request.conversationId
+        )
+        
+        # Questionnaire turns are answered without the LLM
+        if not turn.needs_generation:
+            return turn.reply
+        
+        if chat_request.stream or "text/event-stream" in request.headers.get("accept", ""):
+            return await stream_chat_response(turn, user_id)
+        
+        response = await llm_service.generate_response(
+            system_instruction=turn.system_instruction,
+            message=turn.prompt,
+            prefix=turn.prefix,
+            user_id=user_id,
+            priority=turn.priority
+        )
+        
+        logger.info(f"Generated response for user: {user_id}")
+        
+        return await with_store(turn.complete, response)
+    
+    except AdmissionRejected as e:
+        return admission_rejected_response(e)
+    
+    except LLMUnavailableError as e:
+        return llm_unavailable_response(e)
+    
+    except Exception as e:
+        logger.exception("Error in chat endpoint")
+        return JSONResponse({"error": "Internal server error"}, status_code=500)
+
+@app.get('/api/templates')
+async def list_templates():
+    """
+    List available questionnaire templates.
+    """
+    return {"templates": prompt_manager.list_templates()}
+
+@app.get('/api/conversations')
+async def list_conversations(limit: int = 20, offset: int = 0):
+    """
+    List the current user's conversations, most recently updated first.
+    """
+    user_id = get_current_user_id()
+    limit = min(limit, 100)
+    offset = max(offset, 0)
+    
+    conversations = await with_store(conversation_manager.get_user_conversations, user_id, limit=limit, offset=offset)
+    total = await with_store(conversation_manager.count_user_conversations, user_id)
+    
+    return {
+        "conversations": [conversation.to_summary() for conversation in conversations],
+        "total": total,
+        "limit": limit,
+        "offset": offset
+    }
+
+@app.get('/api/conversations/{conversation_id}')
+async def get_conversation(conversation_id: str):
+    """
+    Get conversation details.
+    """
+    conversation = await with_store(conversation_manager.get_conversation, conversation_id)
+    if not conversation:
+        return JSONResponse({"error": "Conversation not found"}, status_code=404)
+    
+    return conversation.to_dict()
+
+@app.post('/api/conversations/{conversation_id}/reset')
+async def reset_conversation(conversation_id: str):
+    """
+    Reset conversation questionnaire state.
+    """
+    conversation = await with_store(conversation_manager.get_conversation, conversation_id)
+    if not conversation:
+        return JSONResponse({"error": "Conversation not found"}, status_code=404)
+    
+    # Reset questionnaire state
+    conversation.questionnaire = None
+    conversation.original_message = None
+    await with_store(conversation_manager.save_conversation, conversation)
+    
+    return {"message": "Conversation reset successfully"}
+
+@app.get('/health')
+async def health():
+    return {"status": "ok"}
+
+@app.on_event("shutdown")
+async def close_llm_client():
+    await llm_service.aclose()
@@ -0,0 +1,603 @@
+"""
+Asyncio LLM service for serving many concurrent generations from one process.
+"""
+
+import asyncio
+import logging
+from contextlib import AsyncExitStack, asynccontextmanager
+from typing import Awaitable, Callable, Dict, List, Any, AsyncIterator, Optional, Tuple
+
+import httpx
+
+from llm_service import (
+    BaseLLMService,
+    ERROR_MESSAGE,
+    JSON_HEADERS,
+    MODELS_READ_TIMEOUT,
+    NO_RESPONSE_MESSAGE,
+    STREAM_DONE,
+)
+from singleflight import AsyncSingleFlight
+from request_prefix import RequestPrefix
+from resilience import LLMUnavailableError, UpstreamError
+from admission import PRIORITY_NORMAL, AdmissionRejected
+
+logger = logging.getLogger(__name__)
+
+class AsyncLLMService(BaseLLMService):
+    """
+    Asyncio counterpart of LLMService with the same method surface.
+    
+    Calls are awaitable, so a single event loop can keep many upstream
+    generations in flight without tying up a worker thread for each.
+    """
+    
+    def __init__(self, *args, **kwargs):
+        """
+        Initialize the async LLM service.
+        
+        Args:
+            *args: Positional configuration, see BaseLLMService
+            **kwargs: Keyword configuration, see BaseLLMService
+        """
+        super().__init__(*args, **kwargs)
+        
+        self._inflight = AsyncSingleFlight()
+        self._client: Optional[httpx.AsyncClient] = None
+        self._client_lock = asyncio.Lock()
+    
+    async def get_client(self) -> httpx.AsyncClient:
+        """
+        Get the pooled keep-alive client, creating it on first use.
+        
+        Returns:
+            The HTTP client owned by this service
+        """
+        if self._client is None:
+            async with self._client_lock:
+                if self._client is None:
+                    self._client = httpx.AsyncClient(
+                        headers={"X-API-Key": self.api_key},
+                        limits=httpx.Limits(
+                            max_connections=self.pool_maxsize * self.pool_connections if self.pool_block else None,
+                            max_keepalive_connections=self.pool_maxsize * self.pool_connections
+                        ),
+                        timeout=httpx.Timeout(self.read_timeout, connect=self.connect_timeout)
+                    )
+        return self._client
+    
+    @asynccontextmanager
+    async def _admitted(self, user_id: Optional[str], priority: int) -> AsyncIterator[None]:
+        """Hold an admission slot, if admission control is enabled."""
+        if self.admission is None:
+            yield
+            return
+        async with self.admission.aslot(user_id, priority):
+            yield
+    
+    async def _coalesced(self, key: str, user_id: Optional[str], priority: int, fn: Callable[[], Awaitable[Any]]) -> Any:
+        """
+        Share fn with identical calls in flight, admitting each caller on its own.
+        
+        A caller that starts the shared call is admitted under its own user
+        and priority before it does; a caller that joins a call already
+        running needs no slot of its own. A rejection is only raised to the
+        caller it belongs to: one that ends up sharing the call of a rejected
+        leader tries again under its own admission. The slot of the caller
+        that starts the call moves to it, so it is held until the call ends
+        even when that caller is cancelled and others still wait for it.
+        
+        Args:
+            key: Fingerprint of the call
+            user_id: ID of the user, for per-user admission limits
+            priority: Admission priority class of the request
+            fn: Factory for the upstream call
+            
+        Returns:
+            The result of fn, possibly computed for another caller
+        """
+        while True:
+            joining = self._inflight.in_flight(key)
+            led = False
+            
+            async with AsyncExitStack() as slot:
+                if not joining:
+                    await slot.enter_async_context(self._admitted(user_id, priority))
+                
+                async def request() -> Any:
+                    nonlocal led
+                    led = True
+                    async with slot.pop_all() as held:
+                        if joining:
+                            # The call finished before this caller could join it
+                            await held.enter_async_context(self._admitted(user_id, priority))
+                        return await fn()
+                
+                try:
+                    return await self._inflight.do(key, request)
+                except AdmissionRejected:
+                    if led:
+                        raise
+    
+    async def _coalesced_stream(self, key: str, user_id: Optional[str], priority: int, fn: Callable[[], AsyncIterator[str]]) -> AsyncIterator[str]:
+        """
+        Share the stream of fn with identical streams in flight, admitting each consumer on its own.
+        
+        Works like _coalesced. The slot of the consumer that starts the
+        upstream stream moves to it, so it is held until upstream ends even
+        when the stream outlives that consumer for the others sharing it.
+        
+        Args:
+            key: Fingerprint of the stream
+            user_id: ID of the user, for per-user admission limits
+            priority: Admission priority class of the request
+            fn: Factory for the upstream stream
+            
+        Yields:
+            Every chunk of the shared stream
+        """
+        while True:
+            joining = self._inflight.in_flight(key)
+            led = False
+            produced = False
+            
+            async with AsyncExitStack() as slot:
+                if not joining:
+                    await slot.enter_async_context(self._admitted(user_id, priority))
+                
+                async def request() -> AsyncIterator[str]:
+                    nonlocal led
+                    led = True
+                    async with slot.pop_all() as held:
+                        if joining:
+                            # The stream finished before this consumer could join it
+                            await held.enter_async_context(self._admitted(user_id, priority))
+                        async for chunk in fn():
+                            yield chunk
+                
+                try:
+                    async for chunk in self._inflight.stream(key, request):
+                        produced = True
+                        yield chunk
+                    return
+                except AdmissionRejected:
+                    if led or produced:
+                        raise
+    
+    def get_coalescing_stats(self) -> Dict[str, int]:
+        """
+        Get single-flight deduplication statistics.
+        
+        Returns:
+            Number of requests in flight, upstream calls made and calls that
+            shared another caller's upstream call
+        """
+        return self._inflight.stats()
+    
+    async def aclose(self) -> None:
+        """
+        Close the client and every pooled connection.
+        """
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+    
+    async def generate_response(
+        self,
+        system_instruction: str,
+        message: str,
+        model: str = "vicuna-13b",
+        temperature: float = 0.7,
+        max_tokens: int = 1024,
+        prefix: Optional[RequestPrefix] = None,
+        user_id: Optional[str] = None,
+        priority: int = PRIORITY_NORMAL
+    ) -> str:
+        """
+        Generate a response to a user message.
+        
+        Args:
+            system_instruction: System instruction for the AI
+            message: User message
+            model: Model to use for generation
+            temperature: Temperature for generation
+            max_tokens: Maximum number of tokens to generate
+            prefix: Precomputed system message and model settings for the
+                request, used instead of system_instruction and the model arguments
+            user_id: ID of the user, for per-user admission limits
+            priority: Admission priority class of the request
+            
+        Returns:
+            Generated response
+            
+        Raises:
+            AdmissionRejected: If the request was not admitted to call the LLM
+            LLMUnavailableError: If the gateway could not be reached
+        """
+        try:
+            messages = prefix.messages(message) if prefix else self._build_messages(system_instruction, message)
+            
+            response = await self.chat_completion(
+                messages=messages,
+                model=model,
+                temperature=temperature,
+                max_tokens=max_tokens,
+                prefix=prefix,
+                user_id=user_id,
+                priority=priority
+            )
+            
+            assistant_message = self.extract_assistant_message(response)
+            
+            if assistant_message:
+                return assistant_message
+            else:
+                logger.error(f"Failed to extract response from LLM: {response}")
+                return NO_RESPONSE_MESSAGE
+        
+        except (AdmissionRejected, LLMUnavailableError):
+            raise
+        
+        except Exception as e:
+            logger.exception("Error generating response")
+            return ERROR_MESSAGE
+    
+    async def generate_response_stream(
+        self,
+        system_instruction: str,
+        message: str,
+        model: str = "vicuna-13b",
+        temperature: float = 0.7,
+        max_tokens: int = 1024,
+        prefix: Optional[RequestPrefix] = None,
+        user_id: Optional[str] = None,
+        priority: int = PRIORITY_NORMAL
+    ) -> AsyncIterator[str]:
+        """
+        Generate a response to a user message, yielding text deltas as they arrive.
+        
+        Args:
+            system_instruction: System instruction for the AI
+            message: User message
+            model: Model to use for generation
+            temperature: Temperature for generation
+            max_tokens: Maximum number of tokens to generate
+            prefix: Precomputed system message and model settings for the
+                request, used instead of system_instruction and the model arguments
+            user_id: ID of the user, for per-user admission limits
+            priority: Admission priority class of the request
+            
+        Yields:
+            Successive pieces of the generated response
+            
+        Raises:
+            AdmissionRejected: If the request was not admitted to call the LLM
+            LLMUnavailableError: If the gateway could not be reached
+        """
+        messages = prefix.messages(message) if prefix else self._build_messages(system_instruction, message)
+        
+        produced = False
+        try:
+            async for delta in self.chat_completion_stream(
+                messages=messages,
+                model=model,
+                temperature=temperature,
+                max_tokens=max_tokens,
+                prefix=prefix,
+                user_id=user_id,
+                priority=priority
+            ):
+                produced = True
+                yield delta
+        
+        except (AdmissionRejected, LLMUnavailableError):
+            raise
+        
+        except Exception as e:
+            logger.exception("Error streaming response")
+            if not produced:
+                yield ERROR_MESSAGE
+            return
+        
+        if not produced:
+            logger.error("LLM stream finished without producing any content")
+            yield NO_RESPONSE_MESSAGE
+    
+    async def chat_completion(
+        self,
+        messages: List[Dict[str, str]],
+        model: str = "vicuna-13b",
+        temperature: float = 0.7,
+        max_tokens: int = 1024,
+        force_cloud: bool = False,
+        prefix: Optional[RequestPrefix] = None,
+        user_id: Optional[str] = None,
+        priority: int = PRIORITY_NORMAL
+    ) -> Dict[str, Any]:
+        """
+        Generate a chat completion.
+        
+        Args:
+            messages: List of messages in the conversation
+            model: Model to use for generation
+            temperature: Temperature for generation
+            max_tokens: Maximum number of tokens to generate
+            force_cloud: Whether to force using the cloud model
+            prefix: Precomputed prefix the messages were built from; its model
+                settings override the arguments and its encoding is reused
+            user_id: ID of the user, for per-user admission limits
+            priority: Admission priority class of the request
+            
+        Returns:
+            Response from the LLM API
+        """
+        if prefix is not None:
+            model, temperature, max_tokens, force_cloud = prefix.model, prefix.temperature, prefix.max_tokens, prefix.force_cloud
+        
+        cache_key = self._cache_key(messages, model, temperature, max_tokens, prefix)
+        if cache_key is not None:
+            cached = self.cache.get(cache_key)
+            if cached is not None:
+                return cached
+        
+        def request() -> Awaitable[Dict[str, Any]]:
+            return self._request_completion(messages, model, temperature, max_tokens, force_cloud, cache_key, prefix)
+        
+        if self.coalesce:
+            key = self._fingerprint(messages, model, temperature, max_tokens, force_cloud, prefix=prefix)
+            return await self._coalesced(key, user_id, priority, request)
+        async with self._admitted(user_id, priority):
+            return await request()
+    
+    async def _request_completion(
+        self,
+        messages: List[Dict[str, str]],
+        model: str,
+        temperature: float,
+        max_tokens: int,
+        force_cloud: bool,
+        cache_key: Optional[str],
+        prefix: Optional[RequestPrefix] = None
+    ) -> Dict[str, Any]:
+        """
+        Send a chat completion request upstream, with retries and hedging.
+        
+        Returns:
+            Response from the LLM API
+            
+        Raises:
+            LLMUnavailableError: If no completion could be obtained and mock
+                fallback is disabled
+        """
+        async def attempt(endpoint: str) -> Dict[str, Any]:
+            with self.endpoints.track(endpoint):
+                try:
+                    response = await self._post_chat(endpoint, messages, model, temperature, max_tokens, force_cloud, prefix=prefix)
+                    try:
+                        await response.aread()
+                    finally:
+                        await response.aclose()
+                except httpx.TransportError as e:
+                    raise UpstreamError(f"LLM API not available: {e}") from e
+                
+                if response.status_code != 200:
+                    raise self._upstream_error(response.status_code, response.text, response.headers)
+                return self._parse_completion(response.status_code, response.json)
+        
+        try:
+            result = await self.resilience.acall(self._route(force_cloud), attempt, hedge=True)
+        except LLMUnavailableError as e:
+            if not self.mock_fallback:
+                raise
+            logger.warning(f"{e}; using mock response")
+            return self._mock_response(messages[-1]["content"])
+        
+        self._cache_completion(cache_key, result)
+        return result
+    
+    async def _post_chat(
+        self,
+        endpoint: str,
+        messages: List[Dict[str, str]],
+        model: str,
+        temperature: float,
+        max_tokens: int,
+        force_cloud: bool,
+        stream: bool = False,
+        prefix: Optional[RequestPrefix] = None
+    ) -> httpx.Response:
+        """
+        POST a chat request, referring to its prefix if the endpoint already holds it.
+        
+        If the endpoint no longer holds the prefix, the request is sent again
+        with the prefix included. The body of the returned response is not
+        read yet; the caller has to read or close it.
+        
+        Returns:
+            The response to the last request sent
+        """
+        client = await self.get_client()
+        cached_prefix = self._cached_prefix(messages, model, temperature, max_tokens, force_cloud, prefix)
+        referenced = self._is_prefix_known(endpoint, cached_prefix)
+        
+        while True:
+            body = self._encode_body(messages, model, temperature, max_tokens, force_cloud, stream, prefix, cached_prefix, referenced)
+            request = client.build_request("POST", f"{endpoint}/chat", content=body, headers=JSON_HEADERS)
+            response = await client.send(request, stream=True)
+            
+            if not self._track_prefix(endpoint, response.status_code, response.headers, messages, prefix, cached_prefix, referenced):
+                return response
+            
+            await response.aclose()
+            referenced = False
+    
+    async def chat_completion_stream(
+        self,
+        messages: List[Dict[str, str]],
+        model: str = "vicuna-13b",
+        temperature: float = 0.7,
+        max_tokens: int = 1024,
+        force_cloud: bool = False,
+        prefix: Optional[RequestPrefix] = None,
+        user_id: Optional[str] = None,
+        priority: int = PRIORITY_NORMAL
+    ) -> AsyncIterator[str]:
+        """
+        Generate a chat completion as a stream of text deltas.
+        
+        Args:
+            messages: List of messages in the conversation
+            model: Model to use for generation
+            temperature: Temperature for generation
+            max_tokens: Maximum number of tokens to generate
+            force_cloud: Whether to force using the cloud model
+            prefix: Precomputed prefix the messages were built from; its model
+                settings override the arguments and its encoding is reused
+            user_id: ID of the user, for per-user admission limits
+            priority: Admission priority class of the request
+            
+        Yields:
+            Successive pieces of the assistant's message
+        """
+        if prefix is not None:
+            model, temperature, max_tokens, force_cloud = prefix.model, prefix.temperature, prefix.max_tokens, prefix.force_cloud
+        
+        cache_key = self._cache_key(messages, model, temperature, max_tokens, prefix)
+        if cache_key is not None:
+            cached = self.cache.get(cache_key)
+            if cached is not None:
+                content = self.extract_assistant_message(cached)
+                if content:
+                    yield content
+                return
+        
+        def request() -> AsyncIterator[str]:
+            return self._request_completion_stream(messages, model, temperature, max_tokens, force_cloud, cache_key, prefix)
+        
+        if self.coalesce:
+            key = self._fingerprint(messages, model, temperature, max_tokens, force_cloud, stream=True, prefix=prefix)
+            async for delta in self._coalesced_stream(key, user_id, priority, request):
+                yield delta
+        else:
+            # The slot is held until the stream ends
+            async with self._admitted(user_id, priority):
+                async for delta in request():
+                    yield delta
+    
+    async def _request_completion_stream(
+        self,
+        messages: List[Dict[str, str]],
+        model: str,
+        temperature: float,
+        max_tokens: int,
+        force_cloud: bool,
+        cache_key: Optional[str],
+        prefix: Optional[RequestPrefix] = None
+    ) -> AsyncIterator[str]:
+        """
+        Send a streamed chat completion request upstream.
+        
+        Opening the stream is retried; once the first bytes arrived, errors
+        are passed on to the caller.
+        
+        Yields:
+            Successive pieces of the assistant's message
+            
+        Raises:
+            LLMUnavailableError: If the stream could not be opened and mock
+                fallback is disabled
+        """
+        async def open_stream(endpoint: str) -> Tuple[str, float, httpx.Response]:
+            # The request stays in flight on the endpoint until the stream ends
+            started = self.endpoints.start(endpoint)
+            try:
+                try:
+                    response = await self._post_chat(endpoint, messages, model, temperature, max_tokens, force_cloud, stream=True, prefix=prefix)
+                    if response.status_code != 200:
+                        try:
+                            await response.aread()
+                        finally:
+                            await response.aclose()
+                except httpx.TransportError as e:
+                    raise UpstreamError(f"LLM API not available: {e}") from e
+                
+                if response.status_code != 200:
+                    raise self._upstream_error(response.status_code, response.text, response.headers)
+                return endpoint, started, response
+            except Exception:
+                self.endpoints.finish(endpoint, started)
+                raise
+            except BaseException:
+                # Cancelled, for example the slower request of a hedged call
+                self.endpoints.release(endpoint)
+                raise
+        
+        try:
+            endpoint, started, response = await self.resilience.acall(self._route(force_cloud), open_stream, operation="stream")
+        except LLMUnavailableError as e:
+            if not self.mock_fallback:
+                raise
+            logger.warning(f"{e}; using mock response")
+            for delta in self._mock_stream(messages[-1]["content"]):
+                yield delta
+            return
+        
+        parts = []
+        failed = True
+        try:
+            content_type = response.headers.get("Content-Type", "")
+            if "text/event-stream" not in content_type:
+                await response.aread()
+                result = self._parse_completion(response.status_code, response.json)
+                self.endpoints.first_byte(endpoint, started)
+                self._cache_completion(cache_key, result)
+                failed = False
+                content = self.extract_assistant_message(result)
+                if content:
+                    yield content
+                return
+            
+            async for line in response.aiter_lines():
+                delta = self._parse_stream_line(line)
+                if delta is STREAM_DONE:
+                    break
+                if delta:
+                    if not parts:
+                        self.endpoints.first_byte(endpoint, started)
+                    parts.append(delta)
+                    yield delta
+            failed = False
+        except (GeneratorExit, asyncio.CancelledError):
+            # The caller stopped reading or was cancelled; not the endpoint's fault
+            failed = False
+            raise
+        finally:
+            # Counted first: a cancellation may interrupt closing the response
+            self.endpoints.finish(endpoint, started, None if failed else "stream")
+            await response.aclose()
+        
+        self._cache_stream(cache_key, parts)
+    
+    async def get_available_models(self) -> List[Dict[str, Any]]:
+        """
+        Get a list of available models.
+        
+        Returns:
+            List of available models
+        """
+        try:
+            client = await self.get_client()
+            response = await client.get(
+                f"{self.api_url}/models",
+                timeout=httpx.Timeout(MODELS_READ_TIMEOUT, connect=self.connect_timeout)
+            )
+            
+            if response.status_code == 200:
+                return response.json().get("data", [])
+            else:
+                logger.error(f"Error getting models: {response.status_code} - {response.text}")
+                return []
+        
+        except Exception as e:
+            logger.exception("Error getting models")
+            return []
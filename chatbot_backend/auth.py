@@ -1,12 +1,22 @@
 # Authentication utilities using Firebase Admin SDK
 
 import os
+import re
+import time
+import hashlib
 import logging
+import threading
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Optional, Tuple
+
+import requests
 import firebase_admin
 from firebase_admin import credentials, auth
 from fastapi import Depends, HTTPException, status
 from fastapi.security import OAuth2PasswordBearer
 
+from singleflight import SingleFlight
+
 logger = logging.getLogger(__name__)
 
 # --- Firebase Initialization ---
@@ -20,7 +30,7 @@ if SERVICE_ACCOUNT_KEY_PATH:
         if not os.path.exists(SERVICE_ACCOUNT_KEY_PATH):
             logger.error(f"Firebase service account key file not found at: {SERVICE_ACCOUNT_KEY_PATH}")
             raise FileNotFoundError(f"Service account key file not found at {SERVICE_ACCOUNT_KEY_PATH}")
-            
+        
         cred = credentials.Certificate(SERVICE_ACCOUNT_KEY_PATH)
         firebase_app = firebase_admin.initialize_app(cred)
         logger.info("Firebase Admin SDK initialized successfully.")
@@ -30,6 +40,480 @@ if SERVICE_ACCOUNT_KEY_PATH:
 else:
     logger.warning("FIREBASE_SERVICE_ACCOUNT_KEY_PATH environment variable not set. Firebase Authentication will not work.")
 
+# --- ID Token Verification ---
+
+# Public certificates Google signs Firebase ID tokens with, keyed by key id
+FIREBASE_CERTIFICATES_URL = "https://www.googleapis.com/robot/v1/metadata/x509/securetoken@system.gserviceaccount.com"
+FIREBASE_ISSUER_PREFIX = "https://securetoken.google.com/"
+
+# Verified tokens are answered from memory until shortly before they expire
+DEFAULT_TOKEN_CACHE_SIZE = int(os.getenv("AUTH_TOKEN_CACHE_SIZE", "10000"))
+DEFAULT_TOKEN_EXPIRY_SKEW = float(os.getenv("AUTH_TOKEN_EXPIRY_SKEW", "30"))
+# Rejected tokens are answered from memory for a while, so floods of them stay cheap
+DEFAULT_REJECTED_CACHE_SIZE = int(os.getenv("AUTH_REJECTED_CACHE_SIZE", "10000"))
+DEFAULT_REJECTED_TOKEN_TTL = float(os.getenv("AUTH_REJECTED_TOKEN_TTL", "300"))
+
+# Certificates are refreshed this many seconds before Google marks them stale,
+# and at most once per minimum interval; max-age assumed without Cache-Control
+DEFAULT_CERT_REFRESH_MARGIN = 300
+DEFAULT_CERT_MIN_REFRESH_INTERVAL = 30
+DEFAULT_CERT_MAX_AGE = 3600
+CERT_FETCH_TIMEOUT = 10
+
+class InvalidTokenError(Exception):
+    """Raised when an ID token is malformed, badly signed or fails a claim check."""
+
+class ExpiredTokenError(InvalidTokenError):
+    """Raised when an ID token has expired."""
+
+class UnknownSigningKeyError(Exception):
+    """
+    Raised when an ID token names a signing key that is not loaded.
+    
+    Not an InvalidTokenError: after a key rotation the same token verifies
+    once the certificates have been refreshed, so it must not be cached as
+    rejected.
+    """
+
+class CertificateUnavailableError(Exception):
+    """Raised when no signing certificates are loaded to check a token against."""
+
+def load_public_key(pem: str) -> Any:
+    """
+    Load the public key of a PEM certificate or public key.
+    
+    Args:
+        pem: X.509 certificate or SubjectPublicKeyInfo in PEM encoding
+        
+    Returns:
+        Public key object accepted by PyJWT
+        
+    Raises:
+        ImportError: If the cryptography package is not installed
+    """
+    try:
+        from cryptography import x509
+        from cryptography.hazmat.primitives.serialization import load_pem_public_key
+    except ImportError:
+        raise ImportError("The cryptography package is required for ID token verification")
+    
+    data = pem.encode("utf-8")
+    if b"BEGIN CERTIFICATE" in data:
+        return x509.load_pem_x509_certificate(data).public_key()
+    return load_pem_public_key(data)
+
+class CertificateCache:
+    """
+    Token signing keys, refreshed by a background thread before they go stale.
+    
+    Requests only read the loaded keys; fetching happens on the refresh thread,
+    on the schedule set by the Cache-Control max-age of the certificate endpoint.
+    """
+    
+    def __init__(
+        self,
+        url: str = FIREBASE_CERTIFICATES_URL,
+        fetch: Optional[Callable[[], Tuple[Dict[str, str], float]]] = None,
+        refresh_margin: float = None,
+        min_refresh_interval: float = None
+    ):
+        """
+        Initialize an empty cache; call start to load it.
+        
+        Args:
+            url: Endpoint serving a JSON object of PEM certificates by key id
+            fetch: Replaces the HTTP fetch; returns the PEM certificates or
+                public keys by key id and their max-age in seconds
+            refresh_margin: Seconds before the max-age runs out to refresh
+            min_refresh_interval: Shortest time in seconds between refreshes,
+                also the retry interval after a failed one
+        """
+        self.url = url
+        self.fetch = fetch or self._fetch
+        self.refresh_margin = DEFAULT_CERT_REFRESH_MARGIN if refresh_margin is None else refresh_margin
+        self.min_refresh_interval = DEFAULT_CERT_MIN_REFRESH_INTERVAL if min_refresh_interval is None else min_refresh_interval
+        
+        self._keys: Dict[str, Any] = {}
+        self._condition = threading.Condition()
+        self._thread: Optional[threading.Thread] = None
+        self._stopped = False
+        # Monotonic times of the last refresh attempt and of the next one
+        self._refreshed_at: Optional[float] = None
+        self._refresh_at = 0.0
+        self.refreshes = 0
+        self.failures = 0
+    
+    @property
+    def loaded(self) -> bool:
+        """Whether any signing keys are available."""
+        return bool(self._keys)
+    
+    def get(self, kid: str) -> Optional[Any]:
+        """
+        Get the public key for a key id.
+        
+        Args:
+            kid: Key id from the token header
+            
+        Returns:
+            The public key, or None if the id is unknown
+        """
+        return self._keys.get(kid)
+    
+    def _fetch(self) -> Tuple[Dict[str, str], float]:
+        """Download the certificates and read their max-age."""
+        response = requests.get(self.url, timeout=CERT_FETCH_TIMEOUT)
+        response.raise_for_status()
+        match = re.search(r"max-age=(\d+)", response.headers.get("Cache-Control", ""))
+        max_age = float(match.group(1)) if match else DEFAULT_CERT_MAX_AGE
+        return response.json(), max_age
+    
+    def refresh(self) -> bool:
+        """
+        Fetch the certificates now and schedule the next refresh.
+        
+        The keys loaded before are kept if the fetch fails.
+        
+        Returns:
+            True if the keys were replaced
+        """
+        try:
+            certificates, max_age = self.fetch()
+            keys = {kid: load_public_key(pem) for kid, pem in certificates.items()}
+        except Exception as e:
+            logger.warning(f"Failed to refresh token signing certificates: {e}")
+            with self._condition:
+                self.failures += 1
+                self._refreshed_at = time.monotonic()
+                self._refresh_at = self._refreshed_at + self.min_refresh_interval
+            return False
+        
+        with self._condition:
+            self._keys = keys
+            self.refreshes += 1
+            self._refreshed_at = time.monotonic()
+            self._refresh_at = self._refreshed_at + max(max_age - self.refresh_margin, self.min_refresh_interval)
+        logger.info(f"Loaded {len(keys)} token signing certificates, valid for {max_age:.0f}s")
+        return True
+    
+    def request_refresh(self) -> None:
+        """
+        Ask the refresh thread to refresh soon, such as after seeing an
+        unknown key id; at most once per minimum refresh interval.
+        """
+        with self._condition:
+            earliest = (self._refreshed_at or 0.0) + self.min_refresh_interval
+            if self._refresh_at > earliest:
+                self._refresh_at = earliest
+                self._condition.notify_all()
+    
+    def start(self) -> "CertificateCache":
+        """
+        Load the certificates and start the refresh thread.
+        
+        Returns:
+            The cache itself
+        """
+        if self._thread is not None and self._thread.is_alive():
+            return self
+        
+        if not self._keys:
+            self.refresh()
+        self._stopped = False
+        self._thread = threading.Thread(target=self._run, name="certificate-refresh", daemon=True)
+        self._thread.start()
+        return self
+    
+    def stop(self) -> None:
+        """
+        Stop the refresh thread.
+        """
+        with self._condition:
+            self._stopped = True
+            self._condition.notify_all()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+    
+    def _run(self) -> None:
+        """Refresh whenever the schedule says so, until stopped."""
+        while True:
+            with self._condition:
+                while not self._stopped and time.monotonic() < self._refresh_at:
+                    self._condition.wait(self._refresh_at - time.monotonic())
+                if self._stopped:
+                    return
+            self.refresh()
+    
+    def stats(self) -> Dict[str, Any]:
+        """
+        Get refresh statistics.
+        
+        Returns:
+            Loaded key ids, refresh and failure counts and seconds until the
+            next refresh
+        """
+        with self._condition:
+            return {
+                "keys": sorted(self._keys),
+                "refreshes": self.refreshes,
+                "failures": self.failures,
+                "nextRefreshIn": round(max(self._refresh_at - time.monotonic(), 0.0), 1)
+            }
+
+class JWTIdTokenVerifier:
+    """
+    Local verification of Firebase ID tokens with PyJWT.
+    
+    Checks the RS256 signature against the cached signing keys and the claims
+    Firebase requires, and returns the claims with the user id as "uid", like
+    firebase_admin.auth.verify_id_token.
+    """
+    
+    def __init__(self, project_id: str, certificates: CertificateCache, leeway: float = 0):
+        """
+        Initialize the verifier.
+        
+        Args:
+            project_id: Firebase project the tokens must be issued for
+            certificates: Signing keys; tokens signed with other keys are rejected
+            leeway: Seconds of clock skew tolerated in time claims
+            
+        Raises:
+            ImportError: If the PyJWT package is not installed
+        """
+        try:
+            import jwt
+        except ImportError:
+            raise ImportError("The PyJWT package is required for ID token verification")
+        
+        self._jwt = jwt
+        self.project_id = project_id
+        self.issuer = FIREBASE_ISSUER_PREFIX + project_id
+        self.certificates = certificates
+        self.leeway = leeway
+    
+    def __call__(self, token: str) -> Dict[str, Any]:
+        """
+        Verify an ID token.
+        
+        Args:
+            token: Encoded ID token
+            
+        Returns:
+            The token's claims, with the user id as "uid"
+            
+        Raises:
+            ExpiredTokenError: If the token has expired
+            InvalidTokenError: If the token is malformed, badly signed or fails
+                a claim check
+            UnknownSigningKeyError: If the token's signing key is not loaded
+            CertificateUnavailableError: If no signing keys are loaded
+        """
+        jwt = self._jwt
+        try:
+            header = jwt.get_unverified_header(token)
+        except jwt.PyJWTError as e:
+            raise InvalidTokenError(f"Malformed token: {e}") from e
+        if header.get("alg") != "RS256":
+            raise InvalidTokenError(f"Unexpected signing algorithm: {header.get('alg')}")
+        
+        key = self.certificates.get(header.get("kid"))
+        if key is None:
+            if not self.certificates.loaded:
+                raise CertificateUnavailableError("No token signing certificates are loaded")
+            # A rotation the refresh schedule has not caught up with, or a forgery
+            self.certificates.request_refresh()
+            raise UnknownSigningKeyError("Token is not signed by a known key")
+        
+        try:
+            claims = jwt.decode(
+                token,
+                key,
+                algorithms=["RS256"],
+                audience=self.project_id,
+                issuer=self.issuer,
+                leeway=self.leeway,
+                options={"require": ["exp", "iat", "aud", "iss", "sub", "auth_time"]}
+            )
+        except jwt.ExpiredSignatureError as e:
+            raise ExpiredTokenError("Token expired") from e
+        except jwt.PyJWTError as e:
+            raise InvalidTokenError(str(e)) from e
+        
+        subject = claims.get("sub")
+        if not isinstance(subject, str) or not subject or len(subject) > 128:
+            raise InvalidTokenError("Token has an invalid subject")
+        auth_time = claims["auth_time"]
+        if not isinstance(auth_time, (int, float)) or isinstance(auth_time, bool):
+            raise InvalidTokenError("Token has an invalid authentication time")
+        if auth_time > time.time() + self.leeway:
+            raise InvalidTokenError("Token has an authentication time in the future")
+        claims["uid"] = subject
+        return claims
+
+class VerifiedTokenCache:
+    """
+    Bounded LRU cache in front of an ID token verifier.
+    
+    Entries are keyed by a SHA-256 hash of the token, so tokens are not kept
+    in memory. Verified claims are served until the token's exp minus a skew,
+    and rejections for a fixed time. Concurrent verifications of the same
+    token share one call to the verifier.
+    """
+    
+    def __init__(
+        self,
+        verify: Callable[[str], Dict[str, Any]],
+        max_entries: int = None,
+        expiry_skew: float = None,
+        max_rejected: int = None,
+        rejected_ttl: float = None,
+        rejected_errors: Tuple[type, ...] = (InvalidTokenError,)
+    ):
+        """
+        Initialize the cache.
+        
+        Args:
+            verify: Verifier returning the claims of a valid token
+            max_entries: Verified tokens kept
+            expiry_skew: Seconds before a token's exp at which its entry expires
+            max_rejected: Rejected tokens kept
+            rejected_ttl: Seconds a rejection is remembered; 0 disables the
+                negative cache
+            rejected_errors: Exceptions of the verifier that mean the token
+                itself is bad; other errors, such as certificate fetch
+                failures, are not remembered
+        """
+        self.verify_fn = verify
+        self.max_entries = max_entries or DEFAULT_TOKEN_CACHE_SIZE
+        self.expiry_skew = DEFAULT_TOKEN_EXPIRY_SKEW if expiry_skew is None else expiry_skew
+        self.max_rejected = max_rejected or DEFAULT_REJECTED_CACHE_SIZE
+        self.rejected_ttl = DEFAULT_REJECTED_TOKEN_TTL if rejected_ttl is None else rejected_ttl
+        self.rejected_errors = rejected_errors
+        
+        # Token hash -> (claims, expiry time) and (error, expiry time), in LRU order
+        self._verified: "OrderedDict[str, Tuple[Dict[str, Any], float]]" = OrderedDict()
+        self._rejected: "OrderedDict[str, Tuple[BaseException, float]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._flight = SingleFlight()
+        self.hits = 0
+        self.rejected_hits = 0
+        self.misses = 0
+    
+    @staticmethod
+    def _key(token: str) -> str:
+        """Hash a token for use as a cache key."""
+        return hashlib.sha256(token.encode("utf-8")).hexdigest()
+    
+    def verify(self, token: str) -> Dict[str, Any]:
+        """
+        Verify a token, from the cache if possible.
+        
+        Args:
+            token: Encoded ID token
+            
+        Returns:
+            A copy of the token's claims
+            
+        Raises:
+            Exception: Whatever the verifier raised for this token, possibly
+                remembered from an earlier call
+        """
+        key = self._key(token)
+        now = time.time()
+        with self._lock:
+            entry = self._verified.get(key)
+            if entry is not None:
+                if now < entry[1]:
+                    self._verified.move_to_end(key)
+                    self.hits += 1
+                    return dict(entry[0])
+                del self._verified[key]
+            
+            rejection = self._rejected.get(key)
+            if rejection is not None:
+                if now < rejection[1]:
+                    self.rejected_hits += 1
+                    # Drop the traceback of the earlier raise so it does not grow
+                    raise rejection[0].with_traceback(None)
+                del self._rejected[key]
+            self.misses += 1
+        
+        return dict(self._flight.do(key, lambda: self._verify(key, token)))
+    
+    def _verify(self, key: str, token: str) -> Dict[str, Any]:
+        """Call the verifier and remember its verdict."""
+        try:
+            claims = self.verify_fn(token)
+        except self.rejected_errors as e:
+            if self.rejected_ttl > 0:
+                with self._lock:
+                    self._rejected[key] = (e, time.time() + self.rejected_ttl)
+                    self._rejected.move_to_end(key)
+                    while len(self._rejected) > self.max_rejected:
+                        self._rejected.popitem(last=False)
+            raise
+        
+        expires_at = float(claims.get("exp", 0)) - self.expiry_skew
+        if expires_at > time.time():
+            with self._lock:
+                self._verified[key] = (claims, expires_at)
+                self._verified.move_to_end(key)
+                while len(self._verified) > self.max_entries:
+                    self._verified.popitem(last=False)
+        return claims
+    
+    def clear(self) -> None:
+        """
+        Forget every verified and rejected token, such as after revoking
+        sessions.
+        """
+        with self._lock:
+            self._verified.clear()
+            self._rejected.clear()
+    
+    def stats(self) -> Dict[str, Any]:
+        """
+        Get cache statistics.
+        
+        Returns:
+            Entry counts and hit, rejection hit and miss counters
+        """
+        with self._lock:
+            return {
+                "verified": len(self._verified),
+                "rejected": len(self._rejected),
+                "hits": self.hits,
+                "rejectedHits": self.rejected_hits,
+                "misses": self.misses
+            }
+
+# Tokens are verified locally when the project is known, so certificates are
+# fetched by the refresh thread; otherwise by the Admin SDK on the request path
+FIREBASE_PROJECT_ID = os.getenv("FIREBASE_PROJECT_ID") or getattr(firebase_app, "project_id", None)
+
+def create_token_verifier() -> Optional[VerifiedTokenCache]:
+    """
+    Create the cached ID token verifier for the configured Firebase project.
+    
+    Returns:
+        The verifier, or None if neither a project id nor the Admin SDK is configured
+    """
+    if FIREBASE_PROJECT_ID:
+        try:
+            return VerifiedTokenCache(JWTIdTokenVerifier(FIREBASE_PROJECT_ID, CertificateCache().start()))
+        except ImportError as e:
+            logger.warning(f"Local ID token verification disabled: {e}")
+    if firebase_app:
+        return VerifiedTokenCache(
+            lambda token: auth.verify_id_token(token, app=firebase_app),
+            rejected_errors=(auth.InvalidIdTokenError,)
+        )
+    return None
+
+token_verifier = create_token_verifier()
+
 # --- FastAPI Dependency for Token Verification ---
 
 # This scheme expects the token to be sent in the Authorization header as a Bearer token
@@ -38,33 +522,39 @@ oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token") # tokenUrl is nominal her
 
 def get_current_user(token: str = Depends(oauth2_scheme)) -> dict:
     """Dependency function to verify Firebase ID token and return user data."""
-    if not firebase_app:
-        logger.error("Firebase app not initialized. Cannot verify token.")
+    if not token_verifier:
+        logger.error("Firebase is not configured. Cannot verify token.")
         raise HTTPException(
             status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
             detail="Authentication service not available",
         )
-        
+    
     try:
-        # Verify the ID token while checking if the token is revoked.
-        decoded_token = auth.verify_id_token(token, app=firebase_app)
+        # Repeated tokens are answered from the cache without checking the signature again.
+        decoded_token = token_verifier.verify(token)
         # The decoded_token contains user information like uid, email, etc.
         logger.info(f"Successfully verified token for user_id: {decoded_token.get('uid')}")
         return decoded_token # Contains uid, email, name, picture etc.
-    except auth.ExpiredIdTokenError:
+    except (ExpiredTokenError, auth.ExpiredIdTokenError):
         logger.warning("Expired Firebase ID token received.")
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Token expired",
             headers={"WWW-Authenticate": "Bearer"},
         )
-    except auth.InvalidIdTokenError as e:
+    except (InvalidTokenError, UnknownSigningKeyError, auth.InvalidIdTokenError) as e:
         logger.warning(f"Invalid Firebase ID token received: {e}")
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail=f"Invalid token: {e}",
             headers={"WWW-Authenticate": "Bearer"},
         )
+    except CertificateUnavailableError as e:
+        logger.error(f"Cannot verify token: {e}")
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Authentication service not available",
+        )
     except Exception as e:
         logger.error(f"An unexpected error occurred during token verification: {e}")
         raise HTTPException(
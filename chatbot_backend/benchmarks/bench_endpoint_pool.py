@@ -0,0 +1,92 @@
+"""
+Benchmark for load balancing across several mock gateways.
+
+Run from the chatbot_backend directory:
+
+    python benchmarks/bench_endpoint_pool.py
+
+Three local gateways with a few model slots each, one of them slower,
+and a larger but slower cloud gateway serve the same concurrent load. The
+table compares pinning each worker to one gateway with routing every
+request through the endpoint pool, with and without spill-over to the
+cloud tier.
+"""
+
+import os
+import sys
+import time
+import threading
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from endpoint_pool import EWMA, LEAST_OUTSTANDING, EndpointPool
+from llm_service import LLMService
+from mock_gateway import MockGateway
+from resilience import Resilience
+
+WORKERS = 24
+REQUESTS_PER_WORKER = 20
+
+def run(services: list) -> dict:
+    """Have every worker send its requests through its service and time them."""
+    latencies = []
+    lock = threading.Lock()
+    
+    def worker(index: int) -> None:
+        service = services[index % len(services)]
+        for i in range(REQUESTS_PER_WORKER):
+            started = time.perf_counter()
+            service.generate_response("Be brief.", f"Worker {index} question {i}")
+            with lock:
+                latencies.append(time.perf_counter() - started)
+    
+    started = time.perf_counter()
+    threads = [threading.Thread(target=worker, args=(index,)) for index in range(WORKERS)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+    
+    latencies.sort()
+    return {
+        "throughput": len(latencies) / elapsed,
+        "p50Ms": latencies[len(latencies) // 2] * 1000,
+        "p99Ms": latencies[int(len(latencies) * 0.99)] * 1000
+    }
+
+def create_service(pool: EndpointPool) -> LLMService:
+    """Create a service without caching or coalescing, so every request goes upstream."""
+    service = LLMService(endpoints=pool, coalesce=False, pool_maxsize=WORKERS, resilience=Resilience())
+    service.cache = None
+    return service
+
+def main() -> None:
+    local = [
+        MockGateway(port=0, base_latency=0.02, concurrency=4).start(),
+        MockGateway(port=0, base_latency=0.02, concurrency=4).start(),
+        MockGateway(port=0, base_latency=0.06, concurrency=4).start()
+    ]
+    cloud = MockGateway(port=0, base_latency=0.05, concurrency=32).start()
+    local_urls = [gateway.url for gateway in local]
+    
+    setups = {
+        "pinned": [create_service(EndpointPool([url])) for url in local_urls],
+        "least outstanding": [create_service(EndpointPool(local_urls, strategy=LEAST_OUTSTANDING))],
+        "ewma": [create_service(EndpointPool(local_urls, strategy=EWMA))],
+        "ewma + cloud": [create_service(EndpointPool(local_urls, [cloud.url], strategy=EWMA, spill_outstanding=4))]
+    }
+    
+    print("routing             req/s   p50 (ms)   p99 (ms)")
+    try:
+        for name, services in setups.items():
+            stats = run(services)
+            print(f"{name:<17} {stats['throughput']:>7.1f}   {stats['p50Ms']:>8.1f}   {stats['p99Ms']:>8.1f}")
+            for service in services:
+                service.close()
+    finally:
+        for gateway in local + [cloud]:
+            gateway.stop()
+
+if __name__ == "__main__":
+    main()
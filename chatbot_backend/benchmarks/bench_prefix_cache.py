@@ -0,0 +1,69 @@
+"""
+Benchmark for the upstream prefix cache against the local mock gateway.
+
+Run from the chatbot_backend directory:
+
+    python benchmarks/bench_prefix_cache.py
+
+For system prompts of increasing size, the same single-turn requests are
+sent with and without the prefix-cache protocol. The table shows the
+request body bytes the gateway received and the mean latency per request;
+the gateway simulates prefill time per kilobyte of prompt it has to
+process, which a cached prefix skips.
+"""
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from llm_service import LLMService
+from mock_gateway import MockGateway
+from personas import PERSONAS
+from request_prefix import PrefixCacheTracker, RequestPrefix
+
+REQUESTS = 200
+
+def run(gateway: MockGateway, prefix: RequestPrefix, prefix_cache: bool) -> dict:
+    """Send REQUESTS distinct messages and collect the gateway's counters."""
+    service = LLMService(api_url=gateway.url, coalesce=False, prefix_cache=PrefixCacheTracker())
+    service.cache = None
+    if not prefix_cache:
+        service.prefix_cache = None
+    
+    gateway.prefixes.clear()
+    gateway.reset_stats()
+    
+    started = time.perf_counter()
+    for i in range(REQUESTS):
+        service.generate_response(prefix.system_instruction, f"Question number {i}", prefix=prefix)
+    elapsed = time.perf_counter() - started
+    service.close()
+    
+    stats = gateway.stats()
+    stats["latencyMs"] = elapsed / REQUESTS * 1000
+    return stats
+
+def main() -> None:
+    gateway = MockGateway(port=0).start()
+    
+    system_prompts = {
+        "persona": PERSONAS["code-assistant"]["system_instruction"],
+        "bot 4 KB": "Follow the knowledge base closely. " * 120,
+        "bot 16 KB": "Follow the knowledge base closely. " * 480
+    }
+    
+    print("system prompt   prefix cache   bytes received   latency (ms)")
+    try:
+        for name, system_prompt in system_prompts.items():
+            prefix = RequestPrefix(system_prompt, "vicuna-13b", 0.7, 1024)
+            for enabled in (False, True):
+                stats = run(gateway, prefix, enabled)
+                label = "on" if enabled else "off"
+                print(f"{name:>13}   {label:>12}   {stats['bytesReceived']:>14}   {stats['latencyMs']:>12.2f}")
+    finally:
+        gateway.stop()
+
+if __name__ == "__main__":
+    main()
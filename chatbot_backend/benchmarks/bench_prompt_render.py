@@ -0,0 +1,99 @@
+"""
+Micro-benchmark for rendering enhanced prompts from compiled templates.
+
+Run from the chatbot_backend directory:
+
+    python benchmarks/bench_prompt_render.py
+
+The first table shows that rendering one template costs the same however
+many templates are loaded. The second compares a compiled render with the
+previous replace-per-answer implementation as the number of placeholders
+grows: the compiled cost per placeholder stays flat, while the previous
+implementation rescans the whole template for every answer.
+"""
+
+import os
+import re
+import json
+import sys
+import tempfile
+import timeit
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from prompt_manager import PromptManager, CompiledTemplate, DEFAULT_TEMPLATES
+
+class BenchConversation:
+    """Minimal conversation carrying a finished questionnaire."""
+    
+    def __init__(self, template_id: str, answers: dict):
+        self.original_message = "Write a function that parses dates"
+        self.questionnaire = {"templateId": template_id, "answers": answers, "complete": True}
+
+def make_template(template_id: str, placeholders: int) -> dict:
+    """Build a synthetic template with one section question per placeholder."""
+    questions = [
+        {"id": f"q{i}", "type": "textarea", "label": f"Q{i}", "format": f"\nQ{i}:\n{{value}}\n"}
+        for i in range(placeholders)
+    ]
+    return {
+        "id": template_id,
+        "name": template_id,
+        "questions": questions,
+        "prompt_template": "\n\n".join(f"{{q{i}}}" for i in range(placeholders))
+    }
+
+def legacy_render(template: dict, answers: dict) -> str:
+    """The previous implementation: one str.replace pass over the template per answer."""
+    formats = {question["id"]: question.get("format") for question in template["questions"]}
+    prompt_template = template["prompt_template"]
+    for question_id, answer in answers.items():
+        placeholder = '{' + question_id + '}'
+        if placeholder in prompt_template:
+            replacement = ""
+            if answer:
+                rule = formats.get(question_id)
+                replacement = rule.replace("{value}", str(answer)) if rule else str(answer)
+            prompt_template = prompt_template.replace(placeholder, replacement)
+    prompt_template = re.sub(r'\{[^{}]*\}', '', prompt_template)
+    lines = [line.strip() for line in prompt_template.split('\n')]
+    return '\n\n'.join(line for line in lines if line)
+
+def time_call(fn, number: int) -> float:
+    """Best-of-five time per call in microseconds."""
+    return min(timeit.repeat(fn, number=number, repeat=5)) / number * 1e6
+
+def bench_template_count() -> None:
+    """Render cost against the number of loaded templates."""
+    answers = {question["id"]: f"answer for {question['id']}" for question in DEFAULT_TEMPLATES["code-generation"]["questions"]}
+    conversation = BenchConversation("code-generation", answers)
+    
+    print("templates loaded   render (us)")
+    for count in (3, 100, 1000, 10000):
+        templates_dir = tempfile.mkdtemp()
+        for i in range(count - len(DEFAULT_TEMPLATES)):
+            with open(os.path.join(templates_dir, f"synthetic-{i}.json"), "w") as f:
+                json.dump(make_template(f"synthetic-{i}", 10), f)
+        
+        manager = PromptManager(templates_dir=templates_dir, poll_interval=3600)
+        print(f"{len(manager.list_templates()):>16}   {time_call(lambda: manager.generate_prompt(conversation), 2000):>11.2f}")
+
+def bench_placeholder_count() -> None:
+    """Render cost per placeholder, compiled against the previous implementation."""
+    print()
+    print("placeholders   compiled (us/placeholder)   previous (us/placeholder)")
+    for placeholders in (10, 100, 1000):
+        template = make_template("synthetic", placeholders)
+        compiled = CompiledTemplate(template)
+        answers = {f"q{i}": f"answer {i}" for i in range(placeholders)}
+        number = max(10, 20000 // placeholders)
+        
+        assert compiled.render(answers) == legacy_render(template, answers)
+        
+        compiled_time = time_call(lambda: compiled.render(answers), number) / placeholders
+        legacy_time = time_call(lambda: legacy_render(template, answers), number) / placeholders
+        print(f"{placeholders:>12}   {compiled_time:>25.3f}   {legacy_time:>25.3f}")
+
+if __name__ == "__main__":
+    bench_template_count()
+    bench_placeholder_count()
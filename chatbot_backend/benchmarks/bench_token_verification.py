@@ -0,0 +1,181 @@
+"""
+Benchmark and behaviour checks for cached Firebase ID token verification.
+
+Run from the chatbot_backend directory:
+
+    python benchmarks/bench_token_verification.py
+
+Tokens are signed with freshly generated RSA keys whose self-signed
+certificates stand in for Google's, served to the CertificateCache by a
+local fetch function instead of the certificate endpoint. The checks cover
+cache hits, entries expiring with their token, the negative cache for
+rejected tokens, and the refresh that picks up a rotated signing key. The
+table then compares a full signature check with cached answers.
+"""
+
+import os
+import sys
+import time
+import timeit
+import datetime
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+import jwt
+from cryptography import x509
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+from cryptography.x509.oid import NameOID
+
+from auth import CertificateCache, InvalidTokenError, JWTIdTokenVerifier, UnknownSigningKeyError, VerifiedTokenCache
+
+PROJECT_ID = "bench-project"
+CERT_MAX_AGE = 3600
+MIN_REFRESH_INTERVAL = 0.2
+
+class LocalCertificates:
+    """Certificate endpoint stand-in serving the PEM certificates of generated keys."""
+    
+    def __init__(self):
+        self.certificates = {}
+        self.fetches = 0
+    
+    def add_key(self, kid: str) -> rsa.RSAPrivateKey:
+        """Generate a signing key and publish its self-signed certificate."""
+        key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+        name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, "securetoken.system.gserviceaccount.com")])
+        now = datetime.datetime.now(datetime.timezone.utc)
+        certificate = (
+            x509.CertificateBuilder()
+            .subject_name(name)
+            .issuer_name(name)
+            .public_key(key.public_key())
+            .serial_number(x509.random_serial_number())
+            .not_valid_before(now)
+            .not_valid_after(now + datetime.timedelta(days=1))
+            .sign(key, hashes.SHA256())
+        )
+        self.certificates[kid] = certificate.public_bytes(serialization.Encoding.PEM).decode("utf-8")
+        return key
+    
+    def fetch(self):
+        self.fetches += 1
+        return dict(self.certificates), CERT_MAX_AGE
+
+class CountingVerifier:
+    """Wraps the verifier to count the tokens that reach it."""
+    
+    def __init__(self, verifier: JWTIdTokenVerifier):
+        self.verifier = verifier
+        self.calls = 0
+    
+    def __call__(self, token: str) -> dict:
+        self.calls += 1
+        return self.verifier(token)
+
+def make_token(key: rsa.RSAPrivateKey, kid: str, lifetime: float = 3600, **claims) -> str:
+    """Sign an ID token for PROJECT_ID with the claims Firebase sets."""
+    now = int(time.time())
+    payload = {
+        "iss": f"https://securetoken.google.com/{PROJECT_ID}",
+        "aud": PROJECT_ID,
+        "sub": "bench-user",
+        "iat": now,
+        "auth_time": now,
+        "exp": now + int(lifetime)
+    }
+    payload.update(claims)
+    return jwt.encode(payload, key, algorithm="RS256", headers={"kid": kid})
+
+def expect_error(cache: VerifiedTokenCache, token: str, error: type) -> None:
+    """Assert that verifying a token raises the given error."""
+    try:
+        cache.verify(token)
+    except error:
+        return
+    raise AssertionError(f"Expected {error.__name__}")
+
+def check(description: str, condition: bool) -> None:
+    """Print one check and stop at the first failure."""
+    print(f"{'ok' if condition else 'FAIL':<6}{description}")
+    if not condition:
+        sys.exit(1)
+
+def check_behaviour() -> None:
+    """Check cache hits, expiry, the negative cache and key rotation."""
+    endpoint = LocalCertificates()
+    key = endpoint.add_key("key-1")
+    certificates = CertificateCache(fetch=endpoint.fetch, min_refresh_interval=MIN_REFRESH_INTERVAL).start()
+    verifier = CountingVerifier(JWTIdTokenVerifier(PROJECT_ID, certificates))
+    cache = VerifiedTokenCache(verifier, expiry_skew=30, rejected_ttl=0.5)
+    
+    token = make_token(key, "key-1")
+    claims = cache.verify(token)
+    cache.verify(token)
+    check("a verified token is answered from the cache", verifier.calls == 1 and claims["uid"] == "bench-user")
+    
+    claims["uid"] = "someone-else"
+    check("callers get a copy of the cached claims", cache.verify(token)["uid"] == "bench-user")
+    
+    expiring = make_token(key, "key-1", lifetime=10)
+    calls = verifier.calls
+    cache.verify(expiring)
+    cache.verify(expiring)
+    check("a token expiring within the skew is checked every time", verifier.calls == calls + 2)
+    
+    forged = make_token(rsa.generate_private_key(public_exponent=65537, key_size=2048), "key-1")
+    calls = verifier.calls
+    for _ in range(5):
+        expect_error(cache, forged, InvalidTokenError)
+    check("a rejected token is answered from the negative cache", verifier.calls == calls + 1)
+    
+    time.sleep(0.6)
+    expect_error(cache, forged, InvalidTokenError)
+    check("a rejection is checked again once its TTL has passed", verifier.calls == calls + 2)
+    
+    rotated_key = endpoint.add_key("key-2")
+    rotated = make_token(rotated_key, "key-2")
+    fetches = endpoint.fetches
+    expect_error(cache, rotated, UnknownSigningKeyError)
+    time.sleep(MIN_REFRESH_INTERVAL * 3)
+    check("an unknown key id triggers a certificate refresh", endpoint.fetches == fetches + 1)
+    check("a token signed with the rotated key verifies after the refresh", cache.verify(rotated)["uid"] == "bench-user")
+    
+    certificates.stop()
+
+def time_call(fn, number: int) -> float:
+    """Best-of-five time per call in microseconds."""
+    return min(timeit.repeat(fn, number=number, repeat=5)) / number * 1e6
+
+def bench() -> None:
+    """Time a full verification against cached verdicts."""
+    endpoint = LocalCertificates()
+    key = endpoint.add_key("key-1")
+    certificates = CertificateCache(fetch=endpoint.fetch)
+    certificates.refresh()
+    verifier = JWTIdTokenVerifier(PROJECT_ID, certificates)
+    cache = VerifiedTokenCache(verifier)
+    
+    token = make_token(key, "key-1")
+    forged = make_token(rsa.generate_private_key(public_exponent=65537, key_size=2048), "key-1")
+    cache.verify(token)
+    try:
+        cache.verify(forged)
+    except InvalidTokenError:
+        pass
+    
+    def verify_rejected():
+        try:
+            cache.verify(forged)
+        except InvalidTokenError:
+            pass
+    
+    print()
+    print("path                      time (us)")
+    print(f"{'signature check':<24}{time_call(lambda: verifier(token), 500):>11.1f}")
+    print(f"{'cached verified token':<24}{time_call(lambda: cache.verify(token), 20000):>11.1f}")
+    print(f"{'cached rejected token':<24}{time_call(verify_rejected, 20000):>11.1f}")
+
+if __name__ == "__main__":
+    check_behaviour()
+    bench()
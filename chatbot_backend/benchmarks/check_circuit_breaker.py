@@ -0,0 +1,87 @@
+"""
+Checks for the circuit breaker's half-open probe.
+
+Run from the chatbot_backend directory:
+
+    python benchmarks/check_circuit_breaker.py
+
+An endpoint's breaker is opened with failed calls. After the cool-down,
+the probe call either is cancelled while waiting on the gateway or ends
+with an exception that is not a gateway failure. Neither answers whether
+the gateway recovered, so the breaker must let the next call probe again
+instead of rejecting calls until the process restarts.
+"""
+
+import os
+import sys
+import time
+import asyncio
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from resilience import CircuitBreaker, CircuitOpenError, Resilience, RetryPolicy, UpstreamError
+
+ENDPOINT = "http://gateway.invalid"
+RESET_TIMEOUT = 0.05
+
+def open_breaker() -> Resilience:
+    """Create settings whose breaker for ENDPOINT is open and ready for a probe."""
+    resilience = Resilience(retry=RetryPolicy(max_attempts=1), breaker_failures=1, breaker_reset_timeout=RESET_TIMEOUT)
+    
+    def fail(url: str) -> str:
+        raise UpstreamError("connection refused")
+    
+    try:
+        resilience.call(ENDPOINT, fail)
+    except Exception:
+        pass
+    assert resilience.breaker(ENDPOINT).state == CircuitBreaker.OPEN
+    time.sleep(RESET_TIMEOUT * 2)
+    return resilience
+
+def check_probe_free(resilience: Resilience, case: str) -> None:
+    """Assert that the next call is let through as the probe and closes the breaker."""
+    try:
+        result = resilience.call(ENDPOINT, lambda url: "ok")
+    except CircuitOpenError:
+        print(f"FAIL  {case}: the breaker still rejects calls")
+        sys.exit(1)
+    assert result == "ok"
+    assert resilience.breaker(ENDPOINT).state == CircuitBreaker.CLOSED
+    print(f"ok    {case}")
+
+async def cancelled_probe(resilience: Resilience) -> None:
+    """Cancel an async probe while it waits on the gateway."""
+    async def hang(url: str) -> str:
+        await asyncio.sleep(60)
+        return "late"
+    
+    task = asyncio.ensure_future(resilience.acall(ENDPOINT, hang))
+    await asyncio.sleep(0.01)
+    task.cancel()
+    try:
+        await task
+    except asyncio.CancelledError:
+        pass
+
+def failing_probe(resilience: Resilience) -> None:
+    """Run a blocking probe that raises something other than UpstreamError."""
+    def broken(url: str) -> str:
+        raise ValueError("bad response body")
+    
+    try:
+        resilience.call(ENDPOINT, broken)
+    except ValueError:
+        pass
+
+def main():
+    resilience = open_breaker()
+    asyncio.run(cancelled_probe(resilience))
+    check_probe_free(resilience, "cancelled async probe")
+    
+    resilience = open_breaker()
+    failing_probe(resilience)
+    check_probe_free(resilience, "probe ending in an unexpected exception")
+
+if __name__ == "__main__":
+    main()
@@ -8,10 +8,18 @@ import json
 import time
 import uuid
 import logging
-from typing import Dict, List, Optional, Any
+import threading
+from typing import Dict, List, Optional, Any, Set, Tuple
+
+from template_registry import JsonFileRegistry, write_json_atomic
+from conversation import Conversation
 
 logger = logging.getLogger(__name__)
 
+DEFAULT_SYSTEM_PROMPT = "You are a helpful assistant."
+# Model settings of root bots, completed key by key down the hierarchy
+DEFAULT_MODEL_CONFIG = {"model": "gemini-1.5-flash", "temperature": 0.7, "max_tokens": 1024}
+
 class Bot:
     """
     Represents a chatbot with specific persona and configuration.
@@ -21,7 +29,7 @@ class Bot:
         self,
         name: str,
         description: str = "",
-        system_prompt: str = "You are a helpful assistant.",
+        system_prompt: str = DEFAULT_SYSTEM_PROMPT,
         focus_keywords: List[str] = None,
         icon: str = None,
         parent_id: str = None,
@@ -36,11 +44,12 @@ class Bot:
         Args:
             name: The name of the bot
             description: A description of the bot
-            system_prompt: System prompt for the bot
+            system_prompt: System prompt for the bot; None to inherit the parent's
             focus_keywords: Keywords that the bot focuses on
             icon: Icon for the bot
             parent_id: ID of the parent bot (if this is a child bot)
-            model_config: Configuration for the model
+            model_config: Configuration for the model; keys a child bot leaves
+                out are inherited from its parent
             id: Unique identifier for the bot (generated if not provided)
             created_at: Timestamp when the bot was created
             updated_at: Timestamp when the bot was last updated
@@ -51,7 +60,7 @@ class Bot:
         self.focus_keywords = focus_keywords or []
         self.icon = icon
         self.parent_id = parent_id
-        self.model_config = model_config or {"model": "gemini-1.5-flash", "temperature": 0.7, "max_tokens": 1024}
+        self.model_config = dict(DEFAULT_MODEL_CONFIG) if model_config is None else model_config
         self.id = id or str(uuid.uuid4())
         self.created_at = created_at or time.time()
         self.updated_at = updated_at or time.time()
@@ -102,7 +111,7 @@ class Bot:
     
     def save(self, directory: str) -> str:
         """
-        Save the bot to a JSON file.
+        Save the bot to a JSON file, replacing any previous version atomically.
         
         Args:
             directory: Directory to save the bot in
@@ -110,12 +119,8 @@ class Bot:
         Returns:
             Path to the saved file
         """
-        os.makedirs(directory, exist_ok=True)
         file_path = os.path.join(directory, f"{self.id}.json")
-        
-        with open(file_path, 'w') as f:
-            json.dump(self.to_dict(), f, indent=2)
-        
+        write_json_atomic(file_path, self.to_dict())
         return file_path
     
     @classmethod
@@ -160,3 +165,452 @@ class Bot:
                     logger.error(f"Error loading bot from {file_path}: {e}")
         
         return bots
+
+class BotConversation(Conversation):
+    """
+    A conversation with a bot, stored as one JSON file per conversation.
+    """
+    
+    def __init__(
+        self,
+        bot_id: Optional[str] = None,
+        user_id: Optional[str] = None,
+        metadata: Optional[Dict[str, Any]] = None,
+        id: Optional[str] = None
+    ):
+        """
+        Initialize a bot conversation.
+        
+        Args:
+            bot_id: ID of the bot the conversation is with
+            user_id: The ID of the user
+            metadata: Additional data, such as the system prompt it was started with
+            id: The ID of the conversation
+        """
+        super().__init__(id=id, user_id=user_id)
+        self.bot_id = bot_id
+        self.metadata = metadata or {}
+    
+    def to_dict(self) -> Dict[str, Any]:
+        """
+        Convert the conversation to a dictionary.
+        
+        Returns:
+            Dictionary representation of the conversation
+        """
+        data = super().to_dict()
+        data["botId"] = self.bot_id
+        data["metadata"] = self.metadata
+        return data
+    
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> 'BotConversation':
+        """
+        Create a bot conversation from a dictionary.
+        
+        Args:
+            data: Dictionary representation of the conversation
+            
+        Returns:
+            BotConversation instance
+        """
+        conversation = super().from_dict(data)
+        conversation.bot_id = data.get("botId")
+        conversation.metadata = data.get("metadata") or {}
+        return conversation
+    
+    def save(self, directory: str) -> str:
+        """
+        Save the conversation to a JSON file, replacing any previous version atomically.
+        
+        Args:
+            directory: Directory to save the conversation in
+            
+        Returns:
+            Path to the saved file
+        """
+        file_path = os.path.join(directory, f"{self.id}.json")
+        write_json_atomic(file_path, self.to_dict())
+        return file_path
+    
+    @classmethod
+    def load(cls, file_path: str) -> 'BotConversation':
+        """
+        Load a conversation from a JSON file.
+        
+        Args:
+            file_path: Path to the JSON file
+            
+        Returns:
+            BotConversation instance
+        """
+        with open(file_path, 'r') as f:
+            data = json.load(f)
+        
+        return cls.from_dict(data)
+    
+    @classmethod
+    def list_conversations(cls, directory: str, bot_id: Optional[str] = None, user_id: Optional[str] = None) -> List['BotConversation']:
+        """
+        List the conversations in a directory.
+        
+        Args:
+            directory: Directory containing conversation JSON files
+            bot_id: Optional bot ID to filter by
+            user_id: Optional user ID to filter by
+            
+        Returns:
+            List of BotConversation instances
+        """
+        conversations = []
+        
+        if not os.path.exists(directory):
+            return conversations
+        
+        for filename in os.listdir(directory):
+            if filename.endswith('.json'):
+                file_path = os.path.join(directory, filename)
+                try:
+                    conversation = cls.load(file_path)
+                except Exception as e:
+                    logger.error(f"Error loading conversation from {file_path}: {e}")
+                    continue
+                if bot_id and conversation.bot_id != bot_id:
+                    continue
+                if user_id and conversation.user_id != user_id:
+                    continue
+                conversations.append(conversation)
+        
+        return conversations
+
+class BotRegistry:
+    """
+    Bots loaded once from a directory and served from memory.
+    
+    Saves and deletions go through to disk and are visible at once; edits
+    by other processes are picked up by polling the directory's mtimes.
+    """
+    
+    def __init__(self, directory: str, poll_interval: float = None):
+        """
+        Initialize the registry without touching the directory.
+        
+        Args:
+            directory: Directory holding one <bot-id>.json file per bot
+            poll_interval: Seconds between checks of the directory for changes
+        """
+        self.files = JsonFileRegistry(directory, poll_interval=poll_interval)
+        # Bot ID -> (document it was built from, bot)
+        self._bots: Dict[str, Tuple[Dict[str, Any], Bot]] = {}
+        self._lock = threading.Lock()
+    
+    def get(self, bot_id: str) -> Optional[Bot]:
+        """
+        Get a bot by ID.
+        
+        The bot is shared with other callers and must not be modified; save a
+        copy instead.
+        
+        Args:
+            bot_id: ID of the bot
+            
+        Returns:
+            The bot or None if not found
+        """
+        data = self.files.get(bot_id)
+        if data is None:
+            return None
+        return self._bot(bot_id, data)
+    
+    def list(self, parent_id: str = None, keyword: str = None, limit: int = None, offset: int = 0) -> List[Bot]:
+        """
+        List bots in file name order, optionally filtered.
+        
+        Args:
+            parent_id: Only bots that are children of this bot
+            keyword: Only bots with this focus keyword, compared case-insensitively
+            limit: Maximum number of bots to return; None for all
+            offset: Number of matching bots to skip
+            
+        Returns:
+            List of shared Bot instances
+        """
+        bots = [self._bot(bot_id, data) for bot_id, data in self.files.documents().items()]
+        if parent_id is not None:
+            bots = [bot for bot in bots if bot.parent_id == parent_id]
+        if keyword is not None:
+            keyword = keyword.strip().lower()
+            bots = [bot for bot in bots if keyword in (k.strip().lower() for k in bot.focus_keywords)]
+        return bots[offset:None if limit is None else offset + limit]
+    
+    def save(self, bot: Bot) -> str:
+        """
+        Write a bot to disk and serve the new version.
+        
+        Args:
+            bot: The bot; must not be modified afterwards
+            
+        Returns:
+            Path to the saved file
+        """
+        data = bot.to_dict()
+        file_path = self.files.write(bot.id, data)
+        with self._lock:
+            self._bots[bot.id] = (data, bot)
+        return file_path
+    
+    def delete(self, bot_id: str) -> bool:
+        """
+        Delete a bot's file.
+        
+        Args:
+            bot_id: ID of the bot
+            
+        Returns:
+            True if the bot was deleted, False if it did not exist
+        """
+        with self._lock:
+            self._bots.pop(bot_id, None)
+        return self.files.remove(bot_id)
+    
+    def version(self) -> Any:
+        """
+        Get a token that is replaced whenever any bot changes.
+        
+        Returns:
+            The current document mapping, which is replaced on every change
+        """
+        return self.files.documents()
+    
+    def _bot(self, bot_id: str, data: Dict[str, Any]) -> Bot:
+        """Get the Bot for a document, building it again only if the document changed."""
+        cached = self._bots.get(bot_id)
+        if cached and cached[0] is data:
+            return cached[1]
+        
+        bot = Bot.from_dict(data)
+        with self._lock:
+            self._bots[bot_id] = (data, bot)
+        return bot
+
+class BotHierarchy:
+    """
+    Parent/child index of bots with memoized effective configurations.
+    
+    A bot's effective configuration is resolved along its ancestor chain:
+    model settings are merged key by key from the root down, and the system
+    prompt is the nearest one set. Each result is kept until the bot or one
+    of its ancestors changes, which drops only that bot's subtree from the
+    memo, so serving a message never walks the tree.
+    """
+    
+    def __init__(self):
+        """
+        Initialize an empty hierarchy; call sync to fill it.
+        """
+        self._bots: Dict[str, Bot] = {}
+        # Parent ID -> IDs of its children, including children of unknown parents
+        self._children: Dict[str, Set[str]] = {}
+        # Bot ID -> effective configuration
+        self._effective: Dict[str, Dict[str, Any]] = {}
+        # Parent ID -> counter bumped whenever a child or its keywords change
+        self._generations: Dict[str, int] = {}
+        # Registry version the index was last synced with
+        self._version: Any = None
+        self._lock = threading.RLock()
+        self.invalidations = 0
+    
+    def sync(self, registry: Any) -> None:
+        """
+        Catch up with changes made to a registry's bots by other processes.
+        
+        Costs one version check unless something changed; then only changed
+        bots are invalidated.
+        
+        Args:
+            registry: BotRegistry or CatalogBotRegistry holding the bots
+        """
+        version = registry.version()
+        if version is self._version:
+            return
+        
+        with self._lock:
+            bots = {bot.id: bot for bot in registry.list()}
+            for bot_id in [bot_id for bot_id in self._bots if bot_id not in bots]:
+                self.remove(bot_id)
+            for bot in bots.values():
+                self.update(bot)
+            self._version = version
+    
+    def update(self, bot: Bot) -> None:
+        """
+        Add or replace a bot, invalidating its subtree if its configuration changed.
+        
+        Args:
+            bot: The new version of the bot
+        """
+        with self._lock:
+            old = self._bots.get(bot.id)
+            if old is bot:
+                return
+            self._bots[bot.id] = bot
+            
+            if old is not None and old.parent_id != bot.parent_id:
+                self._children.get(old.parent_id, set()).discard(bot.id)
+                self._bump(old.parent_id)
+            if bot.parent_id is not None:
+                self._children.setdefault(bot.parent_id, set()).add(bot.id)
+                if old is None or old.parent_id != bot.parent_id or old.focus_keywords != bot.focus_keywords:
+                    self._bump(bot.parent_id)
+            
+            if (
+                old is None
+                or old.parent_id != bot.parent_id
+                or old.system_prompt != bot.system_prompt
+                or old.model_config != bot.model_config
+            ):
+                self._invalidate(bot.id)
+    
+    def remove(self, bot_id: str) -> None:
+        """
+        Remove a bot; its children resolve as roots until it comes back.
+        
+        Args:
+            bot_id: ID of the bot
+        """
+        with self._lock:
+            bot = self._bots.pop(bot_id, None)
+            if bot is None:
+                return
+            if bot.parent_id is not None:
+                self._children.get(bot.parent_id, set()).discard(bot_id)
+                self._bump(bot.parent_id)
+            self._invalidate(bot_id)
+    
+    def _bump(self, parent_id: Optional[str]) -> None:
+        """Record that a parent's set of children or their keywords changed."""
+        if parent_id is not None:
+            self._generations[parent_id] = self._generations.get(parent_id, 0) + 1
+    
+    def children_generation(self, bot_id: str) -> int:
+        """
+        Get a counter that changes whenever a bot's children change.
+        
+        Caches derived from the children, such as keyword routers, are
+        still valid while it stays the same.
+        
+        Args:
+            bot_id: ID of the parent bot
+            
+        Returns:
+            The counter; 0 for a bot whose children never changed
+        """
+        return self._generations.get(bot_id, 0)
+    
+    def _invalidate(self, bot_id: str) -> None:
+        """Drop the memoized configurations of a bot and all its descendants."""
+        pending = [bot_id]
+        seen = set()
+        while pending:
+            current = pending.pop()
+            if current in seen:
+                continue
+            seen.add(current)
+            if self._effective.pop(current, None) is not None:
+                self.invalidations += 1
+            pending.extend(self._children.get(current, ()))
+    
+    def children(self, bot_id: str) -> List[Bot]:
+        """
+        Get the direct children of a bot.
+        
+        Args:
+            bot_id: ID of the parent bot
+            
+        Returns:
+            Child bots in creation order
+        """
+        with self._lock:
+            children = [self._bots[child_id] for child_id in self._children.get(bot_id, ())]
+        return sorted(children, key=lambda bot: (bot.created_at, bot.id))
+    
+    def ancestors(self, bot_id: str) -> List[Bot]:
+        """
+        Get the known ancestors of a bot.
+        
+        Args:
+            bot_id: ID of the bot
+            
+        Returns:
+            Ancestors from the parent up to the root
+        """
+        ancestors = []
+        seen = {bot_id}
+        with self._lock:
+            bot = self._bots.get(bot_id)
+            while bot is not None and bot.parent_id is not None and bot.parent_id not in seen:
+                seen.add(bot.parent_id)
+                bot = self._bots.get(bot.parent_id)
+                if bot is not None:
+                    ancestors.append(bot)
+        return ancestors
+    
+    def effective_config(self, bot_id: str) -> Optional[Dict[str, Any]]:
+        """
+        Get a bot's configuration with everything it inherits filled in.
+        
+        The result is shared with other callers and must not be modified.
+        
+        Args:
+            bot_id: ID of the bot
+            
+        Returns:
+            The effective "system_prompt" and "model_config", or None if the
+            bot is unknown
+        """
+        effective = self._effective.get(bot_id)
+        if effective is not None:
+            return effective
+        
+        with self._lock:
+            if bot_id not in self._bots:
+                return None
+            return self._resolve(bot_id, set())
+    
+    def _resolve(self, bot_id: str, seen: Set[str]) -> Dict[str, Any]:
+        """Resolve and memoize a bot's configuration, reusing its parent's."""
+        effective = self._effective.get(bot_id)
+        if effective is not None:
+            return effective
+        
+        bot = self._bots[bot_id]
+        seen.add(bot_id)
+        if bot.parent_id in self._bots and bot.parent_id not in seen:
+            inherited = self._resolve(bot.parent_id, seen)
+        else:
+            if bot.parent_id in seen:
+                logger.warning(f"Bot {bot_id} is part of a parent cycle; resolving it as a root")
+            inherited = {"system_prompt": DEFAULT_SYSTEM_PROMPT, "model_config": DEFAULT_MODEL_CONFIG}
+        
+        effective = {
+            "system_prompt": bot.system_prompt or inherited["system_prompt"],
+            "model_config": {**inherited["model_config"], **(bot.model_config or {})}
+        }
+        self._effective[bot_id] = effective
+        return effective
+    
+    def stats(self) -> Dict[str, Any]:
+        """
+        Get hierarchy statistics.
+        
+        Returns:
+            Number of bots, of parents with children and of memoized
+            configurations, and the invalidation count
+        """
+        with self._lock:
+            return {
+                "bots": len(self._bots),
+                "parents": sum(1 for children in self._children.values() if children),
+                "memoized": len(self._effective),
+                "invalidations": self.invalidations
+            }
@@ -5,11 +5,16 @@ Bot service for the child bot system.
 import os
 import json
 import logging
-from typing import Dict, List, Any, Optional
+import threading
+from typing import Dict, List, Any, Optional, Tuple
 
-from src.models.bot import Bot
-from src.models.conversation import Conversation
-from src.services.llm_service import LLMService
+from bot import DEFAULT_SYSTEM_PROMPT, Bot, BotConversation, BotHierarchy, BotRegistry
+from llm_service import LLMService
+from context_builder import context_builder, context_token_budget
+from resilience import LLMUnavailableError
+from admission import AdmissionRejected
+from catalog import CatalogBotRegistry, create_catalog_from_env
+from keyword_matcher import KeywordMatcher
 
 # Configure logging
 logging.basicConfig(
@@ -39,6 +44,24 @@ class BotService:
         # Create directories if they don't exist
         os.makedirs(self.bots_dir, exist_ok=True)
         os.makedirs(self.conversations_dir, exist_ok=True)
+        
+        # Bots live in the SQLite catalog if BOT_CATALOG_PATH is set, seeded
+        # once from the JSON files; otherwise they are read once and served
+        # from memory, with writes going through to disk
+        self.catalog = create_catalog_from_env()
+        if self.catalog:
+            self.catalog.migrate_from_json(bots_dir=self.bots_dir)
+            self.bots = CatalogBotRegistry(self.catalog)
+        else:
+            self.bots = BotRegistry(self.bots_dir)
+        
+        # Parent/child index and inherited configurations, kept up to date by
+        # this service's writes and synced with other workers' on use
+        self.hierarchy = BotHierarchy()
+        
+        # Parent ID -> (children generation, matcher over the children's focus keywords)
+        self._routers: Dict[str, Tuple[int, Optional[KeywordMatcher]]] = {}
+        self._router_lock = threading.Lock()
     
     def create_bot(self, bot_data: Dict[str, Any]) -> Bot:
         """
@@ -50,17 +73,21 @@ class BotService:
         Returns:
             The created bot
         """
+        parent_id = bot_data.get("parent_id")
+        
+        # Child bots inherit the prompt and the model settings they leave out
         bot = Bot(
             name=bot_data.get("name", "Unnamed Bot"),
             description=bot_data.get("description", ""),
-            system_prompt=bot_data.get("system_prompt", "You are a helpful assistant."),
+            system_prompt=bot_data.get("system_prompt", None if parent_id else DEFAULT_SYSTEM_PROMPT),
             focus_keywords=bot_data.get("focus_keywords", []),
             icon=bot_data.get("icon"),
-            parent_id=bot_data.get("parent_id"),
-            model_config=bot_data.get("model_config")
+            parent_id=parent_id,
+            model_config=bot_data.get("model_config", {} if parent_id else None)
         )
         
-        bot.save(self.bots_dir)
+        self.bots.save(bot)
+        self.hierarchy.update(bot)
         logger.info(f"Created bot: {bot.id} - {bot.name}")
         
         return bot
@@ -75,17 +102,12 @@ class BotService:
         Returns:
             The bot or None if not found
         """
-        file_path = os.path.join(self.bots_dir, f"{bot_id}.json")
+        bot = self.bots.get(bot_id)
         
-        if not os.path.exists(file_path):
+        if not bot:
             logger.warning(f"Bot not found: {bot_id}")
-            return None
         
-        try:
-            return Bot.load(file_path)
-        except Exception as e:
-            logger.exception(f"Error loading bot: {bot_id}")
-            return None
+        return bot
     
     def update_bot(self, bot_id: str, bot_data: Dict[str, Any]) -> Optional[Bot]:
         """
@@ -103,6 +125,9 @@ class BotService:
         if not bot:
             return None
         
+        # The registry's instance is shared with readers; update a copy
+        bot = Bot.from_dict(bot.to_dict())
+        
         # Update bot fields
         if "name" in bot_data:
             bot.name = bot_data["name"]
@@ -117,7 +142,8 @@ class BotService:
         if "model_config" in bot_data:
             bot.model_config = bot_data["model_config"]
         
-        bot.save(self.bots_dir)
+        self.bots.save(bot)
+        self.hierarchy.update(bot)
         logger.info(f"Updated bot: {bot.id} - {bot.name}")
         
         return bot
@@ -132,30 +158,117 @@ class BotService:
         Returns:
             True if the bot was deleted, False otherwise
         """
-        file_path = os.path.join(self.bots_dir, f"{bot_id}.json")
-        
-        if not os.path.exists(file_path):
-            logger.warning(f"Bot not found for deletion: {bot_id}")
-            return False
-        
         try:
-            os.remove(file_path)
+            if not self.bots.delete(bot_id):
+                logger.warning(f"Bot not found for deletion: {bot_id}")
+                return False
+            self.hierarchy.remove(bot_id)
             logger.info(f"Deleted bot: {bot_id}")
             return True
         except Exception as e:
             logger.exception(f"Error deleting bot: {bot_id}")
             return False
     
-    def list_bots(self) -> List[Bot]:
+    def list_bots(self, parent_id: str = None, keyword: str = None, limit: int = None, offset: int = 0) -> List[Bot]:
         """
-        List all bots.
+        List bots, optionally filtered and paginated.
         
+        Args:
+            parent_id: Only bots that are children of this bot
+            keyword: Only bots with this focus keyword
+            limit: Maximum number of bots to return; None for all
+            offset: Number of matching bots to skip
+            
         Returns:
             List of bots
         """
-        return Bot.list_bots(self.bots_dir)
+        return self.bots.list(parent_id, keyword, limit, offset)
+    
+    def get_children(self, bot_id: str) -> List[Bot]:
+        """
+        Get the direct children of a bot.
+        
+        Args:
+            bot_id: ID of the parent bot
+            
+        Returns:
+            Child bots in creation order
+        """
+        self.hierarchy.sync(self.bots)
+        return self.hierarchy.children(bot_id)
+    
+    def get_effective_config(self, bot_id: str) -> Optional[Dict[str, Any]]:
+        """
+        Get a bot's system prompt and model settings with inherited values filled in.
+        
+        Args:
+            bot_id: ID of the bot
+            
+        Returns:
+            Dict with "system_prompt" and "model_config", or None if the bot
+            doesn't exist
+        """
+        self.hierarchy.sync(self.bots)
+        return self.hierarchy.effective_config(bot_id)
     
-    def create_conversation(self, bot_id: str, user_id: str = "anonymous") -> Optional[Conversation]:
+    def route_message(self, bot_id: str, message: str) -> str:
+        """
+        Pick the bot that should answer a message sent to a bot.
+        
+        The message is passed down the hierarchy, at each level to the child
+        whose focus keywords it matches best, and stays with the first bot
+        none of whose children match. Each level costs one scan of the
+        message, however many children there are.
+        
+        Args:
+            bot_id: ID of the bot the message was sent to
+            message: The message
+            
+        Returns:
+            ID of the bot itself or of one of its descendants
+        """
+        self.hierarchy.sync(self.bots)
+        routed_id = bot_id
+        seen = {bot_id}
+        while True:
+            router = self._get_router(routed_id)
+            child_id = router.best_match(message) if router else None
+            if child_id is None or child_id in seen:
+                return routed_id
+            seen.add(child_id)
+            routed_id = child_id
+    
+    def _get_router(self, parent_id: str) -> Optional[KeywordMatcher]:
+        """
+        Get the keyword matcher over a bot's children, compiling it again
+        only when a child was added, removed or changed its keywords.
+        
+        While one thread compiles, other threads keep routing with the
+        previous matcher; only the first compilation for a parent blocks.
+        """
+        generation = self.hierarchy.children_generation(parent_id)
+        cached = self._routers.get(parent_id)
+        if cached is not None and cached[0] == generation:
+            return cached[1]
+        
+        if not self._router_lock.acquire(blocking=cached is None):
+            return cached[1]
+        
+        try:
+            cached = self._routers.get(parent_id)
+            if cached is not None and cached[0] == generation:
+                return cached[1]
+            
+            children = self.hierarchy.children(parent_id)
+            router = KeywordMatcher({child.id: child.focus_keywords for child in children}) if children else None
+            self._routers[parent_id] = (generation, router)
+            if children:
+                logger.info(f"Compiled keyword router for bot {parent_id} over {len(children)} children")
+            return router
+        finally:
+            self._router_lock.release()
+    
+    def create_conversation(self, bot_id: str, user_id: str = "anonymous") -> Optional[BotConversation]:
         """
         Create a new conversation with a bot.
         
@@ -166,15 +279,16 @@ class BotService:
         Returns:
             The created conversation or None if the bot doesn't exist
         """
-        bot = self.get_bot(bot_id)
+        config = self.get_effective_config(bot_id)
         
-        if not bot:
+        if not config:
+            logger.warning(f"Bot not found: {bot_id}")
             return None
         
-        conversation = Conversation(
+        conversation = BotConversation(
             bot_id=bot_id,
             user_id=user_id,
-            metadata={"system_prompt": bot.system_prompt}
+            metadata={"system_prompt": config["system_prompt"]}
         )
         
         conversation_dir = os.path.join(self.conversations_dir, bot_id)
@@ -185,7 +299,7 @@ class BotService:
         
         return conversation
     
-    def get_conversation(self, conversation_id: str, bot_id: str) -> Optional[Conversation]:
+    def get_conversation(self, conversation_id: str, bot_id: str) -> Optional[BotConversation]:
         """
         Get a conversation by ID.
         
@@ -204,12 +318,12 @@ class BotService:
             return None
         
         try:
-            return Conversation.load(file_path)
+            return BotConversation.load(file_path)
         except Exception as e:
             logger.exception(f"Error loading conversation: {conversation_id}")
             return None
     
-    def list_conversations(self, bot_id: str, user_id: str = None) -> List[Conversation]:
+    def list_conversations(self, bot_id: str, user_id: str = None) -> List[BotConversation]:
         """
         List conversations for a bot.
         
@@ -221,14 +335,15 @@ class BotService:
             List of conversations
         """
         conversation_dir = os.path.join(self.conversations_dir, bot_id)
-        return Conversation.list_conversations(conversation_dir, bot_id, user_id)
+        return BotConversation.list_conversations(conversation_dir, bot_id, user_id)
     
     def send_message(
         self,
         conversation_id: str,
         bot_id: str,
         message: str,
-        user_id: str = "anonymous"
+        user_id: str = "anonymous",
+        route: bool = True
     ) -> Dict[str, Any]:
         """
         Send a message to a bot and get a response.
@@ -238,10 +353,29 @@ class BotService:
             bot_id: ID of the bot
             message: Message to send
             user_id: ID of the user
-            
+            route: Whether a parent bot hands the message to the child bot
+                whose focus keywords match it best
+                
         Returns:
-            Response from the bot
+            Response from the bot, with the ID of the bot that answered as
+            routed_bot_id
         """
+        if not self.get_effective_config(bot_id):
+            logger.warning(f"Bot not found: {bot_id}")
+            return {"error": f"Bot not found: {bot_id}"}
+        
+        # Answer with the configuration, inherited from its ancestors, of
+        # the bot the message is routed to; the conversation stays with bot_id
+        routed_bot_id = self.route_message(bot_id, message) if route else bot_id
+        config = self.get_effective_config(routed_bot_id)
+        if not config:
+            # The child was deleted since routing
+            routed_bot_id = bot_id
+            config = self.get_effective_config(bot_id)
+        model_config = config["model_config"]
+        if routed_bot_id != bot_id:
+            logger.info(f"Routed message for bot {bot_id} to child bot {routed_bot_id}")
+        
         # Get the conversation or create a new one if it doesn't exist
         conversation = self.get_conversation(conversation_id, bot_id)
         if not conversation:
@@ -249,24 +383,56 @@ class BotService:
             if not conversation:
                 return {"error": f"Bot not found: {bot_id}"}
         
-        # Get the bot
-        bot = self.get_bot(bot_id)
-        if not bot:
-            return {"error": f"Bot not found: {bot_id}"}
-        
         # Add the user message to the conversation
         conversation.add_message("user", message)
         
-        # Get the conversation context for the LLM
-        context = conversation.get_context_for_llm()
+        model = model_config.get("model", "vicuna-13b")
+        max_tokens = model_config.get("max_tokens", 1024)
         
-        # Get the bot's response from the LLM
-        llm_response = self.llm_service.chat_completion(
-            messages=context,
-            model=bot.model_config.get("model", "vicuna-13b"),
-            temperature=bot.model_config.get("temperature", 0.7),
-            max_tokens=bot.model_config.get("max_tokens", 1024)
+        # Get the most recent turns that fit the model's context window
+        window = context_builder.build(
+            conversation,
+            system_prompt=config["system_prompt"],
+            token_budget=context_token_budget(model, max_tokens)
         )
+        if window.trimmed_tokens:
+            logger.info(
+                f"Trimmed {window.trimmed_tokens} tokens ({window.trimmed_messages} messages) "
+                f"from conversation {conversation.id} for model {model}"
+            )
+        
+        # Get the bot's response from the LLM
+        try:
+            llm_response = self.llm_service.chat_completion(
+                messages=window.messages,
+                model=model,
+                temperature=model_config.get("temperature", 0.7),
+                max_tokens=max_tokens,
+                user_id=user_id
+            )
+        except AdmissionRejected as e:
+            logger.warning(f"LLM call not admitted for conversation {conversation.id}: {e}")
+            return {
+                "conversation_id": conversation.id,
+                "bot_id": bot_id,
+                "routed_bot_id": routed_bot_id,
+                "error": "Too many requests in progress",
+                "details": str(e),
+                "status": e.status,
+                "retry_after": round(e.retry_after, 1)
+            }
+        except LLMUnavailableError as e:
+            logger.error(f"LLM unavailable for conversation {conversation.id}: {e}")
+            result = {
+                "conversation_id": conversation.id,
+                "bot_id": bot_id,
+                "routed_bot_id": routed_bot_id,
+                "error": "The language model is temporarily unavailable",
+                "details": str(e)
+            }
+            if e.retry_after is not None:
+                result["retry_after"] = round(e.retry_after, 1)
+            return result
         
         # Extract the assistant's message
         assistant_message = self.llm_service.extract_assistant_message(llm_response)
@@ -281,13 +447,16 @@ class BotService:
             
             return {
                 "conversation_id": conversation.id,
-                "bot_id": bot.id,
-                "message": assistant_message
+                "bot_id": bot_id,
+                "routed_bot_id": routed_bot_id,
+                "message": assistant_message,
+                "context": window.to_dict()
             }
         else:
             return {
                 "conversation_id": conversation.id,
-                "bot_id": bot.id,
+                "bot_id": bot_id,
+                "routed_bot_id": routed_bot_id,
                 "error": "Failed to get response from LLM",
                 "details": llm_response
             }
@@ -0,0 +1,510 @@
+"""
+Indexed catalog of bots and knowledge bases in a single SQLite file.
+
+The per-file JSON layout needs one open and parse per entity to list them
+and cannot filter without loading everything. The catalog keeps each
+entity's JSON document in one row, with indexed columns for the fields
+that are queried: bots by parent and by focus keyword (through the
+bot_keywords table), both kinds by ID. Listings are paginated in creation
+order. Existing JSON directories are imported once by migrate_from_json.
+"""
+
+import os
+import json
+import time
+import sqlite3
+import logging
+import threading
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from bot import Bot
+from knowledge_base import KnowledgeBase
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_PAGE_SIZE = 50
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS bots (
+    id TEXT PRIMARY KEY,
+    parent_id TEXT,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL,
+    data TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS bots_parent ON bots (parent_id, created_at, id);
+CREATE INDEX IF NOT EXISTS bots_created ON bots (created_at, id);
+-- created_at is copied from bots so keyword listings are read in index order
+CREATE TABLE IF NOT EXISTS bot_keywords (
+    keyword TEXT NOT NULL,
+    created_at REAL NOT NULL,
+    bot_id TEXT NOT NULL,
+    PRIMARY KEY (keyword, created_at, bot_id)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS bot_keywords_bot ON bot_keywords (bot_id);
+CREATE TABLE IF NOT EXISTS knowledge_bases (
+    id TEXT PRIMARY KEY,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL,
+    data TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS knowledge_bases_created ON knowledge_bases (created_at, id);
+CREATE TABLE IF NOT EXISTS migrations (
+    source TEXT PRIMARY KEY,
+    migrated_at REAL NOT NULL,
+    count INTEGER NOT NULL
+);
+"""
+
+# Replace the stored version when a row already exists
+UPSERT_BOT = (
+    "INSERT INTO bots (id, parent_id, created_at, updated_at, data) VALUES (?, ?, ?, ?, ?) "
+    "ON CONFLICT (id) DO UPDATE SET parent_id = excluded.parent_id, created_at = excluded.created_at, "
+    "updated_at = excluded.updated_at, data = excluded.data"
+)
+UPSERT_KNOWLEDGE_BASE = (
+    "INSERT INTO knowledge_bases (id, created_at, updated_at, data) VALUES (?, ?, ?, ?) "
+    "ON CONFLICT (id) DO UPDATE SET created_at = excluded.created_at, "
+    "updated_at = excluded.updated_at, data = excluded.data"
+)
+
+def normalize_keywords(keywords: Optional[List[str]]) -> List[str]:
+    """
+    Normalize focus keywords for indexing and lookup.
+    
+    Args:
+        keywords: Keywords as entered
+        
+    Returns:
+        Distinct lowercase keywords without surrounding whitespace
+    """
+    return sorted({keyword.strip().lower() for keyword in keywords or [] if keyword and keyword.strip()})
+
+class Catalog:
+    """
+    SQLite-backed catalog of bots and knowledge bases.
+    """
+    
+    def __init__(self, path: str):
+        """
+        Initialize the catalog, creating the database if needed.
+        
+        Args:
+            path: Path of the SQLite database file
+        """
+        self.path = path
+        self._conn: Optional[sqlite3.Connection] = None
+        self._conn_pid: Optional[int] = None
+        self._lock = threading.RLock()
+        
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with self._lock:
+            self.connection.executescript(SCHEMA)
+    
+    @property
+    def connection(self) -> sqlite3.Connection:
+        """
+        Get this process's database connection, opening it on first use.
+        
+        Returns:
+            The SQLite connection
+        """
+        if self._conn is None or self._conn_pid != os.getpid():
+            conn = sqlite3.connect(self.path, check_same_thread=False, timeout=10, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn = conn
+            self._conn_pid = os.getpid()
+        return self._conn
+    
+    def data_version(self) -> int:
+        """
+        Get a number that changes when another connection commits a change.
+        
+        Returns:
+            SQLite's data_version for this process's connection
+        """
+        with self._lock:
+            return self.connection.execute("PRAGMA data_version").fetchone()[0]
+    
+    # --- Bots ---
+    
+    def save_bot(self, bot: Bot) -> None:
+        """
+        Insert or replace a bot and its keyword index entries.
+        
+        Args:
+            bot: The bot to store
+        """
+        with self._lock:
+            conn = self.connection
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                self._write_bot(conn, bot)
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+    
+    def get_bot(self, bot_id: str) -> Optional[Bot]:
+        """
+        Get a bot by ID.
+        
+        Args:
+            bot_id: ID of the bot
+            
+        Returns:
+            The bot or None if not found
+        """
+        with self._lock:
+            row = self.connection.execute("SELECT data FROM bots WHERE id = ?", (bot_id,)).fetchone()
+        return Bot.from_dict(json.loads(row[0])) if row else None
+    
+    def delete_bot(self, bot_id: str) -> bool:
+        """
+        Delete a bot and its keyword index entries.
+        
+        Args:
+            bot_id: ID of the bot
+            
+        Returns:
+            True if the bot was stored, False otherwise
+        """
+        with self._lock:
+            conn = self.connection
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                cursor = conn.execute("DELETE FROM bots WHERE id = ?", (bot_id,))
+                conn.execute("DELETE FROM bot_keywords WHERE bot_id = ?", (bot_id,))
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+        
+        return cursor.rowcount > 0
+    
+    def list_bots(
+        self,
+        parent_id: str = None,
+        keyword: str = None,
+        limit: int = DEFAULT_PAGE_SIZE,
+        offset: int = 0
+    ) -> List[Bot]:
+        """
+        List bots in creation order, optionally filtered.
+        
+        Args:
+            parent_id: Only bots that are children of this bot
+            keyword: Only bots with this focus keyword, compared case-insensitively
+            limit: Maximum number of bots to return; None for all
+            offset: Number of matching bots to skip
+            
+        Returns:
+            List of bots
+        """
+        where, params = self._bot_filter(parent_id, keyword)
+        order = "bot_keywords.created_at, bot_keywords.bot_id" if keyword is not None else "bots.created_at, bots.id"
+        query = f"SELECT bots.data FROM {where} ORDER BY {order} LIMIT ? OFFSET ?"
+        with self._lock:
+            rows = self.connection.execute(query, params + (-1 if limit is None else limit, offset)).fetchall()
+        return [Bot.from_dict(json.loads(row[0])) for row in rows]
+    
+    def count_bots(self, parent_id: str = None, keyword: str = None) -> int:
+        """
+        Count the bots list_bots would return without pagination.
+        
+        Args:
+            parent_id: Only bots that are children of this bot
+            keyword: Only bots with this focus keyword
+            
+        Returns:
+            Number of matching bots
+        """
+        where, params = self._bot_filter(parent_id, keyword)
+        with self._lock:
+            return self.connection.execute(f"SELECT COUNT(*) FROM {where}", params).fetchone()[0]
+    
+    def _bot_filter(self, parent_id: Optional[str], keyword: Optional[str]) -> Tuple[str, Tuple]:
+        """Build the FROM and WHERE clauses of a bot query; both filters use an index."""
+        if keyword is not None:
+            clause = "bot_keywords JOIN bots ON bots.id = bot_keywords.bot_id WHERE bot_keywords.keyword = ?"
+            params: Tuple = (keyword.strip().lower(),)
+        else:
+            clause = "bots WHERE 1"
+            params = ()
+        if parent_id is not None:
+            clause += " AND bots.parent_id = ?"
+            params += (parent_id,)
+        return clause, params
+    
+    def _write_bot(self, conn: sqlite3.Connection, bot: Bot) -> None:
+        """Upsert a bot row and rewrite its keywords inside the caller's transaction."""
+        conn.execute(UPSERT_BOT, (bot.id, bot.parent_id, bot.created_at, bot.updated_at, json.dumps(bot.to_dict())))
+        conn.execute("DELETE FROM bot_keywords WHERE bot_id = ?", (bot.id,))
+        conn.executemany(
+            "INSERT INTO bot_keywords (keyword, created_at, bot_id) VALUES (?, ?, ?)",
+            [(keyword, bot.created_at, bot.id) for keyword in normalize_keywords(bot.focus_keywords)]
+        )
+    
+    # --- Knowledge bases ---
+    
+    def save_knowledge_base(self, knowledge_base: KnowledgeBase) -> None:
+        """
+        Insert or replace a knowledge base.
+        
+        Args:
+            knowledge_base: The knowledge base to store
+        """
+        with self._lock:
+            self._write_knowledge_base(self.connection, knowledge_base)
+    
+    def get_knowledge_base(self, knowledge_base_id: str) -> Optional[KnowledgeBase]:
+        """
+        Get a knowledge base by ID.
+        
+        Args:
+            knowledge_base_id: ID of the knowledge base
+            
+        Returns:
+            The knowledge base or None if not found
+        """
+        with self._lock:
+            row = self.connection.execute(
+                "SELECT data FROM knowledge_bases WHERE id = ?", (knowledge_base_id,)
+            ).fetchone()
+        return KnowledgeBase.from_dict(json.loads(row[0])) if row else None
+    
+    def delete_knowledge_base(self, knowledge_base_id: str) -> bool:
+        """
+        Delete a knowledge base.
+        
+        Args:
+            knowledge_base_id: ID of the knowledge base
+            
+        Returns:
+            True if the knowledge base was stored, False otherwise
+        """
+        with self._lock:
+            cursor = self.connection.execute("DELETE FROM knowledge_bases WHERE id = ?", (knowledge_base_id,))
+        return cursor.rowcount > 0
+    
+    def list_knowledge_bases(self, limit: int = DEFAULT_PAGE_SIZE, offset: int = 0) -> List[KnowledgeBase]:
+        """
+        List knowledge bases in creation order.
+        
+        Args:
+            limit: Maximum number of knowledge bases to return; None for all
+            offset: Number of knowledge bases to skip
+            
+        Returns:
+            List of knowledge bases
+        """
+        with self._lock:
+            rows = self.connection.execute(
+                "SELECT data FROM knowledge_bases ORDER BY created_at, id LIMIT ? OFFSET ?",
+                (-1 if limit is None else limit, offset)
+            ).fetchall()
+        return [KnowledgeBase.from_dict(json.loads(row[0])) for row in rows]
+    
+    def _write_knowledge_base(self, conn: sqlite3.Connection, knowledge_base: KnowledgeBase) -> None:
+        """Upsert a knowledge base row."""
+        conn.execute(
+            UPSERT_KNOWLEDGE_BASE,
+            (knowledge_base.id, knowledge_base.created_at, knowledge_base.updated_at, json.dumps(knowledge_base.to_dict()))
+        )
+    
+    # --- Migration ---
+    
+    def migrate_from_json(self, bots_dir: str = None, knowledge_bases_dir: str = None, force: bool = False) -> Dict[str, int]:
+        """
+        Import the per-file JSON layout into the catalog, once per directory.
+        
+        Each directory is imported in one transaction and recorded, so later
+        calls, including concurrent ones from other workers, skip it. The
+        JSON files are left in place.
+        
+        Args:
+            bots_dir: Directory with one <bot-id>.json file per bot
+            knowledge_bases_dir: Directory with one <id>.json file per knowledge base
+            force: Import again even if a directory was already imported
+            
+        Returns:
+            Number of entities imported per kind
+        """
+        imported = {"bots": 0, "knowledge_bases": 0}
+        if bots_dir:
+            imported["bots"] = self._migrate(bots_dir, Bot.load, self._write_bot, force)
+        if knowledge_bases_dir:
+            imported["knowledge_bases"] = self._migrate(knowledge_bases_dir, KnowledgeBase.load, self._write_knowledge_base, force)
+        return imported
+    
+    def _migrate(
+        self,
+        directory: str,
+        load: Callable[[str], Any],
+        write: Callable[[sqlite3.Connection, Any], None],
+        force: bool
+    ) -> int:
+        """Import one directory of JSON files unless it was imported before."""
+        source = os.path.abspath(directory)
+        if not force and self._migrated(source):
+            # Skip reading the files on every start after the first
+            return 0
+        
+        entities = []
+        try:
+            entries = list(os.scandir(directory))
+        except FileNotFoundError:
+            entries = []
+        for entry in entries:
+            if not entry.name.endswith('.json') or not entry.is_file():
+                continue
+            try:
+                entities.append(load(entry.path))
+            except Exception as e:
+                logger.error(f"Skipping {entry.path} in catalog migration: {e}")
+        
+        with self._lock:
+            conn = self.connection
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                # Another worker may have imported it while the files were read
+                if not force and self._migrated(source):
+                    conn.execute("ROLLBACK")
+                    return 0
+                
+                for entity in entities:
+                    write(conn, entity)
+                conn.execute(
+                    "INSERT OR REPLACE INTO migrations (source, migrated_at, count) VALUES (?, ?, ?)",
+                    (source, time.time(), len(entities))
+                )
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+        
+        logger.info(f"Imported {len(entities)} entities from {directory} into the catalog")
+        return len(entities)
+    
+    def _migrated(self, source: str) -> bool:
+        """Check whether a directory was imported before."""
+        with self._lock:
+            return self.connection.execute("SELECT 1 FROM migrations WHERE source = ?", (source,)).fetchone() is not None
+    
+    def stats(self) -> Dict[str, Any]:
+        """
+        Get catalog statistics.
+        
+        Returns:
+            Number of stored bots, indexed keywords and knowledge bases
+        """
+        with self._lock:
+            conn = self.connection
+            bots = conn.execute("SELECT COUNT(*) FROM bots").fetchone()[0]
+            keywords = conn.execute("SELECT COUNT(DISTINCT keyword) FROM bot_keywords").fetchone()[0]
+            knowledge_bases = conn.execute("SELECT COUNT(*) FROM knowledge_bases").fetchone()[0]
+        return {"path": self.path, "bots": bots, "keywords": keywords, "knowledgeBases": knowledge_bases}
+    
+    def close(self) -> None:
+        """
+        Close the database connection.
+        """
+        with self._lock:
+            if self._conn is not None and self._conn_pid == os.getpid():
+                self._conn.close()
+            self._conn = None
+            self._conn_pid = None
+
+
+class CatalogBotRegistry:
+    """
+    The catalog's bots behind the same interface as BotRegistry.
+    """
+    
+    def __init__(self, catalog: Catalog):
+        """
+        Initialize the registry.
+        
+        Args:
+            catalog: Catalog holding the bots
+        """
+        self.catalog = catalog
+        self._data_version: Optional[int] = None
+        self._version = object()
+    
+    def get(self, bot_id: str) -> Optional[Bot]:
+        """
+        Get a bot by ID.
+        
+        Args:
+            bot_id: ID of the bot
+            
+        Returns:
+            The bot or None if not found
+        """
+        return self.catalog.get_bot(bot_id)
+    
+    def list(self, parent_id: str = None, keyword: str = None, limit: int = None, offset: int = 0) -> List[Bot]:
+        """
+        List bots in creation order, optionally filtered.
+        
+        Args:
+            parent_id: Only bots that are children of this bot
+            keyword: Only bots with this focus keyword
+            limit: Maximum number of bots to return; None for all
+            offset: Number of matching bots to skip
+            
+        Returns:
+            List of bots
+        """
+        return self.catalog.list_bots(parent_id, keyword, limit, offset)
+    
+    def version(self) -> Any:
+        """
+        Get a token that is replaced whenever another process changes the catalog.
+        
+        Changes made through this process's connection do not replace it.
+        
+        Returns:
+            An opaque token, compared by identity
+        """
+        data_version = self.catalog.data_version()
+        if data_version != self._data_version:
+            self._data_version = data_version
+            self._version = object()
+        return self._version
+    
+    def save(self, bot: Bot) -> None:
+        """
+        Store a bot.
+        
+        Args:
+            bot: The bot to store
+        """
+        self.catalog.save_bot(bot)
+    
+    def delete(self, bot_id: str) -> bool:
+        """
+        Delete a bot.
+        
+        Args:
+            bot_id: ID of the bot
+            
+        Returns:
+            True if the bot was deleted, False if it did not exist
+        """
+        return self.catalog.delete_bot(bot_id)
+
+
+def create_catalog_from_env() -> Optional[Catalog]:
+    """
+    Create the catalog if BOT_CATALOG_PATH is set.
+    
+    Returns:
+        The configured catalog or None to keep the per-file JSON layout
+    """
+    path = os.environ.get("BOT_CATALOG_PATH")
+    if not path:
+        return None
+    return Catalog(path)
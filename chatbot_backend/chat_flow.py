@@ -0,0 +1,224 @@
+"""
+Chat turn processing shared by the Flask and ASGI entry points.
+"""
+
+import json
+import logging
+from typing import Dict, Any, Optional
+
+from conversation import Conversation, ConversationManager
+from prompt_manager import PromptManager
+from personas import persona_registry
+from request_prefix import RequestPrefix
+from admission import PRIORITY_HIGH, PRIORITY_NORMAL
+
+logger = logging.getLogger(__name__)
+
+def format_sse(data: Dict[str, Any], event: Optional[str] = None) -> str:
+    """Format a payload as a server-sent event."""
+    prefix = f"event: {event}\n" if event else ""
+    return f"{prefix}data: {json.dumps(data)}\n\n"
+
+class ChatTurn:
+    """
+    Result of processing a chat request up to the point of calling the LLM.
+    
+    A turn either already has its reply (questionnaire questions never touch
+    the LLM) or describes the generation the caller still has to run, with
+    whichever LLM client suits its execution model.
+    """
+    
+    def __init__(
+        self,
+        conversation: Conversation,
+        reply: Optional[Dict[str, Any]] = None,
+        system_instruction: Optional[str] = None,
+        prefix: Optional[RequestPrefix] = None,
+        prompt: Optional[str] = None,
+        user_message: Optional[str] = None,
+        extra: Optional[Dict[str, Any]] = None,
+        priority: int = PRIORITY_NORMAL,
+        conversation_manager: Optional[ConversationManager] = None
+    ):
+        """
+        Initialize a chat turn.
+        
+        Args:
+            conversation: The conversation the turn belongs to
+            reply: Ready-made response payload, if no generation is needed
+            system_instruction: System instruction for the AI
+            prefix: Precomputed request prefix of the persona; supplies the
+                system instruction if given
+            prompt: Message to send to the LLM
+            user_message: Message recorded as the user's turn
+            extra: Additional fields for the final response payload
+            priority: Admission priority class of the generation
+            conversation_manager: Store to save the conversation to when the
+                turn completes its questionnaire; None if it does not
+        """
+        self.conversation = conversation
+        self.reply = reply
+        self.prefix = prefix
+        self.system_instruction = prefix.system_instruction if prefix else system_instruction
+        self.prompt = prompt
+        self.user_message = user_message
+        self.extra = extra or {}
+        self.priority = priority
+        self.conversation_manager = conversation_manager
+    
+    @property
+    def needs_generation(self) -> bool:
+        """Whether the caller still has to generate the reply with the LLM."""
+        return self.reply is None
+    
+    def start_event(self) -> Dict[str, Any]:
+        """
+        Get the payload announcing a streamed reply.
+        
+        Returns:
+            Payload for the "start" event
+        """
+        return {
+            "conversationId": self.conversation.id,
+            "promptMode": False,
+            "isQuestion": False
+        }
+    
+    def complete(self, response: str) -> Dict[str, Any]:
+        """
+        Record the generated reply in the conversation.
+        
+        A turn that ends a questionnaire marks it complete here rather than
+        when the turn is prepared.
+        
+        Args:
+            response: The assistant's full response
+            
+        Returns:
+            Response payload for the client
+        """
+        self.conversation.add_message("user", self.user_message)
+        self.conversation.add_message("assistant", response)
+        
+        # Only now that there is a reply: a generation that was not admitted
+        # leaves the questionnaire open, so the user can send the answer again
+        if self.conversation_manager:
+            self.conversation.complete_questionnaire()
+            self.conversation_manager.save_conversation(self.conversation)
+        
+        return {
+            "message": response,
+            "conversationId": self.conversation.id,
+            "promptMode": False,
+            "isQuestion": False,
+            **self.extra
+        }
+
+class ChatFlow:
+    """
+    Runs the /api/chat state machine: normal chat plus the prompt-mode questionnaire.
+    """
+    
+    def __init__(self, conversation_manager: ConversationManager, prompt_manager: PromptManager):
+        """
+        Initialize the chat flow.
+        
+        Args:
+            conversation_manager: Store for conversation state
+            prompt_manager: Questionnaire templates and prompt generation
+        """
+        self.conversation_manager = conversation_manager
+        self.prompt_manager = prompt_manager
+    
+    def prepare_turn(
+        self,
+        user_id: str,
+        message: str,
+        persona_id: str = "default",
+        prompt_mode: bool = False,
+        conversation_id: Optional[str] = None
+    ) -> ChatTurn:
+        """
+        Advance the conversation for an incoming message.
+        
+        Args:
+            user_id: The ID of the user
+            message: The user's message
+            persona_id: The persona answering the message
+            prompt_mode: Whether the client requested prompt enhancement
+            conversation_id: The ID of an existing conversation
+            
+        Returns:
+            The chat turn to answer or generate
+        """
+        # Get or create conversation
+        conversation = self.conversation_manager.get_or_create_conversation(
+            user_id=user_id,
+            conversation_id=conversation_id
+        )
+        
+        # Handle prompt mode initialization
+        if prompt_mode and not conversation.questionnaire:
+            # Initialize questionnaire if not already in progress
+            template_id = self.prompt_manager.select_template(message)
+            conversation.start_questionnaire(template_id, message)
+            self.conversation_manager.save_conversation(conversation)
+            
+            logger.info(f"Started questionnaire with template: {template_id}")
+            
+            # Return first question
+            first_question = self.prompt_manager.get_current_question(conversation)
+            return ChatTurn(conversation, reply={
+                "message": first_question,
+                "conversationId": conversation.id,
+                "promptMode": True,
+                "isQuestion": True,
+                "templateId": template_id
+            })
+        
+        # Handle questionnaire in progress
+        if conversation.questionnaire and not conversation.questionnaire.get("complete", False):
+            # Store answer to current question
+            self.prompt_manager.store_answer(conversation, message)
+            
+            logger.info(f"Stored answer for question {conversation.questionnaire.get('currentQuestionIndex', 0)}")
+            
+            # Check if more questions
+            if self.prompt_manager.has_next_question(conversation):
+                # Return next question
+                next_question = self.prompt_manager.get_next_question(conversation)
+                self.conversation_manager.save_conversation(conversation)
+                return ChatTurn(conversation, reply={
+                    "message": next_question,
+                    "conversationId": conversation.id,
+                    "promptMode": True,
+                    "isQuestion": True
+                })
+            
+            # Generate enhanced prompt
+            enhanced_prompt = self.prompt_manager.generate_prompt(conversation)
+            
+            logger.info(f"Generated enhanced prompt: {enhanced_prompt[:100]}...")
+            
+            # Save the answer; the turn marks the questionnaire complete once
+            # the reply has been generated
+            self.conversation_manager.save_conversation(conversation)
+            
+            return ChatTurn(
+                conversation,
+                prefix=persona_registry.get_prefix(persona_id),
+                prompt=enhanced_prompt,
+                user_message=conversation.original_message or message,
+                extra={"enhancedPrompt": enhanced_prompt},  # Optional, for transparency
+                # The user has answered every question; don't let bulk chat starve this turn
+                priority=PRIORITY_HIGH,
+                conversation_manager=self.conversation_manager
+            )
+        
+        # Normal chat flow
+        return ChatTurn(
+            conversation,
+            prefix=persona_registry.get_prefix(persona_id),
+            prompt=message,
+            user_message=message
+        )
@@ -0,0 +1,472 @@
+"""
+Opt-in response cache for LLM chat completions.
+"""
+
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from typing import Dict, List, Any, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CACHE_TTL = 3600
+DEFAULT_CACHE_MAX_BYTES = 64 * 1024 * 1024
+# Sampled replies are meant to vary, so only deterministic requests are cached
+DEFAULT_CACHE_MAX_TEMPERATURE = 0.0
+
+def request_fingerprint(*parts: Any) -> str:
+    """
+    Hash JSON-serializable request parts into a stable fingerprint.
+    
+    Args:
+        *parts: Values identifying the request
+        
+    Returns:
+        Hex digest of the canonical JSON encoding of the parts
+    """
+    material = json.dumps(list(parts), sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+    return hashlib.sha256(material.encode("utf-8")).hexdigest()
+
+class CacheBackend:
+    """
+    Storage interface for cached completions.
+    
+    Backends store opaque byte strings and are responsible for expiry and for
+    keeping their total size within bounds.
+    """
+    
+    def get(self, key: str) -> Optional[bytes]:
+        """
+        Get a value by key.
+        
+        Args:
+            key: Cache key
+            
+        Returns:
+            The stored value or None if missing or expired
+        """
+        raise NotImplementedError
+    
+    def set(self, key: str, value: bytes, ttl: float) -> None:
+        """
+        Store a value.
+        
+        Args:
+            key: Cache key
+            value: Value to store
+            ttl: Seconds until the value expires
+        """
+        raise NotImplementedError
+    
+    def clear(self) -> None:
+        """
+        Remove every entry.
+        """
+        raise NotImplementedError
+    
+    def stats(self) -> Dict[str, Any]:
+        """
+        Get backend statistics.
+        
+        Returns:
+            Dictionary of backend-specific counters
+        """
+        return {}
+
+
+class MemoryCacheBackend(CacheBackend):
+    """
+    In-process LRU cache bounded by the total size of its keys and values.
+    """
+    
+    def __init__(self, max_bytes: int = DEFAULT_CACHE_MAX_BYTES):
+        """
+        Initialize the in-memory backend.
+        
+        Args:
+            max_bytes: Upper bound for the summed size of keys and values
+        """
+        self.max_bytes = max_bytes
+        self._entries: "OrderedDict[str, Tuple[float, bytes]]" = OrderedDict()
+        self._size = 0
+        self._evictions = 0
+        self._lock = threading.Lock()
+    
+    def get(self, key: str) -> Optional[bytes]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            
+            expires_at, value = entry
+            if expires_at <= time.time():
+                self._remove(key)
+                return None
+            
+            self._entries.move_to_end(key)
+            return value
+    
+    def set(self, key: str, value: bytes, ttl: float) -> None:
+        size = len(key) + len(value)
+        if size > self.max_bytes:
+            return
+        
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            
+            self._entries[key] = (time.time() + ttl, value)
+            self._size += size
+            
+            # Evict least recently used entries until we fit again
+            while self._size > self.max_bytes:
+                oldest_key = next(iter(self._entries))
+                self._remove(oldest_key)
+                self._evictions += 1
+    
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+    
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "backend": "memory",
+                "entries": len(self._entries),
+                "bytes": self._size,
+                "maxBytes": self.max_bytes,
+                "evictions": self._evictions
+            }
+    
+    def _remove(self, key: str) -> None:
+        """Remove an entry and release its size. Caller must hold the lock."""
+        _, value = self._entries.pop(key)
+        self._size -= len(key) + len(value)
+
+
+class SQLiteCacheBackend(CacheBackend):
+    """
+    On-disk LRU cache in a SQLite file, shareable between worker processes.
+    """
+    
+    def __init__(self, path: str, max_bytes: int = DEFAULT_CACHE_MAX_BYTES):
+        """
+        Initialize the SQLite backend.
+        
+        Args:
+            path: Path of the SQLite database file
+            max_bytes: Upper bound for the summed size of cached values
+        """
+        self.path = path
+        self.max_bytes = max_bytes
+        self._evictions = 0
+        self._lock = threading.Lock()
+        
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        
+        self._conn: Optional[sqlite3.Connection] = None
+        self._conn_pid: Optional[int] = None
+        with self._lock:
+            conn = self.connection
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS completion_cache ("
+                "key TEXT PRIMARY KEY, value BLOB NOT NULL, size INTEGER NOT NULL, "
+                "expires_at REAL NOT NULL, accessed_at REAL NOT NULL)"
+            )
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS completion_cache_accessed ON completion_cache (accessed_at)"
+            )
+            conn.commit()
+    
+    @property
+    def connection(self) -> sqlite3.Connection:
+        """
+        Get this process's database connection, opening it on first use.
+        
+        Returns:
+            The SQLite connection
+        """
+        if self._conn is None or self._conn_pid != os.getpid():
+            conn = sqlite3.connect(self.path, check_same_thread=False, timeout=5)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn = conn
+            self._conn_pid = os.getpid()
+        return self._conn
+    
+    def get(self, key: str) -> Optional[bytes]:
+        now = time.time()
+        with self._lock:
+            conn = self.connection
+            row = conn.execute(
+                "SELECT value, expires_at FROM completion_cache WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                return None
+            
+            value, expires_at = row
+            if expires_at <= now:
+                conn.execute("DELETE FROM completion_cache WHERE key = ?", (key,))
+                conn.commit()
+                return None
+            
+            conn.execute("UPDATE completion_cache SET accessed_at = ? WHERE key = ?", (now, key))
+            conn.commit()
+            return bytes(value)
+    
+    def set(self, key: str, value: bytes, ttl: float) -> None:
+        if len(value) > self.max_bytes:
+            return
+        
+        now = time.time()
+        with self._lock:
+            conn = self.connection
+            conn.execute(
+                "INSERT OR REPLACE INTO completion_cache (key, value, size, expires_at, accessed_at) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (key, sqlite3.Binary(value), len(value), now + ttl, now)
+            )
+            conn.execute("DELETE FROM completion_cache WHERE expires_at <= ?", (now,))
+            self._evict()
+            conn.commit()
+    
+    def clear(self) -> None:
+        with self._lock:
+            conn = self.connection
+            conn.execute("DELETE FROM completion_cache")
+            conn.commit()
+    
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            entries, size = self.connection.execute(
+                "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM completion_cache"
+            ).fetchone()
+        return {
+            "backend": "sqlite",
+            "path": self.path,
+            "entries": entries,
+            "bytes": size,
+            "maxBytes": self.max_bytes,
+            "evictions": self._evictions
+        }
+    
+    def _evict(self) -> None:
+        """Drop least recently used rows until the size bound holds. Caller must hold the lock."""
+        conn = self.connection
+        total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM completion_cache").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        
+        rows = conn.execute("SELECT key, size FROM completion_cache ORDER BY accessed_at").fetchall()
+        victims = []
+        for key, size in rows:
+            if total <= self.max_bytes:
+                break
+            victims.append((key,))
+            total -= size
+        
+        conn.executemany("DELETE FROM completion_cache WHERE key = ?", victims)
+        self._evictions += len(victims)
+
+
+class RedisCacheBackend(CacheBackend):
+    """
+    Cache in a Redis-compatible server.
+    
+    Expiry uses native key TTLs. The size bound and LRU eviction are delegated
+    to the server, which should run with maxmemory and an allkeys-lru policy.
+    """
+    
+    def __init__(self, url: str = "redis://localhost:6379/0", prefix: str = "llm-cache:"):
+        """
+        Initialize the Redis backend.
+        
+        Args:
+            url: Redis connection URL
+            prefix: Prefix for every cache key
+        """
+        try:
+            import redis
+        except ImportError:
+            raise ImportError("The redis package is required for the Redis completion cache backend")
+        
+        self.url = url
+        self.prefix = prefix
+        self._client = redis.Redis.from_url(url)
+    
+    def get(self, key: str) -> Optional[bytes]:
+        return self._client.get(self.prefix + key)
+    
+    def set(self, key: str, value: bytes, ttl: float) -> None:
+        self._client.set(self.prefix + key, value, px=int(ttl * 1000))
+    
+    def clear(self) -> None:
+        for key in self._client.scan_iter(match=self.prefix + "*"):
+            self._client.delete(key)
+    
+    def stats(self) -> Dict[str, Any]:
+        return {"backend": "redis", "url": self.url}
+
+
+class CompletionCache:
+    """
+    Cache of chat completions keyed on the request that produced them.
+    """
+    
+    def __init__(
+        self,
+        backend: CacheBackend = None,
+        ttl: float = DEFAULT_CACHE_TTL,
+        max_temperature: Optional[float] = DEFAULT_CACHE_MAX_TEMPERATURE
+    ):
+        """
+        Initialize the completion cache.
+        
+        Args:
+            backend: Storage backend (in-process LRU if not provided)
+            ttl: Seconds a cached completion stays valid
+            max_temperature: Only cache requests at or below this temperature
+                (None caches every request)
+        """
+        self.backend = backend or MemoryCacheBackend()
+        self.ttl = ttl
+        self.max_temperature = max_temperature
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+    
+    def is_cacheable(self, temperature: float) -> bool:
+        """
+        Check whether requests at a temperature may be served from the cache.
+        
+        Args:
+            temperature: Temperature for generation
+            
+        Returns:
+            True if the request may be cached
+        """
+        return self.max_temperature is None or temperature <= self.max_temperature
+    
+    def make_key(
+        self,
+        messages: List[Dict[str, str]],
+        model: str,
+        temperature: float,
+        max_tokens: int
+    ) -> str:
+        """
+        Build the cache key for a completion request.
+        
+        Args:
+            messages: List of messages in the conversation
+            model: Model to use for generation
+            temperature: Temperature for generation
+            max_tokens: Maximum number of tokens to generate
+            
+        Returns:
+            Hex digest identifying the request
+        """
+        return request_fingerprint(messages, model, temperature, max_tokens)
+    
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        """
+        Get a cached completion.
+        
+        Args:
+            key: Key from make_key
+            
+        Returns:
+            The cached API response or None on a miss
+        """
+        try:
+            value = self.backend.get(key)
+        except Exception as e:
+            logger.warning(f"Completion cache lookup failed: {e}")
+            value = None
+        
+        with self._lock:
+            if value is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        
+        return json.loads(value)
+    
+    def set(self, key: str, response: Dict[str, Any]) -> None:
+        """
+        Cache a completion.
+        
+        Args:
+            key: Key from make_key
+            response: API response to cache
+        """
+        try:
+            self.backend.set(key, json.dumps(response).encode("utf-8"), self.ttl)
+        except Exception as e:
+            logger.warning(f"Completion cache store failed: {e}")
+    
+    def clear(self) -> None:
+        """
+        Remove every cached completion.
+        """
+        self.backend.clear()
+    
+    def stats(self) -> Dict[str, Any]:
+        """
+        Get hit/miss counters and backend statistics.
+        
+        Returns:
+            Dictionary of cache statistics
+        """
+        with self._lock:
+            hits, misses = self.hits, self.misses
+        
+        lookups = hits + misses
+        return {
+            "hits": hits,
+            "misses": misses,
+            "hitRate": hits / lookups if lookups else 0.0,
+            "ttl": self.ttl,
+            **self.backend.stats()
+        }
+
+
+def create_completion_cache_from_env() -> Optional[CompletionCache]:
+    """
+    Create a completion cache from LLM_CACHE_* environment variables.
+    
+    The cache is opt-in: nothing is cached unless LLM_CACHE_BACKEND is set to
+    "memory", "sqlite" or "redis".
+    
+    Returns:
+        The configured cache or None if caching is disabled
+    """
+    backend_name = os.environ.get("LLM_CACHE_BACKEND", "").lower()
+    if not backend_name or backend_name == "none":
+        return None
+    
+    max_bytes = int(os.environ.get("LLM_CACHE_MAX_BYTES", DEFAULT_CACHE_MAX_BYTES))
+    
+    if backend_name == "memory":
+        backend = MemoryCacheBackend(max_bytes=max_bytes)
+    elif backend_name == "sqlite":
+        default_path = os.path.join(os.path.dirname(__file__), "data", "completion_cache.sqlite3")
+        backend = SQLiteCacheBackend(os.environ.get("LLM_CACHE_PATH", default_path), max_bytes=max_bytes)
+    elif backend_name == "redis":
+        backend = RedisCacheBackend(os.environ.get("LLM_CACHE_REDIS_URL", "redis://localhost:6379/0"))
+    else:
+        logger.error(f"Unknown LLM_CACHE_BACKEND: {backend_name}; completion cache disabled")
+        return None
+    
+    return CompletionCache(
+        backend=backend,
+        ttl=float(os.environ.get("LLM_CACHE_TTL", DEFAULT_CACHE_TTL)),
+        max_temperature=float(os.environ.get("LLM_CACHE_MAX_TEMPERATURE", DEFAULT_CACHE_MAX_TEMPERATURE))
+    )
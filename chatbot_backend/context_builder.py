@@ -0,0 +1,225 @@
+"""
+Token-budgeted context assembly for multi-turn LLM requests.
+
+Only the system prompt and the most recent turns that fit the model's
+context window are sent upstream. Token counts are estimated once per
+message and kept as running totals on the conversation, so finding the
+oldest message that still fits is a binary search instead of a walk over
+the whole history.
+"""
+
+import os
+import logging
+import threading
+from bisect import bisect_left
+from typing import Dict, List, Any, Optional
+
+logger = logging.getLogger(__name__)
+
+# Rough token estimate: about four characters of English text per token
+CHARS_PER_TOKEN = 4
+# Tokens spent on role markers and separators around each message
+MESSAGE_OVERHEAD_TOKENS = 4
+
+# Context window of models without an entry in MODEL_CONTEXT_WINDOWS
+DEFAULT_CONTEXT_WINDOW = int(os.environ.get("LLM_CONTEXT_WINDOW", 4096))
+
+MODEL_CONTEXT_WINDOWS = {
+    "vicuna-13b": 2048,
+    "llama-2-13b": 4096,
+    "gpt-3.5-turbo": 16385,
+    "gpt-4": 8192,
+    "gpt-4o": 128000,
+    "gemini-1.5-flash": 1048576,
+    "gemini-1.5-pro": 2097152
+}
+
+def estimate_tokens(text: str) -> int:
+    """
+    Estimate the number of tokens in a text.
+    
+    Args:
+        text: The text
+        
+    Returns:
+        Estimated token count
+    """
+    return (len(text) + CHARS_PER_TOKEN - 1) // CHARS_PER_TOKEN
+
+def message_tokens(message: Any) -> int:
+    """
+    Get the token count of a message, estimating it on first use.
+    
+    Args:
+        message: A message with role and content attributes
+        
+    Returns:
+        Estimated token count including the per-message overhead
+    """
+    tokens = getattr(message, "token_count", None)
+    if tokens is None:
+        tokens = estimate_tokens(message.content) + MESSAGE_OVERHEAD_TOKENS
+        message.token_count = tokens
+    return tokens
+
+def context_token_budget(model: str, max_tokens: int = 0) -> int:
+    """
+    Get the number of prompt tokens available for a request.
+    
+    Args:
+        model: The model name
+        max_tokens: Tokens reserved for the completion
+        
+    Returns:
+        Size of the model's context window minus the completion reservation
+    """
+    window = MODEL_CONTEXT_WINDOWS.get(model, DEFAULT_CONTEXT_WINDOW)
+    return max(window - max_tokens, 0)
+
+class ContextWindow:
+    """
+    Messages selected for one LLM request.
+    """
+    
+    def __init__(self, messages: List[Dict[str, str]], tokens: int, trimmed_messages: int, trimmed_tokens: int):
+        """
+        Initialize a context window.
+        
+        Args:
+            messages: Messages in the format expected by the LLM API
+            tokens: Estimated tokens of the selected messages
+            trimmed_messages: Number of older messages left out
+            trimmed_tokens: Estimated tokens of the messages left out
+        """
+        self.messages = messages
+        self.tokens = tokens
+        self.trimmed_messages = trimmed_messages
+        self.trimmed_tokens = trimmed_tokens
+    
+    def to_dict(self) -> Dict[str, int]:
+        """
+        Get the window's size statistics.
+        
+        Returns:
+            Dictionary of token and message counts
+        """
+        return {
+            "tokens": self.tokens,
+            "messages": len(self.messages),
+            "trimmedMessages": self.trimmed_messages,
+            "trimmedTokens": self.trimmed_tokens
+        }
+
+class ContextBuilder:
+    """
+    Assembles the system prompt and the most recent turns within a token budget.
+    """
+    
+    def __init__(self, token_budget: Optional[int] = None):
+        """
+        Initialize the context builder.
+        
+        Args:
+            token_budget: Default budget for requests that do not specify one
+        """
+        self.token_budget = token_budget or DEFAULT_CONTEXT_WINDOW
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.trimmed_requests = 0
+        self.trimmed_tokens = 0
+    
+    def build(self, conversation: Any, system_prompt: Optional[str] = None, token_budget: Optional[int] = None) -> ContextWindow:
+        """
+        Select the messages to send for a conversation.
+        
+        The system prompt is always kept, as is the latest message even if it
+        alone exceeds the budget; older messages are dropped first.
+        
+        Args:
+            conversation: Conversation whose messages are sent
+            system_prompt: Optional system prompt placed before the history
+            token_budget: Maximum prompt tokens for this request
+            
+        Returns:
+            The selected context window
+        """
+        budget = token_budget or self.token_budget
+        messages = conversation.messages
+        totals = self._running_totals(conversation)
+        total = totals[-1] if totals else 0
+        
+        system_tokens = 0
+        if system_prompt:
+            system_tokens = estimate_tokens(system_prompt) + MESSAGE_OVERHEAD_TOKENS
+        available = budget - system_tokens
+        
+        # First message whose suffix of the history fits the available tokens
+        start = 0
+        if messages and total > available:
+            start = min(bisect_left(totals, total - available) + 1, len(messages) - 1)
+            # Do not open the context with a reply whose question was trimmed
+            while start < len(messages) - 1 and messages[start].role == "assistant":
+                start += 1
+        
+        trimmed_tokens = totals[start - 1] if start > 0 else 0
+        
+        context = []
+        if system_prompt:
+            context.append({"role": "system", "content": system_prompt})
+        context.extend({"role": message.role, "content": message.content} for message in messages[start:])
+        
+        window = ContextWindow(
+            messages=context,
+            tokens=system_tokens + total - trimmed_tokens,
+            trimmed_messages=start,
+            trimmed_tokens=trimmed_tokens
+        )
+        
+        with self._lock:
+            self.requests += 1
+            if start:
+                self.trimmed_requests += 1
+                self.trimmed_tokens += trimmed_tokens
+        
+        return window
+    
+    def stats(self) -> Dict[str, int]:
+        """
+        Get trimming counters.
+        
+        Returns:
+            Number of requests built and trimmed, and the total tokens trimmed
+        """
+        with self._lock:
+            return {
+                "requests": self.requests,
+                "trimmedRequests": self.trimmed_requests,
+                "trimmedTokens": self.trimmed_tokens
+            }
+    
+    def _running_totals(self, conversation: Any) -> List[int]:
+        """
+        Extend the conversation's cumulative token counts to its latest message.
+        
+        Runs under the lock, so concurrent builds for the same conversation
+        do not both append the same counts; usually only the one or two
+        messages of the last turn are new.
+        """
+        with self._lock:
+            messages = conversation.messages
+            totals = getattr(conversation, "token_totals", None)
+            if totals is None or len(totals) > len(messages):
+                # Messages were replaced rather than appended; start over
+                totals = []
+                conversation.token_totals = totals
+            
+            running = totals[-1] if totals else 0
+            for message in messages[len(totals):]:
+                running += message_tokens(message)
+                totals.append(running)
+            
+            return totals
+
+
+# Shared builder for request handlers
+context_builder = ContextBuilder()
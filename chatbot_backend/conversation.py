@@ -2,27 +2,76 @@
 Conversation model for the chatbot backend.
 """
 
+import os
+import sys
+import time
 import uuid
-from typing import Dict, List, Any, Optional
+import logging
+import threading
+from itertools import islice
+from collections import OrderedDict
+from typing import Callable, Dict, List, Any, Optional, Union
 from datetime import datetime
 
+from context_builder import ContextWindow, context_builder
+
+logger = logging.getLogger(__name__)
+
+# Bounds for the in-memory conversation store, overridable through the environment
+DEFAULT_MAX_CONVERSATIONS = int(os.environ.get("CONVERSATION_MAX_COUNT", 10000))
+DEFAULT_MAX_MESSAGE_BYTES = int(os.environ.get("CONVERSATION_MAX_BYTES", 256 * 1024 * 1024))
+DEFAULT_IDLE_TTL = float(os.environ.get("CONVERSATION_IDLE_TTL", 24 * 60 * 60))
+
 class Message:
     """
     Represents a message in a conversation.
+    
+    Messages are immutable and use __slots__, since a process can hold
+    millions of them: the role is interned and the timestamp is kept as
+    epoch seconds.
     """
     
-    def __init__(self, role: str, content: str, timestamp: Optional[datetime] = None):
+    __slots__ = ("_role", "_content", "_epoch", "token_count")
+    
+    def __init__(self, role: str, content: str, timestamp: Union[datetime, float, None] = None):
         """
         Initialize a message.
         
         Args:
             role: The role of the message sender (user or assistant)
             content: The content of the message
-            timestamp: The timestamp of the message
+            timestamp: The timestamp of the message, as a datetime or epoch seconds
         """
-        self.role = role
-        self.content = content
-        self.timestamp = timestamp or datetime.now()
+        self._role = sys.intern(role)
+        self._content = content
+        if timestamp is None:
+            self._epoch = time.time()
+        elif isinstance(timestamp, datetime):
+            self._epoch = timestamp.timestamp()
+        else:
+            self._epoch = float(timestamp)
+        # Estimated tokens, filled in by the context builder on first use
+        self.token_count: Optional[int] = None
+    
+    @property
+    def role(self) -> str:
+        """The role of the message sender."""
+        return self._role
+    
+    @property
+    def content(self) -> str:
+        """The content of the message."""
+        return self._content
+    
+    @property
+    def epoch(self) -> float:
+        """The timestamp of the message in seconds since the epoch."""
+        return self._epoch
+    
+    @property
+    def timestamp(self) -> datetime:
+        """The timestamp of the message."""
+        return datetime.fromtimestamp(self._epoch)
     
     def to_dict(self) -> Dict[str, Any]:
         """
@@ -32,8 +81,8 @@ class Message:
             Dictionary representation of the message
         """
         return {
-            "role": self.role,
-            "content": self.content,
+            "role": self._role,
+            "content": self._content,
             "timestamp": self.timestamp.isoformat()
         }
     
@@ -56,6 +105,19 @@ class Message:
         )
 
 
+def message_size(message: Message) -> int:
+    """
+    Get the number of bytes a message contributes to the store's size bound.
+    
+    Args:
+        message: The message
+        
+    Returns:
+        UTF-8 size of the message content and role
+    """
+    return len(message.content.encode("utf-8")) + len(message.role)
+
+
 class Conversation:
     """
     Represents a conversation between a user and the chatbot.
@@ -71,11 +133,32 @@ class Conversation:
         """
         self.id = id or str(uuid.uuid4())
         self.user_id = user_id
-        self.messages: List[Message] = []
+        self._messages: List[Message] = []
+        # Dictionary forms of the messages, dropped when a message is added
+        self._message_dicts: Optional[List[Dict[str, Any]]] = None
         self.created_at = datetime.now()
         self.updated_at = self.created_at
         self.questionnaire: Optional[Dict[str, Any]] = None
         self.original_message: Optional[str] = None
+        self.message_bytes = 0
+        self.on_message_added: Optional[Callable[['Conversation', Message], None]] = None
+        # Version of this copy in the durable store (0 if never stored)
+        self.store_version = 0
+        # Running token totals of the messages, maintained by the context builder
+        self.token_totals: List[int] = []
+    
+    @property
+    def messages(self) -> List[Message]:
+        """The messages of the conversation, oldest first."""
+        return self._messages
+    
+    @messages.setter
+    def messages(self, messages: List[Message]) -> None:
+        """Replace the messages, dropping everything derived from the old ones."""
+        self._messages = messages
+        self._message_dicts = None
+        self.token_totals = []
+        self.message_bytes = sum(message_size(message) for message in messages)
     
     def add_message(self, role: str, content: str) -> Message:
         """
@@ -89,10 +172,42 @@ class Conversation:
             The added message
         """
         message = Message(role=role, content=content)
-        self.messages.append(message)
+        self._messages.append(message)
+        self._message_dicts = None
+        self.message_bytes += message_size(message)
         self.updated_at = datetime.now()
+        
+        if self.on_message_added:
+            self.on_message_added(self, message)
+        
         return message
     
+    def get_context_for_llm(self, system_prompt: Optional[str] = None, token_budget: Optional[int] = None) -> List[Dict[str, str]]:
+        """
+        Get the most recent messages that fit a token budget, in LLM API format.
+        
+        Args:
+            system_prompt: Optional system prompt placed before the history
+            token_budget: Maximum prompt tokens (the builder's default if None)
+            
+        Returns:
+            List of role/content messages, oldest first
+        """
+        return self.build_context(system_prompt, token_budget).messages
+    
+    def build_context(self, system_prompt: Optional[str] = None, token_budget: Optional[int] = None) -> ContextWindow:
+        """
+        Assemble the context window for the next LLM request.
+        
+        Args:
+            system_prompt: Optional system prompt placed before the history
+            token_budget: Maximum prompt tokens (the builder's default if None)
+            
+        Returns:
+            The context window, including how many tokens were trimmed
+        """
+        return context_builder.build(self, system_prompt=system_prompt, token_budget=token_budget)
+    
     def start_questionnaire(self, template_id: str, original_message: str) -> None:
         """
         Start a questionnaire for prompt enhancement.
@@ -126,13 +241,40 @@ class Conversation:
         return {
             "id": self.id,
             "userId": self.user_id,
-            "messages": [message.to_dict() for message in self.messages],
+            "messages": self._serialize_messages(),
             "createdAt": self.created_at.isoformat(),
             "updatedAt": self.updated_at.isoformat(),
             "questionnaire": self.questionnaire,
             "originalMessage": self.original_message
         }
     
+    def to_summary(self) -> Dict[str, Any]:
+        """
+        Convert the conversation to a summary without its messages.
+        
+        Returns:
+            Dictionary with the conversation's metadata
+        """
+        return {
+            "id": self.id,
+            "userId": self.user_id,
+            "messageCount": len(self.messages),
+            "createdAt": self.created_at.isoformat(),
+            "updatedAt": self.updated_at.isoformat(),
+            "questionnaire": self.questionnaire is not None and not self.questionnaire.get("complete", False)
+        }
+    
+    def _serialize_messages(self) -> List[Dict[str, Any]]:
+        """
+        Get the dictionary forms of the messages.
+        
+        They are reused by every read until the next message is added, and
+        shared between callers, so they must not be modified.
+        """
+        if self._message_dicts is None:
+            self._message_dicts = [message.to_dict() for message in self._messages]
+        return list(self._message_dicts)
+    
     @classmethod
     def from_dict(cls, data: Dict[str, Any]) -> 'Conversation':
         """
@@ -161,13 +303,51 @@ class Conversation:
 class ConversationManager:
     """
     Manages conversations for the chatbot.
+    
+    The store is bounded: once it holds more than max_conversations
+    conversations or max_message_bytes bytes of messages, the least recently
+    used conversations are evicted, and conversations idle for longer than
+    idle_ttl seconds expire. Evicted conversations are handed to on_evict so
+    they can be spilled to durable storage instead of being lost.
+    
+    With a store attached, every conversation and message is written through
+    to it, so the in-memory conversations act as a cache: misses and copies
+    made stale by another worker are reloaded from the store.
     """
     
-    def __init__(self):
+    def __init__(
+        self,
+        max_conversations: int = None,
+        max_message_bytes: int = None,
+        idle_ttl: float = None,
+        on_evict: Optional[Callable[[Conversation, str], None]] = None,
+        store: Optional[Any] = None
+    ):
         """
         Initialize the conversation manager.
+        
+        Args:
+            max_conversations: Maximum number of conversations kept in memory
+            max_message_bytes: Maximum total size of kept messages in bytes
+            idle_ttl: Seconds after the last access before a conversation expires
+            on_evict: Callback receiving each evicted conversation and the
+                reason ("capacity", "bytes" or "idle")
+            store: Durable ConversationStore shared with other workers
         """
-        self.conversations: Dict[str, Conversation] = {}
+        self.max_conversations = max_conversations or DEFAULT_MAX_CONVERSATIONS
+        self.max_message_bytes = max_message_bytes or DEFAULT_MAX_MESSAGE_BYTES
+        self.idle_ttl = idle_ttl or DEFAULT_IDLE_TTL
+        self.on_evict = on_evict
+        self.store = store
+        
+        # Least recently used conversations first
+        self.conversations: "OrderedDict[str, Conversation]" = OrderedDict()
+        self._last_access: Dict[str, float] = {}
+        # Per-user conversation IDs, least recently updated first
+        self._user_index: Dict[Optional[str], "OrderedDict[str, None]"] = {}
+        self._message_bytes = 0
+        self._evictions = {"capacity": 0, "bytes": 0, "idle": 0}
+        self._lock = threading.RLock()
     
     def get_conversation(self, conversation_id: str) -> Optional[Conversation]:
         """
@@ -179,7 +359,14 @@ class ConversationManager:
         Returns:
             The conversation or None if not found
         """
-        return self.conversations.get(conversation_id)
+        with self._lock:
+            evicted = self._expire_idle()
+            conversation = self._lookup(conversation_id)
+            if conversation:
+                evicted += self._enforce_limits(keep=conversation.id)
+        
+        self._notify_evicted(evicted)
+        return conversation
     
     def get_or_create_conversation(self, user_id: Optional[str] = None, conversation_id: Optional[str] = None) -> Conversation:
         """
@@ -192,24 +379,76 @@ class ConversationManager:
         Returns:
             The conversation
         """
-        if conversation_id and conversation_id in self.conversations:
-            return self.conversations[conversation_id]
+        with self._lock:
+            evicted = self._expire_idle()
+            
+            conversation = self._lookup(conversation_id) if conversation_id else None
+            if conversation is None:
+                conversation = Conversation(id=conversation_id, user_id=user_id)
+                if self.store:
+                    conversation.store_version = self.store.create(conversation)
+                self._add(conversation)
+            evicted += self._enforce_limits(keep=conversation.id)
         
-        conversation = Conversation(id=conversation_id, user_id=user_id)
-        self.conversations[conversation.id] = conversation
+        self._notify_evicted(evicted)
         return conversation
     
-    def get_user_conversations(self, user_id: str) -> List[Conversation]:
+    def get_user_conversations(self, user_id: str, limit: Optional[int] = None, offset: int = 0) -> List[Conversation]:
         """
-        Get all conversations for a user.
+        Get a user's conversations, most recently updated first.
+        
+        With a store attached the page is read from the store, so it includes
+        conversations evicted from or never loaded into this process.
         
         Args:
             user_id: The ID of the user
+            limit: Maximum number of conversations to return (all if None)
+            offset: Number of most recent conversations to skip
             
         Returns:
             List of conversations
         """
-        return [conversation for conversation in self.conversations.values() if conversation.user_id == user_id]
+        if self.store:
+            conversation_ids = self.store.list_user_conversation_ids(user_id, limit=limit, offset=offset)
+            with self._lock:
+                evicted = self._expire_idle()
+                conversations = []
+                for conversation_id in conversation_ids:
+                    # Deleted since the page was read if None
+                    conversation = self._lookup(conversation_id)
+                    if conversation:
+                        conversations.append(conversation)
+                if conversations:
+                    evicted += self._enforce_limits(keep=conversations[-1].id)
+            
+            self._notify_evicted(evicted)
+            return conversations
+        
+        with self._lock:
+            conversation_ids = self._user_index.get(user_id)
+            if not conversation_ids:
+                return []
+            
+            stop = None if limit is None else offset + limit
+            page = islice(reversed(conversation_ids), offset, stop)
+            return [self.conversations[conversation_id] for conversation_id in page]
+    
+    def count_user_conversations(self, user_id: str) -> int:
+        """
+        Count a user's conversations.
+        
+        Args:
+            user_id: The ID of the user
+            
+        Returns:
+            Number of conversations held for the user, or stored for them
+            if a store is attached
+        """
+        if self.store:
+            return self.store.count_user_conversations(user_id)
+        
+        with self._lock:
+            return len(self._user_index.get(user_id, ()))
     
     def delete_conversation(self, conversation_id: str) -> bool:
         """
@@ -221,10 +460,179 @@ class ConversationManager:
         Returns:
             True if the conversation was deleted, False otherwise
         """
-        if conversation_id in self.conversations:
-            del self.conversations[conversation_id]
-            return True
-        return False
+        with self._lock:
+            deleted = conversation_id in self.conversations
+            if deleted:
+                # A turn still holding it must not write it back to the store
+                self._remove(conversation_id).on_message_added = None
+        
+        if self.store:
+            deleted = self.store.delete(conversation_id) or deleted
+        return deleted
+    
+    def save_conversation(self, conversation: Conversation) -> None:
+        """
+        Write a conversation's questionnaire state through to the store.
+        
+        Messages are persisted as they are added; call this after changing
+        any other state of the conversation.
+        
+        Args:
+            conversation: The conversation to save
+        """
+        if self.store:
+            version = self.store.save_state(conversation)
+            if version == conversation.store_version + 1:
+                conversation.store_version = version
+    
+    def stats(self) -> Dict[str, Any]:
+        """
+        Get the current size of the store and its eviction counters.
+        
+        Returns:
+            Dictionary of store statistics
+        """
+        with self._lock:
+            stats = {
+                "conversations": len(self.conversations),
+                "messageBytes": self._message_bytes,
+                "maxConversations": self.max_conversations,
+                "maxMessageBytes": self.max_message_bytes,
+                "idleTtl": self.idle_ttl,
+                "evictions": dict(self._evictions)
+            }
+        
+        if self.store:
+            stats["store"] = self.store.stats()
+        return stats
+    
+    def _lookup(self, conversation_id: str) -> Optional[Conversation]:
+        """
+        Find a conversation in memory or in the store. Caller must hold the lock.
+        
+        A copy in memory is reloaded when another worker has changed the
+        stored conversation since it was loaded.
+        """
+        conversation = self.conversations.get(conversation_id)
+        if conversation and (not self.store or self.store.get_version(conversation_id) == conversation.store_version):
+            self._touch(conversation_id)
+            return conversation
+        
+        if not self.store:
+            return None
+        
+        stored = self.store.load(conversation_id)
+        if conversation:
+            self._remove(conversation_id)
+        if stored:
+            self._add(stored)
+        return stored
+    
+    def _add(self, conversation: Conversation) -> None:
+        """Start tracking a conversation. Caller must hold the lock."""
+        conversation.on_message_added = self._handle_message_added
+        self.conversations[conversation.id] = conversation
+        self._last_access[conversation.id] = time.monotonic()
+        self._message_bytes += conversation.message_bytes
+        self._index_user(conversation)
+    
+    def _remove(self, conversation_id: str) -> Conversation:
+        """
+        Stop tracking a conversation. Caller must hold the lock.
+        
+        The conversation keeps its message hook, so a turn that still holds
+        an evicted or reloaded copy writes its messages through to the store.
+        """
+        conversation = self.conversations.pop(conversation_id)
+        del self._last_access[conversation_id]
+        self._message_bytes -= conversation.message_bytes
+        
+        conversation_ids = self._user_index.get(conversation.user_id)
+        if conversation_ids is not None:
+            conversation_ids.pop(conversation_id, None)
+            if not conversation_ids:
+                del self._user_index[conversation.user_id]
+        
+        return conversation
+    
+    def _index_user(self, conversation: Conversation) -> None:
+        """Add a conversation to its user's updated_at order. Caller must hold the lock."""
+        conversation_ids = self._user_index.setdefault(conversation.user_id, OrderedDict())
+        
+        newest_id = next(reversed(conversation_ids), None)
+        conversation_ids[conversation.id] = None
+        
+        # Conversations restored with an older timestamp are rare; re-sort the
+        # user's entries instead of appending them out of order.
+        if newest_id is not None and self.conversations[newest_id].updated_at > conversation.updated_at:
+            ordered = sorted(conversation_ids, key=lambda cid: self.conversations[cid].updated_at)
+            self._user_index[conversation.user_id] = OrderedDict.fromkeys(ordered)
+    
+    def _touch(self, conversation_id: str) -> None:
+        """Mark a conversation as most recently used. Caller must hold the lock."""
+        self.conversations.move_to_end(conversation_id)
+        self._last_access[conversation_id] = time.monotonic()
+    
+    def _handle_message_added(self, conversation: Conversation, message: Message) -> None:
+        """Account for a new message and evict other conversations if needed."""
+        evicted = []
+        with self._lock:
+            if self.conversations.get(conversation.id) is conversation:
+                self._message_bytes += message_size(message)
+                self._touch(conversation.id)
+                self._user_index[conversation.user_id].move_to_end(conversation.id)
+                evicted = self._enforce_limits(keep=conversation.id)
+        
+        if self.store:
+            version = self.store.append_message(conversation, message)
+            # Leave the version stale if another worker wrote in between, so
+            # the next lookup reloads its messages too.
+            if version == conversation.store_version + 1:
+                conversation.store_version = version
+        
+        self._notify_evicted(evicted)
+    
+    def _expire_idle(self) -> List[tuple]:
+        """Evict conversations idle for longer than the TTL. Caller must hold the lock."""
+        evicted = []
+        deadline = time.monotonic() - self.idle_ttl
+        
+        # The least recently used conversation is always first in the order
+        while self.conversations:
+            oldest_id = next(iter(self.conversations))
+            if self._last_access[oldest_id] > deadline:
+                break
+            evicted.append((self._remove(oldest_id), "idle"))
+            self._evictions["idle"] += 1
+        
+        return evicted
+    
+    def _enforce_limits(self, keep: str) -> List[tuple]:
+        """Evict least recently used conversations until within bounds. Caller must hold the lock."""
+        evicted = []
+        
+        while len(self.conversations) > 1 and (
+            len(self.conversations) > self.max_conversations or self._message_bytes > self.max_message_bytes
+        ):
+            oldest_id = next(iter(self.conversations))
+            if oldest_id == keep:
+                break
+            reason = "capacity" if len(self.conversations) > self.max_conversations else "bytes"
+            evicted.append((self._remove(oldest_id), reason))
+            self._evictions[reason] += 1
+        
+        return evicted
+    
+    def _notify_evicted(self, evicted: List[tuple]) -> None:
+        """Hand evicted conversations to the eviction callback, outside the lock."""
+        if not self.on_evict:
+            return
+        
+        for conversation, reason in evicted:
+            try:
+                self.on_evict(conversation, reason)
+            except Exception as e:
+                logger.exception(f"Error in eviction callback for conversation {conversation.id}")
 
 
 # Initialize the conversation manager
@@ -0,0 +1,382 @@
+"""
+Durable conversation storage shared by every worker process.
+
+Conversations are stored in a SQLite database in WAL mode. Messages form an
+append-only log per conversation, so recording a message costs one small
+insert instead of rewriting the whole history; the conversation row holds
+the compacted mutable state (questionnaire progress, timestamps) and a
+version counter that lets workers detect each other's writes.
+"""
+
+import os
+import json
+import sqlite3
+import logging
+import threading
+from datetime import datetime
+from typing import Dict, List, Any, Optional
+
+from conversation import Conversation, Message
+
+logger = logging.getLogger(__name__)
+
+# Run a WAL checkpoint after this many appended messages
+DEFAULT_COMPACT_EVERY = int(os.environ.get("CONVERSATION_DB_COMPACT_EVERY", 1000))
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS conversations (
+    id TEXT PRIMARY KEY,
+    user_id TEXT,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL,
+    questionnaire TEXT,
+    original_message TEXT,
+    message_count INTEGER NOT NULL DEFAULT 0,
+    version INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS conversations_user ON conversations (user_id, updated_at);
+CREATE TABLE IF NOT EXISTS messages (
+    conversation_id TEXT NOT NULL,
+    seq INTEGER NOT NULL,
+    role TEXT NOT NULL,
+    content TEXT NOT NULL,
+    timestamp REAL NOT NULL,
+    PRIMARY KEY (conversation_id, seq)
+) WITHOUT ROWID;
+"""
+
+class ConversationStore:
+    """
+    SQLite-backed conversation store.
+    """
+    
+    def __init__(self, path: str, compact_every: int = None):
+        """
+        Initialize the store, creating the database if needed.
+        
+        Args:
+            path: Path of the SQLite database file
+            compact_every: Number of appended messages between WAL checkpoints
+        """
+        self.path = path
+        self.compact_every = compact_every or DEFAULT_COMPACT_EVERY
+        self._appends_since_compact = 0
+        self._conn: Optional[sqlite3.Connection] = None
+        self._conn_pid: Optional[int] = None
+        self._lock = threading.RLock()
+        
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with self._lock:
+            self.connection.executescript(SCHEMA)
+    
+    @property
+    def connection(self) -> sqlite3.Connection:
+        """
+        Get this process's database connection, opening it on first use.
+        
+        Returns:
+            The SQLite connection
+        """
+        if self._conn is None or self._conn_pid != os.getpid():
+            conn = sqlite3.connect(self.path, check_same_thread=False, timeout=10, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            # In WAL mode NORMAL only fsyncs at checkpoints, batching the
+            # cost of many appends while staying consistent after a crash.
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn = conn
+            self._conn_pid = os.getpid()
+        return self._conn
+    
+    def create(self, conversation: Conversation) -> int:
+        """
+        Persist a new conversation with its messages.
+        
+        Args:
+            conversation: The conversation to store
+            
+        Returns:
+            The stored version of the conversation
+        """
+        with self._lock:
+            conn = self.connection
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                conn.execute(
+                    "INSERT OR REPLACE INTO conversations "
+                    "(id, user_id, created_at, updated_at, questionnaire, original_message, message_count, version) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?, 1)",
+                    (
+                        conversation.id,
+                        conversation.user_id,
+                        conversation.created_at.timestamp(),
+                        conversation.updated_at.timestamp(),
+                        self._encode_questionnaire(conversation),
+                        conversation.original_message,
+                        len(conversation.messages)
+                    )
+                )
+                conn.execute("DELETE FROM messages WHERE conversation_id = ?", (conversation.id,))
+                conn.executemany(
+                    "INSERT INTO messages (conversation_id, seq, role, content, timestamp) VALUES (?, ?, ?, ?, ?)",
+                    [
+                        (conversation.id, seq, message.role, message.content, message.epoch)
+                        for seq, message in enumerate(conversation.messages)
+                    ]
+                )
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+        
+        return 1
+    
+    def append_message(self, conversation: Conversation, message: Message) -> int:
+        """
+        Append one message to a conversation's log.
+        
+        The cost is independent of the length of the conversation.
+        
+        Args:
+            conversation: The conversation the message belongs to
+            message: The new message
+            
+        Returns:
+            The stored version of the conversation after the append
+        """
+        with self._lock:
+            conn = self.connection
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = conn.execute(
+                    "SELECT message_count, version FROM conversations WHERE id = ?", (conversation.id,)
+                ).fetchone()
+                if row is None:
+                    conn.execute("ROLLBACK")
+                    return self.create(conversation)
+                
+                seq, version = row
+                conn.execute(
+                    "INSERT INTO messages (conversation_id, seq, role, content, timestamp) VALUES (?, ?, ?, ?, ?)",
+                    (conversation.id, seq, message.role, message.content, message.epoch)
+                )
+                conn.execute(
+                    "UPDATE conversations SET message_count = ?, updated_at = ?, version = ? WHERE id = ?",
+                    (seq + 1, conversation.updated_at.timestamp(), version + 1, conversation.id)
+                )
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+            
+            self._appends_since_compact += 1
+            if self._appends_since_compact >= self.compact_every:
+                self.compact()
+        
+        return version + 1
+    
+    def save_state(self, conversation: Conversation) -> int:
+        """
+        Persist a conversation's mutable state without touching its messages.
+        
+        Args:
+            conversation: The conversation to store
+            
+        Returns:
+            The stored version of the conversation
+        """
+        with self._lock:
+            conn = self.connection
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = conn.execute("SELECT version FROM conversations WHERE id = ?", (conversation.id,)).fetchone()
+                if row is None:
+                    conn.execute("ROLLBACK")
+                    return self.create(conversation)
+                
+                version = row[0] + 1
+                conn.execute(
+                    "UPDATE conversations SET questionnaire = ?, original_message = ?, updated_at = ?, version = ? "
+                    "WHERE id = ?",
+                    (
+                        self._encode_questionnaire(conversation),
+                        conversation.original_message,
+                        conversation.updated_at.timestamp(),
+                        version,
+                        conversation.id
+                    )
+                )
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+        
+        return version
+    
+    def get_version(self, conversation_id: str) -> Optional[int]:
+        """
+        Get the stored version of a conversation.
+        
+        Args:
+            conversation_id: The ID of the conversation
+            
+        Returns:
+            The version or None if the conversation is not stored
+        """
+        with self._lock:
+            row = self.connection.execute(
+                "SELECT version FROM conversations WHERE id = ?", (conversation_id,)
+            ).fetchone()
+        return row[0] if row else None
+    
+    def load(self, conversation_id: str) -> Optional[Conversation]:
+        """
+        Load a conversation with its full message log.
+        
+        Args:
+            conversation_id: The ID of the conversation
+            
+        Returns:
+            The conversation or None if not stored
+        """
+        with self._lock:
+            conn = self.connection
+            row = conn.execute(
+                "SELECT user_id, created_at, updated_at, questionnaire, original_message, version "
+                "FROM conversations WHERE id = ?",
+                (conversation_id,)
+            ).fetchone()
+            if row is None:
+                return None
+            
+            message_rows = conn.execute(
+                "SELECT role, content, timestamp FROM messages WHERE conversation_id = ? ORDER BY seq",
+                (conversation_id,)
+            ).fetchall()
+        
+        user_id, created_at, updated_at, questionnaire, original_message, version = row
+        
+        conversation = Conversation(id=conversation_id, user_id=user_id)
+        conversation.messages = [
+            Message(role=role, content=content, timestamp=timestamp)
+            for role, content, timestamp in message_rows
+        ]
+        conversation.created_at = datetime.fromtimestamp(created_at)
+        conversation.updated_at = datetime.fromtimestamp(updated_at)
+        conversation.questionnaire = json.loads(questionnaire) if questionnaire else None
+        conversation.original_message = original_message
+        conversation.store_version = version
+        
+        return conversation
+    
+    def list_user_conversation_ids(self, user_id: str, limit: Optional[int] = 20, offset: int = 0) -> List[str]:
+        """
+        List a user's stored conversation IDs, most recently updated first.
+        
+        Args:
+            user_id: The ID of the user
+            limit: Maximum number of IDs to return (all if None)
+            offset: Number of most recent conversations to skip
+            
+        Returns:
+            List of conversation IDs
+        """
+        with self._lock:
+            rows = self.connection.execute(
+                "SELECT id FROM conversations WHERE user_id = ? ORDER BY updated_at DESC LIMIT ? OFFSET ?",
+                (user_id, -1 if limit is None else limit, offset)
+            ).fetchall()
+        return [row[0] for row in rows]
+    
+    def count_user_conversations(self, user_id: str) -> int:
+        """
+        Count a user's stored conversations.
+        
+        Args:
+            user_id: The ID of the user
+            
+        Returns:
+            Number of conversations stored for the user
+        """
+        with self._lock:
+            row = self.connection.execute(
+                "SELECT COUNT(*) FROM conversations WHERE user_id = ?", (user_id,)
+            ).fetchone()
+        return row[0]
+    
+    def delete(self, conversation_id: str) -> bool:
+        """
+        Delete a conversation and its message log.
+        
+        Args:
+            conversation_id: The ID of the conversation
+            
+        Returns:
+            True if the conversation was stored, False otherwise
+        """
+        with self._lock:
+            conn = self.connection
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                cursor = conn.execute("DELETE FROM conversations WHERE id = ?", (conversation_id,))
+                conn.execute("DELETE FROM messages WHERE conversation_id = ?", (conversation_id,))
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+        
+        return cursor.rowcount > 0
+    
+    def compact(self) -> None:
+        """
+        Fold the write-ahead log back into the database file and truncate it.
+        """
+        with self._lock:
+            try:
+                self.connection.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+            except sqlite3.OperationalError as e:
+                # Another process holds a read transaction; retry next time
+                logger.warning(f"Conversation store checkpoint skipped: {e}")
+            self._appends_since_compact = 0
+    
+    def stats(self) -> Dict[str, Any]:
+        """
+        Get store statistics.
+        
+        Returns:
+            Number of stored conversations and messages
+        """
+        with self._lock:
+            conn = self.connection
+            conversations = conn.execute("SELECT COUNT(*) FROM conversations").fetchone()[0]
+            messages = conn.execute("SELECT COALESCE(SUM(message_count), 0) FROM conversations").fetchone()[0]
+        return {"path": self.path, "conversations": conversations, "messages": messages}
+    
+    def close(self) -> None:
+        """
+        Checkpoint and close the database connection.
+        """
+        with self._lock:
+            if self._conn is not None and self._conn_pid == os.getpid():
+                self.compact()
+                self._conn.close()
+            self._conn = None
+            self._conn_pid = None
+    
+    def _encode_questionnaire(self, conversation: Conversation) -> Optional[str]:
+        """Serialize the questionnaire state."""
+        if conversation.questionnaire is None:
+            return None
+        return json.dumps(conversation.questionnaire)
+
+
+def create_conversation_store_from_env() -> Optional[ConversationStore]:
+    """
+    Create a conversation store if CONVERSATION_DB_PATH is set.
+    
+    Returns:
+        The configured store or None for memory-only conversations
+    """
+    path = os.environ.get("CONVERSATION_DB_PATH")
+    if not path:
+        return None
+    return ConversationStore(path)
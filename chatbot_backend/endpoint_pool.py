@@ -0,0 +1,433 @@
+"""
+Routing of LLM requests across several gateway endpoints.
+
+Endpoints belong to a local tier (LLM_API_URLS) or a cloud tier
+(LLM_CLOUD_API_URLS). Each request goes to the healthy local endpoint with
+the fewest requests in flight, or with the lowest EWMA latency weighted by
+its requests in flight. The average is fed by completions and by the time
+streams take to produce their first content; an endpoint not measured yet
+is assumed to be as fast as the mean of its measured peers. Health is
+checked passively: an endpoint whose circuit breaker is open is skipped
+until the breaker lets a probe through. Requests spill over to the cloud
+tier when every local endpoint is unhealthy, or when the best one has too
+many requests in flight or has become too slow. Requests with forceCloud
+go to the cloud tier directly.
+"""
+
+import os
+import time
+import random
+import logging
+import threading
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterator, List, Optional, Set
+
+logger = logging.getLogger(__name__)
+
+LOCAL_TIER = "local"
+CLOUD_TIER = "cloud"
+
+LEAST_OUTSTANDING = "least_outstanding"
+EWMA = "ewma"
+STRATEGIES = (LEAST_OUTSTANDING, EWMA)
+
+DEFAULT_STRATEGY = LEAST_OUTSTANDING
+# Weight of the newest sample in the latency moving average
+DEFAULT_EWMA_ALPHA = 0.3
+# Spill over to the cloud tier above these; 0 disables the latency threshold
+DEFAULT_SPILL_OUTSTANDING = 8
+DEFAULT_SPILL_LATENCY = 0.0
+
+# Upper bounds in milliseconds of the latency histogram buckets
+HISTOGRAM_BOUNDS_MS = (10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000)
+
+class LatencyHistogram:
+    """
+    Cumulative count of latencies in fixed buckets.
+    """
+    
+    def __init__(self):
+        """
+        Initialize an empty histogram.
+        """
+        self.counts = [0] * (len(HISTOGRAM_BOUNDS_MS) + 1)
+        self.total = 0
+        self.sum_ms = 0.0
+    
+    def record(self, seconds: float) -> None:
+        """
+        Add a sample; callers hold the owning endpoint's lock.
+        
+        Args:
+            seconds: Latency of a successful request
+        """
+        ms = seconds * 1000
+        index = 0
+        while index < len(HISTOGRAM_BOUNDS_MS) and ms > HISTOGRAM_BOUNDS_MS[index]:
+            index += 1
+        self.counts[index] += 1
+        self.total += 1
+        self.sum_ms += ms
+    
+    def stats(self) -> Dict[str, Any]:
+        """
+        Get the histogram.
+        
+        Returns:
+            Sample count, mean and the count per bucket keyed by its upper bound
+        """
+        buckets = {f"le{bound}ms": count for bound, count in zip(HISTOGRAM_BOUNDS_MS, self.counts)}
+        buckets["inf"] = self.counts[-1]
+        return {
+            "count": self.total,
+            "meanMs": round(self.sum_ms / self.total, 1) if self.total else None,
+            "buckets": buckets
+        }
+
+class Endpoint:
+    """
+    Load and latency of one gateway endpoint.
+    """
+    
+    def __init__(self, url: str, tier: str, ewma_alpha: float = DEFAULT_EWMA_ALPHA):
+        """
+        Initialize an idle endpoint.
+        
+        Args:
+            url: Base URL of the endpoint
+            tier: LOCAL_TIER or CLOUD_TIER
+            ewma_alpha: Weight of the newest sample in the latency average
+        """
+        self.url = url
+        self.tier = tier
+        self.ewma_alpha = ewma_alpha
+        
+        self.outstanding = 0
+        # Seconds; None until the first completion finished
+        self.ewma: Optional[float] = None
+        self.requests = 0
+        self.failures = 0
+        self.histograms: Dict[str, LatencyHistogram] = {}
+        self._lock = threading.Lock()
+    
+    def start(self) -> float:
+        """
+        Count a request as in flight.
+        
+        Returns:
+            Start time of the request
+        """
+        with self._lock:
+            self.outstanding += 1
+            self.requests += 1
+        return time.monotonic()
+    
+    def finish(self, started: float, operation: Optional[str] = None) -> None:
+        """
+        Count a request as done.
+        
+        Args:
+            started: Value returned by start
+            operation: Kind of request if it succeeded, such as "chat" or
+                "stream"; None if it failed
+        """
+        elapsed = time.monotonic() - started
+        with self._lock:
+            self.outstanding -= 1
+            if operation is None:
+                self.failures += 1
+                return
+            
+            self.histograms.setdefault(operation, LatencyHistogram()).record(elapsed)
+            # Streams last as long as the generation; they feed the average
+            # through first_byte instead
+            if operation == "chat":
+                self._observe(elapsed)
+    
+    def release(self) -> None:
+        """
+        Count a request as done without judging the endpoint, such as one
+        that was cancelled.
+        """
+        with self._lock:
+            self.outstanding -= 1
+    
+    def first_byte(self, started: float) -> None:
+        """
+        Record how long a stream took to produce its first content.
+        
+        Args:
+            started: Value returned by start
+        """
+        elapsed = time.monotonic() - started
+        with self._lock:
+            self.histograms.setdefault("firstByte", LatencyHistogram()).record(elapsed)
+            self._observe(elapsed)
+    
+    def _observe(self, elapsed: float) -> None:
+        """Feed a latency sample into the moving average. Caller must hold the lock."""
+        if self.ewma is None:
+            self.ewma = elapsed
+        else:
+            self.ewma += self.ewma_alpha * (elapsed - self.ewma)
+    
+    def score(self, strategy: str, default_ewma: float = 1.0) -> float:
+        """
+        Get the routing cost of sending one more request here.
+        
+        Args:
+            strategy: LEAST_OUTSTANDING or EWMA
+            default_ewma: Latency assumed while the endpoint is not measured
+            
+        Returns:
+            Lower is better
+        """
+        if strategy == EWMA:
+            ewma = self.ewma if self.ewma is not None else default_ewma
+            return ewma * (self.outstanding + 1)
+        return self.outstanding
+    
+    def stats(self) -> Dict[str, Any]:
+        """
+        Get the endpoint's counters.
+        
+        Returns:
+            Tier, requests in flight, totals, EWMA latency and histograms
+        """
+        with self._lock:
+            return {
+                "tier": self.tier,
+                "outstanding": self.outstanding,
+                "requests": self.requests,
+                "failures": self.failures,
+                "ewmaMs": round(self.ewma * 1000, 1) if self.ewma is not None else None,
+                "latency": {operation: histogram.stats() for operation, histogram in self.histograms.items()}
+            }
+
+class EndpointPool:
+    """
+    Local and cloud gateway endpoints with load-aware selection.
+    """
+    
+    def __init__(
+        self,
+        urls: List[str],
+        cloud_urls: Optional[List[str]] = None,
+        strategy: str = None,
+        spill_outstanding: int = None,
+        spill_latency: float = None,
+        ewma_alpha: float = None
+    ):
+        """
+        Initialize the pool.
+        
+        Args:
+            urls: Base URLs of the local tier; at least one is required
+            cloud_urls: Base URLs of the cloud tier
+            strategy: LEAST_OUTSTANDING or EWMA
+            spill_outstanding: Requests in flight on the best local endpoint
+                at which further requests spill over to the cloud tier
+            spill_latency: EWMA latency in seconds of the best local endpoint
+                at which requests spill over; 0 disables the threshold
+            ewma_alpha: Weight of the newest sample in the latency averages
+            
+        Raises:
+            ValueError: If no local URL or an unknown strategy is given
+        """
+        if not urls:
+            raise ValueError("At least one LLM endpoint URL is required")
+        
+        self.strategy = strategy or DEFAULT_STRATEGY
+        if self.strategy not in STRATEGIES:
+            raise ValueError(f"Unknown routing strategy: {self.strategy}")
+        self.spill_outstanding = spill_outstanding or DEFAULT_SPILL_OUTSTANDING
+        self.spill_latency = DEFAULT_SPILL_LATENCY if spill_latency is None else spill_latency
+        
+        alpha = ewma_alpha or DEFAULT_EWMA_ALPHA
+        self.local = [Endpoint(url, LOCAL_TIER, alpha) for url in urls]
+        self.cloud = [Endpoint(url, CLOUD_TIER, alpha) for url in cloud_urls or [] if url not in urls]
+        self._endpoints = {endpoint.url: endpoint for endpoint in self.local + self.cloud}
+        self._lock = threading.Lock()
+        self.spilled = 0
+    
+    @property
+    def primary_url(self) -> str:
+        """Base URL of the first local endpoint."""
+        return self.local[0].url
+    
+    @property
+    def urls(self) -> List[str]:
+        """Base URLs of every endpoint, local tier first."""
+        return list(self._endpoints)
+    
+    def select(self, force_cloud: bool = False, exclude: Optional[Set[str]] = None, available: Optional[Callable[[str], bool]] = None) -> str:
+        """
+        Choose the endpoint for the next attempt of a request.
+        
+        Args:
+            force_cloud: Whether the request asked for the cloud model
+            exclude: URLs that already failed for this request; used only if
+                other endpoints remain
+            available: Passive health check, False for endpoints whose
+                circuit breaker is open
+                
+        Returns:
+            Base URL of the chosen endpoint
+        """
+        def candidates(endpoints: List[Endpoint]) -> List[Endpoint]:
+            healthy = [e for e in endpoints if available is None or available(e.url)]
+            fresh = [e for e in healthy if not exclude or e.url not in exclude]
+            return fresh or healthy
+        
+        cloud = candidates(self.cloud)
+        if force_cloud and cloud:
+            return self._best(cloud).url
+        
+        local = candidates(self.local)
+        if not local:
+            if cloud:
+                self._count_spill("no healthy local endpoint")
+                return self._best(cloud).url
+            # Everything is down; let the breaker of the first one reject the call
+            return self.primary_url
+        
+        best = self._best(local)
+        if cloud and self._overloaded(best):
+            self._count_spill(f"{best.url} is overloaded")
+            return self._best(cloud).url
+        return best.url
+    
+    def _best(self, endpoints: List[Endpoint]) -> Endpoint:
+        """Pick the lowest-scoring endpoint, breaking ties at random."""
+        # Unmeasured endpoints are assumed to be average rather than free, so
+        # that they are not sent every request until their first one returns;
+        # with nothing measured the scores follow the requests in flight
+        measured = [endpoint.ewma for endpoint in endpoints if endpoint.ewma is not None]
+        default_ewma = sum(measured) / len(measured) if measured else 1.0
+        scores = [(endpoint.score(self.strategy, default_ewma), endpoint) for endpoint in endpoints]
+        lowest = min(score for score, _ in scores)
+        return random.choice([endpoint for score, endpoint in scores if score == lowest])
+    
+    def _overloaded(self, endpoint: Endpoint) -> bool:
+        """Whether the best local endpoint is past a spill-over threshold."""
+        if endpoint.outstanding >= self.spill_outstanding:
+            return True
+        return bool(self.spill_latency) and endpoint.ewma is not None and endpoint.ewma >= self.spill_latency
+    
+    def _count_spill(self, reason: str) -> None:
+        """Record a request sent to the cloud tier by spill-over."""
+        with self._lock:
+            self.spilled += 1
+        logger.debug(f"Spilling over to the cloud tier: {reason}")
+    
+    def start(self, url: str) -> float:
+        """
+        Count a request to an endpoint as in flight.
+        
+        Args:
+            url: Base URL of the endpoint
+            
+        Returns:
+            Start time to pass to finish
+        """
+        return self._endpoints[url].start()
+    
+    def first_byte(self, url: str, started: float) -> None:
+        """
+        Feed a stream's time to first content into the endpoint's latency average.
+        
+        Args:
+            url: Base URL of the endpoint
+            started: Value returned by start
+        """
+        self._endpoints[url].first_byte(started)
+    
+    def finish(self, url: str, started: float, operation: Optional[str] = None) -> None:
+        """
+        Count a request to an endpoint as done.
+        
+        Args:
+            url: Base URL of the endpoint
+            started: Value returned by start
+            operation: Kind of request if it succeeded; None if it failed
+        """
+        self._endpoints[url].finish(started, operation)
+    
+    def release(self, url: str) -> None:
+        """
+        Count a request to an endpoint as done without a success or failure.
+        
+        Args:
+            url: Base URL of the endpoint
+        """
+        self._endpoints[url].release()
+    
+    @contextmanager
+    def track(self, url: str, operation: str = "chat") -> Iterator[None]:
+        """
+        Count a request as in flight for the duration of the block.
+        
+        The request counts as failed if the block raises an exception, and
+        as neither failed nor succeeded if it is cancelled.
+        
+        Args:
+            url: Base URL of the endpoint
+            operation: Kind of request, keying its latency histogram
+        """
+        started = self.start(url)
+        try:
+            yield
+        except Exception:
+            self.finish(url, started)
+            raise
+        except BaseException:
+            # Cancelled, for example the slower request of a hedged call
+            self.release(url)
+            raise
+        self.finish(url, started, operation)
+    
+    def stats(self) -> Dict[str, Any]:
+        """
+        Get routing statistics.
+        
+        Returns:
+            Strategy, requests spilled over to the cloud tier and per-endpoint
+            load, latency averages and histograms
+        """
+        with self._lock:
+            spilled = self.spilled
+        return {
+            "strategy": self.strategy,
+            "spilled": spilled,
+            "endpoints": {url: endpoint.stats() for url, endpoint in self._endpoints.items()}
+        }
+
+def parse_urls(value: Optional[str]) -> List[str]:
+    """
+    Split a comma-separated list of base URLs.
+    
+    Args:
+        value: Environment variable value
+        
+    Returns:
+        URLs without surrounding whitespace or trailing slashes
+    """
+    return [url.strip().rstrip("/") for url in (value or "").split(",") if url.strip()]
+
+def create_endpoint_pool_from_env(default_url: str) -> EndpointPool:
+    """
+    Create the endpoint pool from LLM_API_URLS, LLM_CLOUD_API_URLS, LLM_ROUTING and LLM_SPILL_* environment variables.
+    
+    Args:
+        default_url: Local endpoint used if LLM_API_URLS is not set
+        
+    Returns:
+        The configured pool
+    """
+    return EndpointPool(
+        urls=parse_urls(os.environ.get("LLM_API_URLS")) or [default_url],
+        cloud_urls=parse_urls(os.environ.get("LLM_CLOUD_API_URLS")),
+        strategy=os.environ.get("LLM_ROUTING", DEFAULT_STRATEGY).lower(),
+        spill_outstanding=int(os.environ.get("LLM_SPILL_OUTSTANDING", DEFAULT_SPILL_OUTSTANDING)),
+        spill_latency=float(os.environ.get("LLM_SPILL_LATENCY", DEFAULT_SPILL_LATENCY))
+    )
@@ -0,0 +1,126 @@
+"""
+Weighted keyword matching for routing messages to templates.
+
+All keywords of all targets are compiled into a single regular expression,
+so scoring a message is one scan over it regardless of how many targets and
+keywords are registered. The expression is a prefix trie rather than a flat
+alternation, so each position of the text is tried against one branch per
+character instead of against every keyword.
+"""
+
+import re
+from typing import Dict, Iterable, List, Optional, Tuple, Union
+
+# Keywords given as a list weigh 1 each; a mapping assigns explicit weights
+KeywordSpec = Union[Iterable[str], Dict[str, float]]
+
+# Regular inflections a keyword also matches with, such as "bugs" for "bug"
+INFLECTION_SUFFIX = r"(?:s|es|ed|ing)?"
+
+def trie_pattern(terms: Iterable[str]) -> str:
+    """
+    Build a regular expression matching any of the terms, longest first.
+    
+    Terms sharing a prefix share its branch, so the regex engine reads each
+    character once per position instead of once per term. At every branch
+    the longer continuations are tried before stopping at a shorter term.
+    
+    Args:
+        terms: Literal terms
+        
+    Returns:
+        Pattern source without anchors or boundaries
+    """
+    # Character -> subtree; the empty key marks the end of a term
+    root: Dict[str, dict] = {}
+    for term in terms:
+        node = root
+        for char in term:
+            node = node.setdefault(char, {})
+        node[""] = {}
+    
+    def build(node: Dict[str, dict]) -> str:
+        branches = [re.escape(char) + build(child) for char, child in sorted(node.items()) if char]
+        if not branches:
+            return ""
+        body = branches[0] if len(branches) == 1 else "(?:" + "|".join(branches) + ")"
+        if "" in node:
+            return f"(?:{body})?"
+        return body
+    
+    return build(root)
+
+class KeywordMatcher:
+    """
+    Scores text against the keywords of a set of targets.
+    
+    A keyword matches only as a whole word or phrase, so "api" does not
+    match inside "capital". A regular plural or verb ending after it
+    ("bugs", "errors", "posted", "testing") still counts as the keyword;
+    irregular forms such as "debugging" for "debug" need keywords of their
+    own. Each keyword counts once per text, however often it occurs. Where
+    keywords overlap, the longest one wins.
+    """
+    
+    def __init__(self, keywords: Dict[str, KeywordSpec]):
+        """
+        Compile the matcher.
+        
+        Args:
+            keywords: Keywords per target ID, as a list or a keyword-to-weight mapping
+        """
+        # Targets in registration order, used to break ties
+        self.targets: List[str] = list(keywords)
+        self._order: Dict[str, int] = {target_id: index for index, target_id in enumerate(self.targets)}
+        self._terms: Dict[str, List[Tuple[str, float]]] = {}
+        
+        for target_id, spec in keywords.items():
+            weights = spec if isinstance(spec, dict) else dict.fromkeys(spec, 1.0)
+            for keyword, weight in weights.items():
+                term = keyword.strip().lower()
+                if term:
+                    self._terms.setdefault(term, []).append((target_id, float(weight)))
+        
+        self._pattern: Optional[re.Pattern] = None
+        if self._terms:
+            self._pattern = re.compile(
+                rf"(?<!\w)(?P<term>{trie_pattern(self._terms)}){INFLECTION_SUFFIX}(?!\w)", re.IGNORECASE
+            )
+    
+    def scores(self, text: str) -> Dict[str, float]:
+        """
+        Score a text against every target.
+        
+        Args:
+            text: The text to score
+            
+        Returns:
+            Sum of the weights of the matched keywords per target with a match
+        """
+        if self._pattern is None:
+            return {}
+        
+        matched = {match.group("term").lower() for match in self._pattern.finditer(text)}
+        
+        scores: Dict[str, float] = {}
+        for term in matched:
+            for target_id, weight in self._terms.get(term, ()):
+                scores[target_id] = scores.get(target_id, 0.0) + weight
+        return scores
+    
+    def best_match(self, text: str, default: Optional[str] = None) -> Optional[str]:
+        """
+        Get the target with the highest positive score.
+        
+        Args:
+            text: The text to score
+            default: Target returned when no keyword matches
+            
+        Returns:
+            The best target ID, the earliest registered one on ties
+        """
+        # Only targets with a match are compared, however many are registered
+        scores = {target_id: score for target_id, score in self.scores(text).items() if score > 0}
+        if not scores:
+            return default
+        return max(scores, key=lambda target_id: (scores[target_id], -self._order[target_id]))
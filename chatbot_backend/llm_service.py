@@ -6,7 +6,37 @@ import os
 import requests
 import json
 import logging
-from typing import Dict, List, Any, Optional
+import threading
+from contextlib import ExitStack, nullcontext
+from typing import Callable, ContextManager, Dict, List, Any, Iterator, Optional, Set, Tuple
+
+from requests.adapters import HTTPAdapter
+
+from completion_cache import CompletionCache, create_completion_cache_from_env, request_fingerprint
+from singleflight import SingleFlight
+from resilience import (
+    EndpointSelector,
+    LLMUnavailableError,
+    Resilience,
+    UpstreamError,
+    create_resilience_from_env,
+    parse_retry_after,
+)
+from endpoint_pool import EndpointPool, create_endpoint_pool_from_env
+from admission import PRIORITY_NORMAL, AdmissionController, AdmissionRejected, create_admission_controller_from_env
+from request_prefix import (
+    PREFIX_CACHE_HEADER,
+    PREFIX_HIT,
+    PREFIX_MISS,
+    PREFIX_MISS_STATUS,
+    PREFIX_STORED,
+    PrefixCacheTracker,
+    RequestPrefix,
+    build_options,
+    create_prefix_cache_tracker_from_env,
+    prefix_id,
+    prefix_size,
+)
 
 # Configure logging
 logging.basicConfig(
@@ -15,21 +45,711 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-class LLMService:
+# Connection pool defaults, overridable through the environment
+DEFAULT_POOL_CONNECTIONS = int(os.environ.get("LLM_POOL_CONNECTIONS", 4))
+DEFAULT_POOL_MAXSIZE = int(os.environ.get("LLM_POOL_MAXSIZE", 10))
+DEFAULT_POOL_BLOCK = os.environ.get("LLM_POOL_BLOCK", "false").lower() in ("1", "true", "yes")
+DEFAULT_CONNECT_TIMEOUT = float(os.environ.get("LLM_CONNECT_TIMEOUT", 3.05))
+DEFAULT_READ_TIMEOUT = float(os.environ.get("LLM_READ_TIMEOUT", 30))
+DEFAULT_COALESCE = os.environ.get("LLM_COALESCE", "true").lower() in ("1", "true", "yes")
+# Answer with canned text instead of raising when the gateway is unavailable
+DEFAULT_MOCK_FALLBACK = os.environ.get("LLM_MOCK_FALLBACK", "false").lower() in ("1", "true", "yes")
+MODELS_READ_TIMEOUT = 10
+
+# Fallback texts returned to the user when no completion could be produced
+NO_RESPONSE_MESSAGE = "I apologize, but I'm having trouble generating a response right now. Please try again."
+ERROR_MESSAGE = "I apologize, but I encountered an error while processing your request. Please try again."
+
+JSON_HEADERS = {"Content-Type": "application/json"}
+
+# Marker for the end of a server-sent event stream
+STREAM_DONE = "[DONE]"
+
+
+class BaseLLMService:
     """
-    Service for interacting with language models.
+    Configuration and request/response handling shared by the LLM clients.
     """
     
-    def __init__(self, api_url: str = None, api_key: str = None):
+    def __init__(
+        self,
+        api_url: str = None,
+        api_key: str = None,
+        pool_connections: int = None,
+        pool_maxsize: int = None,
+        pool_block: bool = None,
+        connect_timeout: float = None,
+        read_timeout: float = None,
+        cache: Optional[CompletionCache] = None,
+        coalesce: bool = None,
+        prefix_cache: Optional[PrefixCacheTracker] = None,
+        resilience: Optional[Resilience] = None,
+        mock_fallback: bool = None,
+        endpoints: Optional[EndpointPool] = None,
+        admission: Optional[AdmissionController] = None
+    ):
         """
-        Initialize the LLM service.
+        Initialize the shared LLM service configuration.
         
         Args:
-            api_url: URL of the LLM API server
+            api_url: URL of the LLM API server; ignored if endpoints is given
             api_key: API key for authentication
+            pool_connections: Number of per-host connection pools to keep
+            pool_maxsize: Maximum number of kept-alive connections per host
+            pool_block: Whether to wait for a free connection instead of opening
+                an extra, non-pooled one when the pool is exhausted
+            connect_timeout: Seconds to wait for the TCP/TLS connection
+            read_timeout: Seconds to wait between bytes of the response
+            cache: Completion cache (configured from LLM_CACHE_* if not provided;
+                caching is off unless LLM_CACHE_BACKEND is set)
+            coalesce: Whether identical concurrent requests share one upstream call
+            prefix_cache: Record of the prefixes the gateway holds (configured
+                from LLM_PREFIX_CACHE* if not provided)
+            resilience: Retry, hedging and circuit breaker settings (configured
+                from LLM_RETRY_*, LLM_BREAKER_* and LLM_HEDGE* if not provided)
+            mock_fallback: Whether to answer with mock responses instead of
+                raising LLMUnavailableError when the gateway is unavailable
+            endpoints: Gateway endpoints to route requests across (configured
+                from LLM_API_URLS and LLM_CLOUD_API_URLS if neither this nor
+                api_url is provided)
+            admission: Concurrency limits and wait queue for upstream calls
+                (configured from LLM_MAX_CONCURRENCY, LLM_MAX_PER_USER and
+                LLM_ADMISSION_* if not provided)
         """
-        self.api_url = api_url or os.environ.get("LLM_API_URL", "http://localhost:3001/api")
+        if endpoints is None:
+            if api_url:
+                endpoints = EndpointPool([api_url])
+            else:
+                endpoints = create_endpoint_pool_from_env(os.environ.get("LLM_API_URL", "http://localhost:3001/api"))
+        self.endpoints = endpoints
+        self.api_url = endpoints.primary_url
         self.api_key = api_key or os.environ.get("LLM_API_KEY", "test-api-key")
+        # One connection pool per endpoint host, so that none of them gets evicted
+        self.pool_connections = pool_connections or max(DEFAULT_POOL_CONNECTIONS, len(endpoints.urls))
+        self.pool_maxsize = pool_maxsize or DEFAULT_POOL_MAXSIZE
+        self.pool_block = DEFAULT_POOL_BLOCK if pool_block is None else pool_block
+        self.connect_timeout = connect_timeout or DEFAULT_CONNECT_TIMEOUT
+        self.read_timeout = read_timeout or DEFAULT_READ_TIMEOUT
+        self.cache = cache if cache is not None else create_completion_cache_from_env()
+        self.coalesce = DEFAULT_COALESCE if coalesce is None else coalesce
+        self.prefix_cache = prefix_cache if prefix_cache is not None else create_prefix_cache_tracker_from_env()
+        self.resilience = resilience or create_resilience_from_env()
+        self.mock_fallback = DEFAULT_MOCK_FALLBACK if mock_fallback is None else mock_fallback
+        self.admission = admission if admission is not None else create_admission_controller_from_env()
+    
+    @property
+    def timeout(self) -> Tuple[float, float]:
+        """(connect, read) timeout used for chat completions."""
+        return (self.connect_timeout, self.read_timeout)
+    
+    def get_prefix_cache_stats(self) -> Optional[Dict[str, int]]:
+        """
+        Get upstream prefix cache statistics.
+        
+        Returns:
+            Prefix cache counters, or None if prefix caching is disabled
+        """
+        return self.prefix_cache.stats() if self.prefix_cache else None
+    
+    def get_resilience_stats(self) -> Dict[str, Any]:
+        """
+        Get retry, hedging and circuit breaker statistics.
+        
+        Returns:
+            Resilience counters and per-endpoint breaker state and latencies
+        """
+        return self.resilience.stats()
+    
+    def get_admission_stats(self) -> Optional[Dict[str, Any]]:
+        """
+        Get admission control statistics.
+        
+        Returns:
+            Slots in use, queue lengths and rejection counters, or None if
+            admission control is disabled
+        """
+        return self.admission.stats() if self.admission else None
+    
+    def get_endpoint_stats(self) -> Dict[str, Any]:
+        """
+        Get load balancing statistics.
+        
+        Returns:
+            Routing strategy, cloud spill-overs and per-endpoint load and
+            latency histograms
+        """
+        return self.endpoints.stats()
+    
+    def _route(self, force_cloud: bool) -> EndpointSelector:
+        """
+        Get the endpoint selector for a request.
+        
+        Args:
+            force_cloud: Whether the request asked for the cloud model
+            
+        Returns:
+            Selector choosing the endpoint for each attempt
+        """
+        def select(failed: Set[str]) -> str:
+            return self.endpoints.select(force_cloud, failed, self.resilience.is_available)
+        return select
+    
+    def _build_messages(self, system_instruction: str, message: str) -> List[Dict[str, str]]:
+        """
+        Build the messages for a single-turn exchange.
+        
+        Args:
+            system_instruction: System instruction for the AI
+            message: User message
+            
+        Returns:
+            List of messages for the chat completion
+        """
+        return [
+            {"role": "system", "content": system_instruction},
+            {"role": "user", "content": message}
+        ]
+    
+    def _cache_key(
+        self,
+        messages: List[Dict[str, str]],
+        model: str,
+        temperature: float,
+        max_tokens: int,
+        prefix: Optional[RequestPrefix] = None
+    ) -> Optional[str]:
+        """
+        Get the completion cache key for a request.
+        
+        Returns:
+            The cache key, or None if the request must not be cached
+        """
+        if self.cache is None or not self.cache.is_cacheable(temperature):
+            return None
+        if prefix is not None:
+            return prefix.fingerprint(messages[-1]["content"])
+        return self.cache.make_key(messages, model, temperature, max_tokens)
+    
+    def _fingerprint(
+        self,
+        messages: List[Dict[str, str]],
+        model: str,
+        temperature: float,
+        max_tokens: int,
+        force_cloud: bool,
+        stream: bool = False,
+        prefix: Optional[RequestPrefix] = None
+    ) -> str:
+        """
+        Get the fingerprint under which identical in-flight requests are coalesced.
+        
+        Returns:
+            Hex digest identifying the upstream request
+        """
+        if prefix is not None:
+            return prefix.fingerprint(messages[-1]["content"], stream)
+        return request_fingerprint(messages, model, temperature, max_tokens, force_cloud, stream)
+    
+    def _cache_completion(self, cache_key: Optional[str], response: Dict[str, Any]) -> None:
+        """
+        Store a successful upstream response in the completion cache.
+        
+        Args:
+            cache_key: Key from _cache_key, or None if the request is not cacheable
+            response: Response from the LLM API
+        """
+        if cache_key is None or "error" in response or not response.get("choices"):
+            return
+        self.cache.set(cache_key, response)
+    
+    def _cache_stream(self, cache_key: Optional[str], parts: List[str]) -> None:
+        """
+        Store a completed stream in the completion cache as a regular response.
+        
+        Args:
+            cache_key: Key from _cache_key, or None if the request is not cacheable
+            parts: Every delta of the finished stream
+        """
+        if cache_key is None or not parts:
+            return
+        self._cache_completion(cache_key, {
+            "choices": [{"message": {"role": "assistant", "content": "".join(parts)}}]
+        })
+    
+    def _build_payload(
+        self,
+        messages: List[Dict[str, str]],
+        model: str,
+        temperature: float,
+        max_tokens: int,
+        force_cloud: bool,
+        stream: bool = False
+    ) -> Dict[str, Any]:
+        """
+        Build the request body for the chat endpoint.
+        
+        Returns:
+            JSON-serializable request body
+        """
+        options = build_options(model, temperature, max_tokens, force_cloud, stream)
+        return {"messages": messages, "options": options}
+    
+    def _encode_body(
+        self,
+        messages: List[Dict[str, str]],
+        model: str,
+        temperature: float,
+        max_tokens: int,
+        force_cloud: bool,
+        stream: bool = False,
+        prefix: Optional[RequestPrefix] = None,
+        cached_prefix: Optional[Tuple[str, int]] = None,
+        referenced: bool = False
+    ) -> bytes:
+        """
+        Encode the request body for the chat endpoint.
+        
+        With a request prefix, only the user turn is encoded per request.
+        
+        Args:
+            cached_prefix: ID and message count of the prefix declared to the
+                gateway's prefix cache, if any
+            referenced: Whether to leave the prefix messages out of the body
+            
+        Returns:
+            UTF-8 encoded JSON request body
+        """
+        if prefix is not None:
+            if cached_prefix is None:
+                return prefix.body(messages[-1]["content"], stream)
+            return prefix.cached_body(messages[-1]["content"], stream, referenced)
+        
+        payload = self._build_payload(messages, model, temperature, max_tokens, force_cloud, stream)
+        if cached_prefix is not None:
+            cached_id, length = cached_prefix
+            payload = {
+                "prefix": {"id": cached_id, "messages": length, "included": not referenced},
+                "messages": messages[length:] if referenced else messages,
+                "options": payload["options"]
+            }
+        return json.dumps(payload).encode("utf-8")
+    
+    def _cached_prefix(
+        self,
+        messages: List[Dict[str, str]],
+        model: str,
+        temperature: float,
+        max_tokens: int,
+        force_cloud: bool,
+        prefix: Optional[RequestPrefix] = None
+    ) -> Optional[Tuple[str, int]]:
+        """
+        Identify the static leading messages of a request for the gateway's prefix cache.
+        
+        Returns:
+            ID and message count of the prefix, or None if the request is sent
+            without a prefix-cache declaration
+        """
+        if self.prefix_cache is None:
+            return None
+        if prefix is not None:
+            return prefix.digest, 1
+        
+        length = self.prefix_cache.prefix_length(messages)
+        if not length:
+            return None
+        return prefix_id(messages[:length], build_options(model, temperature, max_tokens, force_cloud)), length
+    
+    def _is_prefix_known(self, endpoint: str, cached_prefix: Optional[Tuple[str, int]]) -> bool:
+        """Whether the endpoint is known to hold the prefix, so it can be referenced."""
+        return cached_prefix is not None and self.prefix_cache.is_known(endpoint, cached_prefix[0])
+    
+    def _track_prefix(
+        self,
+        endpoint: str,
+        status_code: int,
+        headers: Any,
+        messages: List[Dict[str, str]],
+        prefix: Optional[RequestPrefix],
+        cached_prefix: Optional[Tuple[str, int]],
+        referenced: bool
+    ) -> bool:
+        """
+        Record the gateway's prefix-cache outcome for a request.
+        
+        Args:
+            endpoint: Base URL of the endpoint the request was sent to
+            status_code: HTTP status of the response
+            headers: Headers of the response
+            messages: Messages of the request
+            prefix: Request prefix the messages were built from, if any
+            cached_prefix: Value from _cached_prefix
+            referenced: Whether the body left the prefix messages out
+            
+        Returns:
+            True if the gateway no longer holds the referenced prefix and the
+            request has to be sent again in full
+        """
+        if cached_prefix is None:
+            return False
+        
+        cached_id, length = cached_prefix
+        outcome = headers.get(PREFIX_CACHE_HEADER, "")
+        
+        if referenced and (outcome == PREFIX_MISS or status_code == PREFIX_MISS_STATUS):
+            logger.info(f"Upstream prefix cache miss for {cached_id[:12]}, resending the full request")
+            self.prefix_cache.record_miss(endpoint, cached_id)
+            return True
+        
+        if outcome == PREFIX_HIT and referenced:
+            self.prefix_cache.record_hit(endpoint, cached_id)
+        elif outcome in (PREFIX_STORED, PREFIX_HIT):
+            size = prefix.size if prefix is not None else prefix_size(messages[:length])
+            self.prefix_cache.record_stored(endpoint, cached_id, size)
+        return False
+    
+    def _upstream_error(self, status_code: int, text: str, headers: Any) -> UpstreamError:
+        """
+        Describe an unsuccessful response from the gateway.
+        
+        Args:
+            status_code: HTTP status of the response
+            text: Body of the response
+            headers: Headers of the response
+            
+        Returns:
+            The error for the resilience layer
+        """
+        logger.error(f"Error from LLM API: {status_code} - {text[:500]}")
+        return UpstreamError(f"HTTP {status_code}", status_code, parse_retry_after(headers.get("Retry-After")))
+    
+    def _parse_completion(self, status_code: int, parse_json: Callable[[], Any]) -> Dict[str, Any]:
+        """
+        Parse the body of a successful response.
+        
+        Args:
+            status_code: HTTP status of the response
+            parse_json: Parses the body as JSON
+            
+        Returns:
+            Response from the LLM API
+        """
+        try:
+            return parse_json()
+        except ValueError as e:
+            raise UpstreamError(f"Invalid JSON from LLM API: {e}", status_code) from e
+    
+    def _parse_stream_line(self, line: Optional[str]) -> Optional[str]:
+        """
+        Parse one line of a server-sent event stream.
+        
+        Args:
+            line: A raw line from the upstream response
+            
+        Returns:
+            The text delta carried by the line, STREAM_DONE at the end of the
+            stream, or None for keep-alives, comments and non-content events
+        """
+        if not line or not line.startswith("data:"):
+            return None
+        
+        payload = line[len("data:"):].strip()
+        if payload == STREAM_DONE:
+            return STREAM_DONE
+        
+        try:
+            event = json.loads(payload)
+        except ValueError:
+            logger.warning(f"Ignoring malformed stream event: {payload[:100]}")
+            return None
+        
+        if "error" in event:
+            raise RuntimeError(f"LLM stream error: {event['error']}")
+        
+        choices = event.get("choices") or []
+        if not choices:
+            return None
+        
+        choice = choices[0]
+        delta = choice.get("delta") or choice.get("message") or {}
+        return delta.get("content")
+    
+    def _mock_stream(self, user_message: str) -> Iterator[str]:
+        """
+        Stream a mock response word by word for development/testing.
+        
+        Args:
+            user_message: The user's message
+            
+        Yields:
+            Pieces of the mock response
+        """
+        content = self.extract_assistant_message(self._mock_response(user_message)) or ""
+        words = content.split(" ")
+        for index, word in enumerate(words):
+            yield word if index == len(words) - 1 else word + " "
+    
+    def _mock_response(self, user_message: str) -> Dict[str, Any]:
+        """
+        Generate a mock response for development/testing.
+        
+        Args:
+            user_message: The user's message
+            
+        Returns:
+            Mock API response
+        """
+        mock_responses = [
+            "Thank you for your message. I understand you're asking about: {message}. This is a mock response for development purposes.",
+            "I appreciate your question regarding: {message}. I'm here to help with that topic.",
+            "That's an interesting point about: {message}. Let me provide some assistance with that.",
+            "I see you're interested in: {message}. I'd be happy to help you with that."
+        ]
+        
+        import random
+        response_template = random.choice(mock_responses)
+        response_content = response_template.format(message=user_message[:100])
+        
+        return {
+            "choices": [
+                {
+                    "message": {
+                        "content": response_content
+                    }
+                }
+            ]
+        }
+    
+    def extract_assistant_message(self, response: Dict[str, Any]) -> Optional[str]:
+        """
+        Extract the assistant's message from an LLM API response.
+        
+        Args:
+            response: Response from the LLM API
+            
+        Returns:
+            Assistant's message or None if not found
+        """
+        try:
+            if "error" in response:
+                return f"Error: {response['error']}"
+            
+            if "choices" in response and len(response["choices"]) > 0:
+                return response["choices"][0]["message"]["content"]
+            
+            return None
+        
+        except Exception as e:
+            logger.exception("Error extracting assistant message")
+            return None
+
+
+class LLMService(BaseLLMService):
+    """
+    Service for interacting with language models.
+    """
+    
+    def __init__(self, *args, **kwargs):
+        """
+        Initialize the LLM service.
+        
+        Args:
+            *args: Positional configuration, see BaseLLMService
+            **kwargs: Keyword configuration, see BaseLLMService
+        """
+        super().__init__(*args, **kwargs)
+        
+        self._inflight = SingleFlight()
+        self._session: Optional[requests.Session] = None
+        self._session_pid: Optional[int] = None
+        self._session_lock = threading.Lock()
+    
+    @property
+    def session(self) -> requests.Session:
+        """
+        Get the pooled keep-alive session, creating it on first use.
+        
+        The session is rebuilt after a fork so that pre-fork servers such as
+        gunicorn never share sockets between worker processes.
+        
+        Returns:
+            The HTTP session owned by this service
+        """
+        if self._session is None or self._session_pid != os.getpid():
+            with self._session_lock:
+                if self._session is None or self._session_pid != os.getpid():
+                    self._session = self._create_session()
+                    self._session_pid = os.getpid()
+        return self._session
+    
+    def _create_session(self) -> requests.Session:
+        """Create a session whose adapter keeps a bounded pool per host."""
+        session = requests.Session()
+        adapter = HTTPAdapter(
+            pool_connections=self.pool_connections,
+            pool_maxsize=self.pool_maxsize,
+            pool_block=self.pool_block
+        )
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        session.headers.update({
+            "Connection": "keep-alive",
+            "X-API-Key": self.api_key
+        })
+        return session
+    
+    def _admitted(self, user_id: Optional[str], priority: int) -> ContextManager[None]:
+        """Hold an admission slot, if admission control is enabled."""
+        if self.admission is None:
+            return nullcontext()
+        return self.admission.slot(user_id, priority)
+    
+    def _coalesced(self, key: str, user_id: Optional[str], priority: int, fn: Callable[[], Any]) -> Any:
+        """
+        Share fn with identical calls in flight, admitting each caller on its own.
+        
+        A caller that starts the shared call is admitted under its own user
+        and priority before it does; a caller that joins a call already
+        running needs no slot of its own. A rejection is only raised to the
+        caller it belongs to: one that ends up sharing the call of a rejected
+        leader tries again under its own admission.
+        
+        Args:
+            key: Fingerprint of the call
+            user_id: ID of the user, for per-user admission limits
+            priority: Admission priority class of the request
+            fn: The upstream call
+            
+        Returns:
+            The result of fn, possibly computed for another caller
+        """
+        while True:
+            joining = self._inflight.in_flight(key)
+            led = False
+            
+            def request() -> Any:
+                nonlocal led
+                led = True
+                if not joining:
+                    return fn()
+                # The call finished before this caller could join it
+                with self._admitted(user_id, priority):
+                    return fn()
+            
+            with nullcontext() if joining else self._admitted(user_id, priority):
+                try:
+                    return self._inflight.do(key, request)
+                except AdmissionRejected:
+                    if led:
+                        raise
+    
+    def _coalesced_stream(self, key: str, user_id: Optional[str], priority: int, fn: Callable[[], Iterator[str]]) -> Iterator[str]:
+        """
+        Share the stream of fn with identical streams in flight, admitting each consumer on its own.
+        
+        Works like _coalesced. The slot of the consumer that starts the
+        upstream stream moves to it, so it is held until upstream ends even
+        when the stream outlives that consumer for the others sharing it.
+        
+        Args:
+            key: Fingerprint of the stream
+            user_id: ID of the user, for per-user admission limits
+            priority: Admission priority class of the request
+            fn: Factory for the upstream stream
+            
+        Yields:
+            Every chunk of the shared stream
+        """
+        while True:
+            joining = self._inflight.in_flight(key)
+            led = False
+            produced = False
+            
+            with ExitStack() as slot:
+                if not joining:
+                    slot.enter_context(self._admitted(user_id, priority))
+                
+                def request() -> Iterator[str]:
+                    nonlocal led
+                    led = True
+                    with slot.pop_all() as held:
+                        if joining:
+                            # The stream finished before this consumer could join it
+                            held.enter_context(self._admitted(user_id, priority))
+                        yield from fn()
+                
+                try:
+                    for chunk in self._inflight.stream(key, request):
+                        produced = True
+                        yield chunk
+                    return
+                except AdmissionRejected:
+                    if led or produced:
+                        raise
+    
+    def get_coalescing_stats(self) -> Dict[str, int]:
+        """
+        Get single-flight deduplication statistics.
+        
+        Returns:
+            Number of requests in flight, upstream calls made and calls that
+            shared another caller's upstream call
+        """
+        return self._inflight.stats()
+    
+    def get_pool_stats(self) -> Dict[str, int]:
+        """
+        Get connection pool statistics aggregated over all upstream hosts.
+        
+        Returns:
+            Dictionary with the configured limits, the number of connections
+            in use and idle, and how many connections were newly opened versus
+            reused by requests so far
+        """
+        stats = {
+            "pool_connections": self.pool_connections,
+            "pool_maxsize": self.pool_maxsize,
+            "hosts": 0,
+            "in_use": 0,
+            "idle": 0,
+            "opened": 0,
+            "reused": 0,
+            "requests": 0
+        }
+        
+        if self._session is None or self._session_pid != os.getpid():
+            return stats
+        
+        adapter = self._session.get_adapter(self.api_url)
+        pools = adapter.poolmanager.pools
+        for key in list(pools.keys()):
+            pool = pools.get(key)
+            if pool is None:
+                continue
+            
+            stats["hosts"] += 1
+            stats["opened"] += pool.num_connections
+            stats["requests"] += pool.num_requests
+            stats["reused"] += max(pool.num_requests - pool.num_connections, 0)
+            
+            # The pool queue is pre-filled with placeholders; a checked-out
+            # connection leaves an empty slot behind.
+            queue = pool.pool
+            if queue is not None:
+                stats["in_use"] += queue.maxsize - queue.qsize()
+                stats["idle"] += sum(1 for conn in list(queue.queue) if conn is not None)
+        
+        return stats
+    
+    def close(self) -> None:
+        """
+        Close the session and every pooled connection.
+        """
+        with self._session_lock:
+            if self._session is not None:
+                self._session.close()
+            self._session = None
+            self._session_pid = None
     
     def generate_response(
         self,
@@ -37,7 +757,10 @@ class LLMService:
         message: str,
         model: str = "vicuna-13b",
         temperature: float = 0.7,
-        max_tokens: int = 1024
+        max_tokens: int = 1024,
+        prefix: Optional[RequestPrefix] = None,
+        user_id: Optional[str] = None,
+        priority: int = PRIORITY_NORMAL
     ) -> str:
         """
         Generate a response to a user message.
@@ -48,23 +771,31 @@ class LLMService:
             model: Model to use for generation
             temperature: Temperature for generation
             max_tokens: Maximum number of tokens to generate
+            prefix: Precomputed system message and model settings for the
+                request, used instead of system_instruction and the model arguments
+            user_id: ID of the user, for per-user admission limits
+            priority: Admission priority class of the request
             
         Returns:
             Generated response
+            
+        Raises:
+            AdmissionRejected: If the request was not admitted to call the LLM
+            LLMUnavailableError: If the gateway could not be reached
         """
         try:
             # Prepare messages for the chat completion
-            messages = [
-                {"role": "system", "content": system_instruction},
-                {"role": "user", "content": message}
-            ]
+            messages = prefix.messages(message) if prefix else self._build_messages(system_instruction, message)
             
             # Call the chat completion API
             response = self.chat_completion(
                 messages=messages,
                 model=model,
                 temperature=temperature,
-                max_tokens=max_tokens
+                max_tokens=max_tokens,
+                prefix=prefix,
+                user_id=user_id,
+                priority=priority
             )
             
             # Extract the assistant's message
@@ -74,11 +805,75 @@ class LLMService:
                 return assistant_message
             else:
                 logger.error(f"Failed to extract response from LLM: {response}")
-                return "I apologize, but I'm having trouble generating a response right now. Please try again."
+                return NO_RESPONSE_MESSAGE
+        
+        except (AdmissionRejected, LLMUnavailableError):
+            raise
         
         except Exception as e:
             logger.exception("Error generating response")
-            return "I apologize, but I encountered an error while processing your request. Please try again."
+            return ERROR_MESSAGE
+    
+    def generate_response_stream(
+        self,
+        system_instruction: str,
+        message: str,
+        model: str = "vicuna-13b",
+        temperature: float = 0.7,
+        max_tokens: int = 1024,
+        prefix: Optional[RequestPrefix] = None,
+        user_id: Optional[str] = None,
+        priority: int = PRIORITY_NORMAL
+    ) -> Iterator[str]:
+        """
+        Generate a response to a user message, yielding text deltas as they arrive.
+        
+        Args:
+            system_instruction: System instruction for the AI
+            message: User message
+            model: Model to use for generation
+            temperature: Temperature for generation
+            max_tokens: Maximum number of tokens to generate
+            prefix: Precomputed system message and model settings for the
+                request, used instead of system_instruction and the model arguments
+            user_id: ID of the user, for per-user admission limits
+            priority: Admission priority class of the request
+            
+        Yields:
+            Successive pieces of the generated response
+            
+        Raises:
+            AdmissionRejected: If the request was not admitted to call the LLM
+            LLMUnavailableError: If the gateway could not be reached
+        """
+        messages = prefix.messages(message) if prefix else self._build_messages(system_instruction, message)
+        
+        produced = False
+        try:
+            for delta in self.chat_completion_stream(
+                messages=messages,
+                model=model,
+                temperature=temperature,
+                max_tokens=max_tokens,
+                prefix=prefix,
+                user_id=user_id,
+                priority=priority
+            ):
+                produced = True
+                yield delta
+        
+        except (AdmissionRejected, LLMUnavailableError):
+            raise
+        
+        except Exception as e:
+            logger.exception("Error streaming response")
+            if not produced:
+                yield ERROR_MESSAGE
+            return
+        
+        if not produced:
+            logger.error("LLM stream finished without producing any content")
+            yield NO_RESPONSE_MESSAGE
     
     def chat_completion(
         self,
@@ -86,7 +881,10 @@ class LLMService:
         model: str = "vicuna-13b",
         temperature: float = 0.7,
         max_tokens: int = 1024,
-        force_cloud: bool = False
+        force_cloud: bool = False,
+        prefix: Optional[RequestPrefix] = None,
+        user_id: Optional[str] = None,
+        priority: int = PRIORITY_NORMAL
     ) -> Dict[str, Any]:
         """
         Generate a chat completion.
@@ -97,79 +895,253 @@ class LLMService:
             temperature: Temperature for generation
             max_tokens: Maximum number of tokens to generate
             force_cloud: Whether to force using the cloud model
+            prefix: Precomputed prefix the messages were built from; its model
+                settings override the arguments and its encoding is reused
+            user_id: ID of the user, for per-user admission limits
+            priority: Admission priority class of the request
             
         Returns:
             Response from the LLM API
         """
+        if prefix is not None:
+            model, temperature, max_tokens, force_cloud = prefix.model, prefix.temperature, prefix.max_tokens, prefix.force_cloud
+        
+        cache_key = self._cache_key(messages, model, temperature, max_tokens, prefix)
+        if cache_key is not None:
+            cached = self.cache.get(cache_key)
+            if cached is not None:
+                return cached
+        
+        def request() -> Dict[str, Any]:
+            return self._request_completion(messages, model, temperature, max_tokens, force_cloud, cache_key, prefix)
+        
+        if self.coalesce:
+            key = self._fingerprint(messages, model, temperature, max_tokens, force_cloud, prefix=prefix)
+            return self._coalesced(key, user_id, priority, request)
+        with self._admitted(user_id, priority):
+            return request()
+    
+    def _request_completion(
+        self,
+        messages: List[Dict[str, str]],
+        model: str,
+        temperature: float,
+        max_tokens: int,
+        force_cloud: bool,
+        cache_key: Optional[str],
+        prefix: Optional[RequestPrefix] = None
+    ) -> Dict[str, Any]:
+        """
+        Send a chat completion request upstream, with retries and hedging.
+        
+        Returns:
+            Response from the LLM API
+            
+        Raises:
+            LLMUnavailableError: If no completion could be obtained and mock
+                fallback is disabled
+        """
+        def attempt(endpoint: str) -> Dict[str, Any]:
+            with self.endpoints.track(endpoint):
+                try:
+                    response = self._post_chat(endpoint, messages, model, temperature, max_tokens, force_cloud, prefix=prefix)
+                except requests.exceptions.RequestException as e:
+                    raise UpstreamError(f"LLM API not available: {e}") from e
+                
+                if response.status_code != 200:
+                    raise self._upstream_error(response.status_code, response.text, response.headers)
+                return self._parse_completion(response.status_code, response.json)
+        
         try:
-            headers = {
-                "Content-Type": "application/json",
-                "X-API-Key": self.api_key
-            }
+            result = self.resilience.call(self._route(force_cloud), attempt, hedge=True)
+        except LLMUnavailableError as e:
+            if not self.mock_fallback:
+                raise
+            logger.warning(f"{e}; using mock response")
+            return self._mock_response(messages[-1]["content"])
+        
+        self._cache_completion(cache_key, result)
+        return result
+    
+    def _post_chat(
+        self,
+        endpoint: str,
+        messages: List[Dict[str, str]],
+        model: str,
+        temperature: float,
+        max_tokens: int,
+        force_cloud: bool,
+        stream: bool = False,
+        prefix: Optional[RequestPrefix] = None
+    ) -> requests.Response:
+        """
+        POST a chat request, referring to its prefix if the endpoint already holds it.
+        
+        If the endpoint no longer holds the prefix, the request is sent again
+        with the prefix included.
+        
+        Returns:
+            The response to the last request sent
+        """
+        cached_prefix = self._cached_prefix(messages, model, temperature, max_tokens, force_cloud, prefix)
+        referenced = self._is_prefix_known(endpoint, cached_prefix)
+        
+        while True:
+            body = self._encode_body(messages, model, temperature, max_tokens, force_cloud, stream, prefix, cached_prefix, referenced)
+            response = self.session.post(
+                f"{endpoint}/chat",
+                data=body,
+                headers=JSON_HEADERS,
+                timeout=self.timeout,
+                stream=stream
+            )
             
-            data = {
-                "messages": messages,
-                "options": {
-                    "model": model,
-                    "temperature": temperature,
-                    "maxTokens": max_tokens,
-                    "forceCloud": force_cloud
-                }
-            }
+            if not self._track_prefix(endpoint, response.status_code, response.headers, messages, prefix, cached_prefix, referenced):
+                return response
             
-            response = requests.post(
-                f"{self.api_url}/chat",
-                headers=headers,
-                json=data,
-                timeout=30  # Add timeout
-            )
+            response.close()
+            referenced = False
+    
+    def chat_completion_stream(
+        self,
+        messages: List[Dict[str, str]],
+        model: str = "vicuna-13b",
+        temperature: float = 0.7,
+        max_tokens: int = 1024,
+        force_cloud: bool = False,
+        prefix: Optional[RequestPrefix] = None,
+        user_id: Optional[str] = None,
+        priority: int = PRIORITY_NORMAL
+    ) -> Iterator[str]:
+        """
+        Generate a chat completion as a stream of text deltas.
+        
+        The upstream is asked to stream server-sent events. A gateway that
+        answers with a plain JSON completion instead is still supported; its
+        content is yielded as a single delta.
+        
+        Args:
+            messages: List of messages in the conversation
+            model: Model to use for generation
+            temperature: Temperature for generation
+            max_tokens: Maximum number of tokens to generate
+            force_cloud: Whether to force using the cloud model
+            prefix: Precomputed prefix the messages were built from; its model
+                settings override the arguments and its encoding is reused
+            user_id: ID of the user, for per-user admission limits
+            priority: Admission priority class of the request
             
-            if response.status_code == 200:
-                return response.json()
-            else:
-                logger.error(f"Error from LLM API: {response.status_code} - {response.text}")
-                # Return a mock response for development/testing
-                return self._mock_response(messages[-1]["content"])
+        Yields:
+            Successive pieces of the assistant's message
+        """
+        if prefix is not None:
+            model, temperature, max_tokens, force_cloud = prefix.model, prefix.temperature, prefix.max_tokens, prefix.force_cloud
         
-        except requests.exceptions.RequestException as e:
-            logger.warning(f"LLM API not available, using mock response: {e}")
-            # Return a mock response when the API is not available
-            return self._mock_response(messages[-1]["content"])
+        cache_key = self._cache_key(messages, model, temperature, max_tokens, prefix)
+        if cache_key is not None:
+            cached = self.cache.get(cache_key)
+            if cached is not None:
+                content = self.extract_assistant_message(cached)
+                if content:
+                    yield content
+                return
         
-        except Exception as e:
-            logger.exception("Error calling LLM API")
-            return self._mock_response(messages[-1]["content"])
+        def request() -> Iterator[str]:
+            return self._request_completion_stream(messages, model, temperature, max_tokens, force_cloud, cache_key, prefix)
+        
+        if self.coalesce:
+            key = self._fingerprint(messages, model, temperature, max_tokens, force_cloud, stream=True, prefix=prefix)
+            yield from self._coalesced_stream(key, user_id, priority, request)
+        else:
+            # The slot is held until the stream ends
+            with self._admitted(user_id, priority):
+                yield from request()
     
-    def _mock_response(self, user_message: str) -> Dict[str, Any]:
+    def _request_completion_stream(
+        self,
+        messages: List[Dict[str, str]],
+        model: str,
+        temperature: float,
+        max_tokens: int,
+        force_cloud: bool,
+        cache_key: Optional[str],
+        prefix: Optional[RequestPrefix] = None
+    ) -> Iterator[str]:
         """
-        Generate a mock response for development/testing.
+        Send a streamed chat completion request upstream.
         
-        Args:
-            user_message: The user's message
+        Opening the stream is retried; once the first bytes arrived, errors
+        are passed on to the caller.
+        
+        Yields:
+            Successive pieces of the assistant's message
             
-        Returns:
-            Mock API response
+        Raises:
+            LLMUnavailableError: If the stream could not be opened and mock
+                fallback is disabled
         """
-        mock_responses = [
-            "Thank you for your message. I understand you're asking about: {message}. This is a mock response for development purposes.",
-            "I appreciate your question regarding: {message}. I'm here to help with that topic.",
-            "That's an interesting point about: {message}. Let me provide some assistance with that.",
-            "I see you're interested in: {message}. I'd be happy to help you with that."
-        ]
+        def open_stream(endpoint: str) -> Tuple[str, float, requests.Response]:
+            # The request stays in flight on the endpoint until the stream ends
+            started = self.endpoints.start(endpoint)
+            opened = False
+            try:
+                try:
+                    response = self._post_chat(endpoint, messages, model, temperature, max_tokens, force_cloud, stream=True, prefix=prefix)
+                except requests.exceptions.RequestException as e:
+                    raise UpstreamError(f"LLM API not available: {e}") from e
+                
+                if response.status_code != 200:
+                    error = self._upstream_error(response.status_code, response.text, response.headers)
+                    response.close()
+                    raise error
+                opened = True
+                return endpoint, started, response
+            finally:
+                if not opened:
+                    self.endpoints.finish(endpoint, started)
         
-        import random
-        response_template = random.choice(mock_responses)
-        response_content = response_template.format(message=user_message[:100])
+        try:
+            endpoint, started, response = self.resilience.call(self._route(force_cloud), open_stream, operation="stream")
+        except LLMUnavailableError as e:
+            if not self.mock_fallback:
+                raise
+            logger.warning(f"{e}; using mock response")
+            yield from self._mock_stream(messages[-1]["content"])
+            return
         
-        return {
-            "choices": [
-                {
-                    "message": {
-                        "content": response_content
-                    }
-                }
-            ]
-        }
+        failed = True
+        try:
+            with response:
+                content_type = response.headers.get("Content-Type", "")
+                if "text/event-stream" not in content_type:
+                    result = self._parse_completion(response.status_code, response.json)
+                    self.endpoints.first_byte(endpoint, started)
+                    self._cache_completion(cache_key, result)
+                    failed = False
+                    content = self.extract_assistant_message(result)
+                    if content:
+                        yield content
+                    return
+                
+                parts = []
+                for line in response.iter_lines(decode_unicode=True):
+                    delta = self._parse_stream_line(line)
+                    if delta is STREAM_DONE:
+                        break
+                    if delta:
+                        if not parts:
+                            self.endpoints.first_byte(endpoint, started)
+                        parts.append(delta)
+                        yield delta
+                
+                self._cache_stream(cache_key, parts)
+                failed = False
+        except GeneratorExit:
+            # The caller stopped reading; not the endpoint's fault
+            failed = False
+            raise
+        finally:
+            self.endpoints.finish(endpoint, started, None if failed else "stream")
     
     def get_available_models(self) -> List[Dict[str, Any]]:
         """
@@ -179,14 +1151,9 @@ class LLMService:
             List of available models
         """
         try:
-            headers = {
-                "X-API-Key": self.api_key
-            }
-            
-            response = requests.get(
+            response = self.session.get(
                 f"{self.api_url}/models",
-                headers=headers,
-                timeout=10
+                timeout=(self.connect_timeout, MODELS_READ_TIMEOUT)
             )
             
             if response.status_code == 200:
@@ -198,27 +1165,3 @@ class LLMService:
         except Exception as e:
             logger.exception("Error getting models")
             return []
-    
-    def extract_assistant_message(self, response: Dict[str, Any]) -> Optional[str]:
-        """
-        Extract the assistant's message from an LLM API response.
-        
-        Args:
-            response: Response from the LLM API
-            
-        Returns:
-            Assistant's message or None if not found
-        """
-        try:
-            if "error" in response:
-                return f"Error: {response['error']}"
-            
-            if "choices" in response and len(response["choices"]) > 0:
-                return response["choices"][0]["message"]["content"]
-            
-            return None
-        
-        except Exception as e:
-            logger.exception("Error extracting assistant message")
-            return None
-
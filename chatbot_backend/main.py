@@ -2,22 +2,25 @@
 Enhanced main Flask application with prompt enhancement features.
 """
 
-from flask import Flask, request, jsonify, send_from_directory
+from flask import Flask, Response, request, jsonify, send_from_directory, stream_with_context
 from flask_cors import CORS
 import os
 import logging
 import sys
-import json
-from typing import Dict, Any, Optional
+import itertools
+from typing import Dict, Any, Iterator, Optional
 
 # Add the current directory to the path
 sys.path.insert(0, os.path.abspath(os.path.dirname(__file__)))
 
 # Import our modules
-from conversation import conversation_manager, Conversation
+from conversation import conversation_manager
+from conversation_store import create_conversation_store_from_env
 from prompt_manager import PromptManager
 from llm_service import LLMService
-from personas import get_persona_system_instruction
+from chat_flow import ChatFlow, ChatTurn, format_sse
+from admission import AdmissionRejected
+from resilience import LLMUnavailableError
 
 # Configure logging
 logging.basicConfig(
@@ -38,6 +41,8 @@ CORS(app)  # Enable CORS for all routes
 # Initialize services
 prompt_manager = PromptManager()
 llm_service = LLMService()
+conversation_manager.store = create_conversation_store_from_env()
+chat_flow = ChatFlow(conversation_manager, prompt_manager)
 
 # Request models
 class ChatRequest:
@@ -46,11 +51,73 @@ class ChatRequest:
         self.personaId = data.get('personaId', 'default')
         self.promptMode = data.get('promptMode', False)
         self.conversationId = data.get('conversationId')
+        self.stream = data.get('stream', False)
 
 def get_current_user_id() -> str:
     """Get the current user ID (placeholder for authentication)."""
     return "anonymous"
 
+def wants_stream(chat_request: ChatRequest) -> bool:
+    """Check whether the client asked for a streamed (SSE) response."""
+    return bool(chat_request.stream) or "text/event-stream" in request.headers.get("Accept", "")
+
+def admission_rejected_response(e: AdmissionRejected):
+    """Answer a request that was not admitted to call the LLM."""
+    logger.warning(f"Request not admitted: {e}")
+    return jsonify({"error": str(e), "retryAfter": int(e.retry_after_header)}), e.status, {"Retry-After": e.retry_after_header}
+
+def llm_unavailable_response(e: LLMUnavailableError):
+    """Answer a request whose reply could not be generated; the turn is not recorded."""
+    logger.error(f"LLM unavailable: {e}")
+    return jsonify({"error": "The assistant is temporarily unavailable", "retryAfter": int(e.retry_after_header)}), 503, {"Retry-After": e.retry_after_header}
+
+def stream_chat_response(turn: ChatTurn, user_id: str) -> Response:
+    """
+    Stream an LLM response to the client as server-sent events.
+    
+    The client receives a "start" event, one unnamed event per text delta and
+    a final "done" event carrying the full message. The turn is added to the
+    conversation once the upstream stream has finished. The first delta is
+    awaited before the response starts, so that a request that is not
+    admitted, or finds the gateway unavailable, still gets a plain error
+    status.
+    
+    Args:
+        turn: The chat turn to generate
+        user_id: ID of the user, for admission control
+        
+    Returns:
+        Streaming Flask response
+        
+    Raises:
+        AdmissionRejected: If the request was not admitted to call the LLM
+        LLMUnavailableError: If the gateway could not be reached
+    """
+    deltas = llm_service.generate_response_stream(
+        system_instruction=turn.system_instruction,
+        message=turn.prompt,
+        prefix=turn.prefix,
+        user_id=user_id,
+        priority=turn.priority
+    )
+    first = list(itertools.islice(deltas, 1))
+    
+    def generate() -> Iterator[str]:
+        yield format_sse(turn.start_event(), event="start")
+        
+        parts = []
+        for delta in itertools.chain(first, deltas):
+            parts.append(delta)
+            yield format_sse({"delta": delta})
+        
+        yield format_sse(turn.complete("".join(parts)), event="done")
+    
+    return Response(
+        stream_with_context(generate()),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
 @app.route('/api/chat', methods=['POST'])
 def handle_chat():
     """
@@ -67,95 +134,39 @@ def handle_chat():
         
         logger.info(f"Chat request: user={user_id}, persona={chat_request.personaId}, promptMode={chat_request.promptMode}")
         
-        # Get or create conversation
-        conversation = conversation_manager.get_or_create_conversation(
+        turn = chat_flow.prepare_turn(
             user_id=user_id,
+            message=chat_request.message,
+            persona_id=chat_request.personaId,
+            prompt_mode=chat_request.promptMode,
             conversation_id=chat_request.conversationId
         )
         
-        # Handle prompt mode initialization
-        if chat_request.promptMode and not conversation.questionnaire:
-            # Initialize questionnaire if not already in progress
-            template_id = prompt_manager.select_template(chat_request.message)
-            conversation.start_questionnaire(template_id, chat_request.message)
-            
-            logger.info(f"Started questionnaire with template: {template_id}")
-            
-            # Return first question
-            first_question = prompt_manager.get_current_question(conversation)
-            return jsonify({
-                "message": first_question,
-                "conversationId": conversation.id,
-                "promptMode": True,
-                "isQuestion": True,
-                "templateId": template_id
-            })
-        
-        # Handle questionnaire in progress
-        if conversation.questionnaire and not conversation.questionnaire.get("complete", False):
-            # Store answer to current question
-            prompt_manager.store_answer(conversation, chat_request.message)
-            
-            logger.info(f"Stored answer for question {conversation.questionnaire.get('currentQuestionIndex', 0)}")
-            
-            # Check if more questions
-            if prompt_manager.has_next_question(conversation):
-                # Return next question
-                next_question = prompt_manager.get_next_question(conversation)
-                return jsonify({
-                    "message": next_question,
-                    "conversationId": conversation.id,
-                    "promptMode": True,
-                    "isQuestion": True
-                })
-            else:
-                # Generate enhanced prompt
-                enhanced_prompt = prompt_manager.generate_prompt(conversation)
-                
-                logger.info(f"Generated enhanced prompt: {enhanced_prompt[:100]}...")
-                
-                # Generate response using enhanced prompt
-                system_instruction = get_persona_system_instruction(chat_request.personaId)
-                response = llm_service.generate_response(
-                    system_instruction=system_instruction,
-                    message=enhanced_prompt
-                )
-                
-                # Mark questionnaire as complete
-                conversation.complete_questionnaire()
-                
-                # Add messages to conversation history
-                conversation.add_message("user", conversation.original_message or chat_request.message)
-                conversation.add_message("assistant", response)
-                
-                return jsonify({
-                    "message": response,
-                    "conversationId": conversation.id,
-                    "promptMode": False,
-                    "isQuestion": False,
-                    "enhancedPrompt": enhanced_prompt  # Optional, for transparency
-                })
-        
-        # Normal chat flow
-        system_instruction = get_persona_system_instruction(chat_request.personaId)
-        response = llm_service.generate_response(
-            system_instruction=system_instruction,
-            message=chat_request.message
-        )
+        # Questionnaire turns are answered without the LLM
+        if not turn.needs_generation:
+            return jsonify(turn.reply)
         
-        # Add messages to conversation history
-        conversation.add_message("user", chat_request.message)
-        conversation.add_message("assistant", response)
+        if wants_stream(chat_request):
+            return stream_chat_response(turn, user_id)
         
-        logger.info(f"Generated normal response for user: {user_id}")
+        response = llm_service.generate_response(
+            system_instruction=turn.system_instruction,
+            message=turn.prompt,
+            prefix=turn.prefix,
+            user_id=user_id,
+            priority=turn.priority
+        )
         
-        return jsonify({
-            "message": response,
-            "conversationId": conversation.id,
-            "promptMode": False,
-            "isQuestion": False
-        })
+        logger.info(f"Generated response for user: {user_id}")
         
+        return jsonify(turn.complete(response))
+    
+    except AdmissionRejected as e:
+        return admission_rejected_response(e)
+    
+    except LLMUnavailableError as e:
+        return llm_unavailable_response(e)
+    
     except Exception as e:
         logger.exception("Error in chat endpoint")
         return jsonify({"error": "Internal server error"}), 500
@@ -172,6 +183,30 @@ def list_templates():
         logger.exception("Error listing templates")
         return jsonify({"error": "Internal server error"}), 500
 
+@app.route('/api/conversations', methods=['GET'])
+def list_conversations():
+    """
+    List the current user's conversations, most recently updated first.
+    """
+    try:
+        user_id = get_current_user_id()
+        limit = min(int(request.args.get('limit', 20)), 100)
+        offset = max(int(request.args.get('offset', 0)), 0)
+        
+        conversations = conversation_manager.get_user_conversations(user_id, limit=limit, offset=offset)
+        
+        return jsonify({
+            "conversations": [conversation.to_summary() for conversation in conversations],
+            "total": conversation_manager.count_user_conversations(user_id),
+            "limit": limit,
+            "offset": offset
+        })
+    except ValueError:
+        return jsonify({"error": "limit and offset must be integers"}), 400
+    except Exception as e:
+        logger.exception("Error listing conversations")
+        return jsonify({"error": "Internal server error"}), 500
+
 @app.route('/api/conversations/<conversation_id>', methods=['GET'])
 def get_conversation(conversation_id: str):
     """
@@ -200,12 +235,33 @@ def reset_conversation(conversation_id: str):
         # Reset questionnaire state
         conversation.questionnaire = None
         conversation.original_message = None
+        conversation_manager.save_conversation(conversation)
         
         return jsonify({"message": "Conversation reset successfully"})
     except Exception as e:
         logger.exception("Error resetting conversation")
         return jsonify({"error": "Internal server error"}), 500
 
+@app.route('/api/stats', methods=['GET'])
+def get_stats():
+    """
+    Get runtime statistics for capacity planning.
+    """
+    try:
+        return jsonify({
+            "llmPool": llm_service.get_pool_stats(),
+            "coalescing": llm_service.get_coalescing_stats(),
+            "completionCache": llm_service.cache.stats() if llm_service.cache else None,
+            "prefixCache": llm_service.get_prefix_cache_stats(),
+            "resilience": llm_service.get_resilience_stats(),
+            "endpoints": llm_service.get_endpoint_stats(),
+            "admission": llm_service.get_admission_stats(),
+            "conversations": conversation_manager.stats()
+        })
+    except Exception as e:
+        logger.exception("Error getting stats")
+        return jsonify({"error": "Internal server error"}), 500
+
 # Default route
 @app.route('/')
 def index():
@@ -215,8 +271,10 @@ def index():
         "endpoints": [
             "/api/chat",
             "/api/templates",
+            "/api/conversations",
             "/api/conversations/<id>",
-            "/api/conversations/<id>/reset"
+            "/api/conversations/<id>/reset",
+            "/api/stats"
         ]
     })
 
@@ -240,10 +298,12 @@ if __name__ == '__main__':
     
     print(f"Starting Chatbot Backend on port {port}")
     print("Available endpoints:")
-    print("  POST /api/chat - Main chat endpoint with prompt mode support")
+    print("  POST /api/chat - Main chat endpoint with prompt mode and streaming support")
     print("  GET /api/templates - List available questionnaire templates")
+    print("  GET /api/conversations - List the user's conversations")
     print("  GET /api/conversations/<id> - Get conversation details")
     print("  POST /api/conversations/<id>/reset - Reset conversation state")
+    print("  GET /api/stats - Runtime statistics")
     
     # Start server
     app.run(host='0.0.0.0', port=port, debug=True)
@@ -0,0 +1,449 @@
+"""
+Local stand-in for the LLM gateway, for development and measurements.
+
+Implements the endpoints the backend calls (POST /chat with JSON or
+server-sent event responses, GET /models) and the prefix-cache protocol
+described in request_prefix.py. Replies echo the user message. Latency is
+simulated as a fixed overhead plus a prefill cost per kilobyte of prompt
+the gateway had to receive, so prefix cache hits are measurably faster.
+Incidents can be simulated by failing a fraction of chat requests with 503
+and by delaying a fraction of them. A concurrency limit makes requests
+queue like on a gateway with a fixed number of model slots.
+GET /stats reports request, byte and prefix cache counters; DELETE
+/prefix-cache drops every stored prefix.
+
+Run from the chatbot_backend directory:
+
+    python mock_gateway.py
+
+and point the backend at it with LLM_API_URL=http://localhost:3001/api.
+"""
+
+import os
+import json
+import time
+import random
+import logging
+import threading
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Any, Optional, Tuple
+
+from request_prefix import (
+    PREFIX_CACHE_HEADER,
+    PREFIX_HIT,
+    PREFIX_MISS,
+    PREFIX_MISS_STATUS,
+    PREFIX_STORED,
+    prefix_size,
+)
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_HOST = os.environ.get("MOCK_GATEWAY_HOST", "127.0.0.1")
+DEFAULT_PORT = int(os.environ.get("MOCK_GATEWAY_PORT", 3001))
+DEFAULT_PREFIX_CACHE_SIZE = int(os.environ.get("MOCK_GATEWAY_PREFIX_CACHE_SIZE", 1024))
+# Seconds of overhead per request and of prefill per kilobyte of uncached prompt
+DEFAULT_BASE_LATENCY = float(os.environ.get("MOCK_GATEWAY_BASE_LATENCY", 0.005))
+DEFAULT_PREFILL_LATENCY = float(os.environ.get("MOCK_GATEWAY_PREFILL_LATENCY", 0.002))
+# Fractions of chat requests that fail with 503 or take SLOW_LATENCY longer
+DEFAULT_FAILURE_RATE = float(os.environ.get("MOCK_GATEWAY_FAILURE_RATE", 0.0))
+DEFAULT_SLOW_RATE = float(os.environ.get("MOCK_GATEWAY_SLOW_RATE", 0.0))
+DEFAULT_SLOW_LATENCY = float(os.environ.get("MOCK_GATEWAY_SLOW_LATENCY", 1.0))
+# Chat requests processed at once; 0 for no limit
+DEFAULT_CONCURRENCY = int(os.environ.get("MOCK_GATEWAY_CONCURRENCY", 0))
+
+MODELS = [
+    {"id": "vicuna-13b", "object": "model", "owned_by": "local"},
+    {"id": "cloud", "object": "model", "owned_by": "cloud"}
+]
+
+class PrefixStore:
+    """
+    Bounded LRU of the prefix messages stored by ID.
+    """
+    
+    def __init__(self, max_entries: int = None):
+        """
+        Initialize the store.
+        
+        Args:
+            max_entries: Most prefixes kept before the least recently used is evicted
+        """
+        self.max_entries = max_entries or DEFAULT_PREFIX_CACHE_SIZE
+        self._entries: "OrderedDict[str, Tuple[List[Dict[str, str]], int]]" = OrderedDict()
+        self._lock = threading.Lock()
+    
+    def get(self, prefix_id: str) -> Optional[Tuple[List[Dict[str, str]], int]]:
+        """
+        Get the messages of a prefix and their size in bytes.
+        
+        Args:
+            prefix_id: ID of the prefix
+            
+        Returns:
+            The messages and their size, or None if not stored
+        """
+        with self._lock:
+            entry = self._entries.get(prefix_id)
+            if entry is not None:
+                self._entries.move_to_end(prefix_id)
+            return entry
+    
+    def put(self, prefix_id: str, messages: List[Dict[str, str]]) -> None:
+        """
+        Store the messages of a prefix.
+        
+        Args:
+            prefix_id: ID of the prefix
+            messages: The prefix messages
+        """
+        with self._lock:
+            self._entries[prefix_id] = (messages, prefix_size(messages))
+            self._entries.move_to_end(prefix_id)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+    
+    def clear(self) -> None:
+        """
+        Remove every prefix.
+        """
+        with self._lock:
+            self._entries.clear()
+    
+    def __len__(self) -> int:
+        return len(self._entries)
+
+class MockGateway:
+    """
+    In-process HTTP server speaking the gateway's chat API.
+    """
+    
+    def __init__(
+        self,
+        host: str = None,
+        port: int = None,
+        prefix_cache: bool = True,
+        prefix_cache_size: int = None,
+        base_latency: float = None,
+        prefill_latency: float = None,
+        failure_rate: float = None,
+        slow_rate: float = None,
+        slow_latency: float = None,
+        concurrency: int = None
+    ):
+        """
+        Initialize the gateway without listening yet.
+        
+        Args:
+            host: Interface to listen on
+            port: Port to listen on; 0 picks a free port
+            prefix_cache: Whether to implement the prefix-cache protocol
+            prefix_cache_size: Most prefixes kept
+            base_latency: Seconds of overhead added to every chat request
+            prefill_latency: Seconds added per kilobyte of prompt received
+            failure_rate: Fraction of chat requests answered with 503
+            slow_rate: Fraction of chat requests delayed by slow_latency
+            slow_latency: Extra seconds taken by slow requests
+            concurrency: Chat requests processed at once, further ones wait;
+                0 for no limit
+        """
+        self.host = host or DEFAULT_HOST
+        self.port = DEFAULT_PORT if port is None else port
+        self.prefix_cache = prefix_cache
+        self.prefixes = PrefixStore(prefix_cache_size)
+        self.base_latency = DEFAULT_BASE_LATENCY if base_latency is None else base_latency
+        self.prefill_latency = DEFAULT_PREFILL_LATENCY if prefill_latency is None else prefill_latency
+        self.failure_rate = DEFAULT_FAILURE_RATE if failure_rate is None else failure_rate
+        self.slow_rate = DEFAULT_SLOW_RATE if slow_rate is None else slow_rate
+        self.slow_latency = DEFAULT_SLOW_LATENCY if slow_latency is None else slow_latency
+        self.concurrency = DEFAULT_CONCURRENCY if concurrency is None else concurrency
+        
+        self._slots = threading.BoundedSemaphore(self.concurrency) if self.concurrency else None
+        self._server: Optional[ThreadingHTTPServer] = None
+        self._thread: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+        self.reset_stats()
+    
+    @property
+    def url(self) -> str:
+        """Base URL of the API, as used for LLM_API_URL."""
+        return f"http://{self.host}:{self.port}/api"
+    
+    def start(self) -> "MockGateway":
+        """
+        Start serving on a background thread.
+        
+        Returns:
+            The gateway, for chaining
+        """
+        self._server = self._create_server()
+        self._thread = threading.Thread(target=self._server.serve_forever, name="mock-gateway", daemon=True)
+        self._thread.start()
+        return self
+    
+    def serve_forever(self) -> None:
+        """
+        Serve on the calling thread until interrupted.
+        """
+        self._server = self._create_server()
+        logger.info(f"Mock gateway listening on {self.url}")
+        try:
+            self._server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self._server.server_close()
+    
+    def stop(self) -> None:
+        """
+        Stop serving and close the listening socket.
+        """
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+    
+    def _create_server(self) -> ThreadingHTTPServer:
+        """Bind the server, recording the actual port if 0 was requested."""
+        # A subclass per server, so several gateways can run side by side
+        handler = type("Handler", (GatewayRequestHandler,), {"gateway": self})
+        server = ThreadingHTTPServer((self.host, self.port), handler)
+        server.daemon_threads = True
+        self.port = server.server_address[1]
+        return server
+    
+    def reset_stats(self) -> None:
+        """
+        Zero every counter.
+        """
+        with self._lock:
+            self.requests = 0
+            self.bytes_received = 0
+            self.prompt_bytes = 0
+            self.prefill_bytes = 0
+            self.prefix_stored = 0
+            self.prefix_hits = 0
+            self.prefix_misses = 0
+            self.prefix_bytes_saved = 0
+            self.failures = 0
+            self.slow = 0
+    
+    def stats(self) -> Dict[str, Any]:
+        """
+        Get request and prefix cache counters.
+        
+        Returns:
+            Chat requests served, injected failures and slow responses,
+            request body bytes received, prompt bytes in total and
+            prefilled without a cached prefix, and prefix cache counters
+        """
+        with self._lock:
+            return {
+                "requests": self.requests,
+                "failures": self.failures,
+                "slow": self.slow,
+                "bytesReceived": self.bytes_received,
+                "promptBytes": self.prompt_bytes,
+                "prefillBytes": self.prefill_bytes,
+                "prefixCache": {
+                    "enabled": self.prefix_cache,
+                    "entries": len(self.prefixes),
+                    "stored": self.prefix_stored,
+                    "hits": self.prefix_hits,
+                    "misses": self.prefix_misses,
+                    "bytesSaved": self.prefix_bytes_saved
+                }
+            }
+    
+    def resolve(self, body: Dict[str, Any], body_size: int) -> Tuple[Optional[List[Dict[str, str]]], str, int]:
+        """
+        Apply the prefix-cache declaration of a chat request.
+        
+        Args:
+            body: Parsed request body
+            body_size: Size of the request body in bytes
+            
+        Returns:
+            The full conversation (None on a miss), the X-Prefix-Cache
+            outcome (empty if the request declared no prefix) and the
+            number of prompt bytes not served from a stored prefix
+        """
+        messages = body.get("messages") or []
+        declared = body.get("prefix") if self.prefix_cache else None
+        
+        with self._lock:
+            self.requests += 1
+            self.bytes_received += body_size
+        
+        if not declared:
+            return messages, "", self._count_prompt(messages, cached_size=0)
+        
+        prefix_id = declared.get("id", "")
+        length = int(declared.get("messages", 0))
+        
+        if declared.get("included", True):
+            self.prefixes.put(prefix_id, messages[:length])
+            return messages, PREFIX_STORED, self._count_prompt(messages, cached_size=0, stored=True)
+        
+        entry = self.prefixes.get(prefix_id)
+        if entry is None or len(entry[0]) != length:
+            with self._lock:
+                self.prefix_misses += 1
+            return None, PREFIX_MISS, 0
+        
+        stored_messages, size = entry
+        messages = stored_messages + messages
+        return messages, PREFIX_HIT, self._count_prompt(messages, cached_size=size)
+    
+    def _count_prompt(self, messages: List[Dict[str, str]], cached_size: int, stored: bool = False) -> int:
+        """Count prompt bytes, of which cached_size came from a stored prefix, and return the rest."""
+        prompt_size = prefix_size(messages)
+        with self._lock:
+            self.prompt_bytes += prompt_size
+            self.prefill_bytes += prompt_size - cached_size
+            if stored:
+                self.prefix_stored += 1
+            if cached_size:
+                self.prefix_hits += 1
+                self.prefix_bytes_saved += cached_size
+        return prompt_size - cached_size
+    
+    def latency(self, prefill_size: int) -> float:
+        """
+        Get the simulated processing time of a request.
+        
+        Args:
+            prefill_size: Prompt bytes not served from a stored prefix
+            
+        Returns:
+            Seconds to wait before answering
+        """
+        latency = self.base_latency + self.prefill_latency * prefill_size / 1024
+        if self.slow_rate and random.random() < self.slow_rate:
+            with self._lock:
+                self.slow += 1
+            latency += self.slow_latency
+        return latency
+    
+    def process(self, seconds: float) -> None:
+        """
+        Simulate processing a request, waiting for a free slot first.
+        
+        Args:
+            seconds: Processing time once a slot is free
+        """
+        if self._slots is None:
+            time.sleep(seconds)
+            return
+        with self._slots:
+            time.sleep(seconds)
+    
+    def should_fail(self) -> bool:
+        """
+        Decide whether to fail a chat request.
+        
+        Returns:
+            True if the request is to be answered with 503
+        """
+        if not self.failure_rate or random.random() >= self.failure_rate:
+            return False
+        with self._lock:
+            self.failures += 1
+        return True
+
+class GatewayRequestHandler(BaseHTTPRequestHandler):
+    """
+    HTTP handler bound to a MockGateway through the class attribute.
+    """
+    
+    gateway: MockGateway = None
+    protocol_version = "HTTP/1.1"
+    
+    def log_message(self, format: str, *args: Any) -> None:
+        logger.debug(f"{self.address_string()} - {format % args}")
+    
+    def do_GET(self) -> None:
+        if self.path.rstrip("/") == "/api/models":
+            self._send_json(200, {"data": MODELS})
+        elif self.path.rstrip("/") == "/api/stats":
+            self._send_json(200, self.gateway.stats())
+        else:
+            self._send_json(404, {"error": "Not found"})
+    
+    def do_DELETE(self) -> None:
+        if self.path.rstrip("/") == "/api/prefix-cache":
+            self.gateway.prefixes.clear()
+            self._send_json(200, {"status": "cleared"})
+        else:
+            self._send_json(404, {"error": "Not found"})
+    
+    def do_POST(self) -> None:
+        if self.path.rstrip("/") != "/api/chat":
+            self._send_json(404, {"error": "Not found"})
+            return
+        
+        raw = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        try:
+            body = json.loads(raw)
+        except ValueError:
+            self._send_json(400, {"error": "Invalid JSON"})
+            return
+        
+        if self.gateway.should_fail():
+            self._send_json(503, {"error": "Simulated gateway failure"})
+            return
+        
+        messages, outcome, prefill_size = self.gateway.resolve(body, len(raw))
+        headers = {PREFIX_CACHE_HEADER: outcome} if outcome else {}
+        
+        if messages is None:
+            self._send_json(PREFIX_MISS_STATUS, {"error": "Prefix not cached"}, headers)
+            return
+        
+        self.gateway.process(self.gateway.latency(prefill_size))
+        
+        user_message = messages[-1].get("content", "") if messages else ""
+        content = f"Mock reply to: {user_message[:100]}"
+        
+        if (body.get("options") or {}).get("stream"):
+            self._send_stream(content, headers)
+        else:
+            self._send_json(200, {"choices": [{"message": {"role": "assistant", "content": content}}]}, headers)
+    
+    def _send_json(self, status: int, payload: Dict[str, Any], headers: Optional[Dict[str, str]] = None) -> None:
+        """Send a JSON response."""
+        data = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+    
+    def _send_stream(self, content: str, headers: Dict[str, str]) -> None:
+        """Send a reply as server-sent events, one word per event."""
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Cache-Control", "no-cache")
+        self.send_header("Connection", "close")
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        
+        words = content.split(" ")
+        for index, word in enumerate(words):
+            delta = word if index == len(words) - 1 else word + " "
+            event = {"choices": [{"delta": {"content": delta}}]}
+            self.wfile.write(f"data: {json.dumps(event)}\n\n".encode("utf-8"))
+        self.wfile.write(b"data: [DONE]\n\n")
+        self.wfile.flush()
+        self.close_connection = True
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    MockGateway().serve_forever()
@@ -5,7 +5,10 @@ from typing import Optional
 
 class ChatRequest(BaseModel):
     message: str
-    personaId: str # Matches the ID used in the frontend (e.g., 'synapse', 'tutor')
+    personaId: str = "default" # Matches the ID used in the frontend (e.g., 'synapse', 'tutor')
+    promptMode: bool = False
+    conversationId: Optional[str] = None
+    stream: bool = False
     # Add other fields if needed based on frontend, e.g., history
     # history: Optional[list[dict]] = None
 
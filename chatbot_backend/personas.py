@@ -1,7 +1,26 @@
 """
 Enhanced persona definitions with system instructions for the chatbot backend.
+
+Besides the built-in personas below, personas are loaded from JSON files in
+data/personas (one <persona-id>.json per persona) and reloaded when the
+files change.
 """
 
+import os
+import threading
+from typing import Dict, Any, List, Tuple
+
+from template_registry import JsonFileRegistry
+from request_prefix import RequestPrefix
+
+# Directory with additional personas
+PERSONAS_DIR = os.environ.get("PERSONAS_DIR", os.path.join(os.path.dirname(__file__), "data", "personas"))
+
+# Most persona and model combinations whose request prefix is kept
+MAX_CACHED_PREFIXES = 1024
+
+DEFAULT_SYSTEM_INSTRUCTION = "You are a helpful AI assistant."
+
 # Based on CHATBOT_PERSONAS in the frontend index.tsx
 PERSONAS = {
     "synapse": {
@@ -48,6 +67,105 @@ PERSONAS = {
     }
 }
 
+class PersonaRegistry:
+    """
+    Built-in and file-based personas, with their request prefixes cached.
+    """
+    
+    def __init__(self, personas_dir: str = None, poll_interval: float = None):
+        """
+        Initialize the registry without touching the personas directory.
+        
+        Args:
+            personas_dir: Directory with additional <persona-id>.json files
+            poll_interval: Seconds between checks of the directory for changes
+        """
+        self.files = JsonFileRegistry(personas_dir or PERSONAS_DIR, PERSONAS, poll_interval)
+        # (persona ID, model settings) -> (persona it was built from, prefix)
+        self._prefixes: Dict[Tuple, Tuple[Dict[str, Any], RequestPrefix]] = {}
+        self._lock = threading.Lock()
+    
+    def get(self, persona_id: str) -> Dict[str, Any]:
+        """
+        Get a persona, falling back to the default persona.
+        
+        Args:
+            persona_id: The ID of the persona
+        
+        Returns:
+            Dictionary containing persona information
+        """
+        personas = self.files.documents()
+        return personas.get(persona_id) or personas["default"]
+    
+    def list(self) -> List[Dict[str, Any]]:
+        """
+        List all available personas.
+        
+        Returns:
+            List of persona dictionaries
+        """
+        return list(self.files.documents().values())
+    
+    def get_system_instruction(self, persona_id: str) -> str:
+        """
+        Get the system instruction of a persona.
+        
+        Args:
+            persona_id: The ID of the persona
+        
+        Returns:
+            System instruction string for the persona
+        """
+        return self.get(persona_id).get("system_instruction", DEFAULT_SYSTEM_INSTRUCTION)
+    
+    def get_prefix(
+        self,
+        persona_id: str,
+        model: str = "vicuna-13b",
+        temperature: float = 0.7,
+        max_tokens: int = 1024,
+        force_cloud: bool = False
+    ) -> RequestPrefix:
+        """
+        Get the precomputed request prefix for a persona and model configuration.
+        
+        The prefix is built on first use and rebuilt when the persona's file
+        changes.
+        
+        Args:
+            persona_id: The ID of the persona
+            model: Model to use for generation
+            temperature: Temperature for generation
+            max_tokens: Maximum number of tokens to generate
+            force_cloud: Whether to force using the cloud model
+        
+        Returns:
+            The request prefix
+        """
+        persona = self.get(persona_id)
+        key = (persona.get("id", persona_id), model, temperature, max_tokens, force_cloud)
+        
+        cached = self._prefixes.get(key)
+        if cached and cached[0] is persona:
+            return cached[1]
+        
+        prefix = RequestPrefix(
+            persona.get("system_instruction", DEFAULT_SYSTEM_INSTRUCTION),
+            model=model,
+            temperature=temperature,
+            max_tokens=max_tokens,
+            force_cloud=force_cloud
+        )
+        with self._lock:
+            if len(self._prefixes) >= MAX_CACHED_PREFIXES:
+                self._prefixes.clear()
+            self._prefixes[key] = (persona, prefix)
+        return prefix
+
+# Shared registry; the personas directory is read on first use
+persona_registry = PersonaRegistry()
+
 def get_persona_system_instruction(persona_id: str) -> str:
     """
     Retrieves the system instruction for a given persona ID.
@@ -58,12 +176,8 @@ def get_persona_system_instruction(persona_id: str) -> str:
     Returns:
         System instruction string for the persona
     """
-    persona = PERSONAS.get(persona_id)
-    if persona:
-        return persona.get("system_instruction", "You are a helpful AI assistant.")
-    
-    # Default fallback if personaId doesn't match
-    return PERSONAS["default"]["system_instruction"]
+    # Falls back to the default persona if personaId doesn't match
+    return persona_registry.get_system_instruction(persona_id)
 
 def get_persona_info(persona_id: str) -> dict:
     """
@@ -75,7 +189,7 @@ def get_persona_info(persona_id: str) -> dict:
     Returns:
         Dictionary containing persona information
     """
-    return PERSONAS.get(persona_id, PERSONAS["default"])
+    return persona_registry.get(persona_id)
 
 def list_personas() -> list:
     """
@@ -84,7 +198,7 @@ def list_personas() -> list:
     Returns:
         List of persona dictionaries
     """
-    return list(PERSONAS.values())
+    return persona_registry.list()
 
 # Backward compatibility
 def get_system_instruction(persona_id: str) -> str:
@@ -2,17 +2,22 @@
 Enhanced prompt manager module for handling prompt enhancement through questionnaires.
 """
 
-import json
 import logging
 import os
 import re
 from typing import Dict, Any, List, Optional, Tuple
 
+from keyword_matcher import KeywordMatcher
+from template_registry import TemplateRegistry
+from semantic_selector import SemanticSelector
+
 logger = logging.getLogger(__name__)
 
 # Base directory for prompt templates
 TEMPLATES_DIR = os.path.join(os.path.dirname(__file__), "data", "templates")
-os.makedirs(TEMPLATES_DIR, exist_ok=True)
+
+# Fall back to embedding similarity when no template keyword matches (requires numpy)
+SEMANTIC_SELECTION = os.environ.get("PROMPT_SEMANTIC_SELECTION", "false").lower() in ("1", "true", "yes")
 
 # Default questionnaire templates based on the mobile app
 DEFAULT_TEMPLATES = {
@@ -21,6 +26,7 @@ DEFAULT_TEMPLATES = {
         "name": "Code Generation",
         "description": "Generate prompts for code generation, debugging, or refactoring tasks",
         "icon": "code",
+        "keywords": ["code", "program", "function", "bug", "error", "debug", "debugging", "algorithm", "python", "javascript", "java", "c++", "programming", "script", "api", "database"],
         "questions": [
             {
                 "id": "programming-language",
@@ -33,6 +39,7 @@ DEFAULT_TEMPLATES = {
                 "id": "framework",
                 "type": "text",
                 "label": "Framework/Library",
+                "format": " using {value}",
                 "placeholder": "e.g., React, Django, Spring",
                 "required": False,
             },
@@ -47,6 +54,7 @@ DEFAULT_TEMPLATES = {
                 "id": "requirements",
                 "type": "textarea",
                 "label": "Requirements",
+                "format": "\nRequirements:\n{value}\n",
                 "placeholder": "List any specific requirements or constraints",
                 "required": False,
             },
@@ -54,6 +62,7 @@ DEFAULT_TEMPLATES = {
                 "id": "input-output",
                 "type": "textarea",
                 "label": "Expected Input/Output",
+                "format": "\nInput Output:\n{value}\n",
                 "placeholder": "Describe the expected inputs and outputs",
                 "required": False,
             },
@@ -61,6 +70,7 @@ DEFAULT_TEMPLATES = {
                 "id": "code-style",
                 "type": "textarea",
                 "label": "Code Style Preferences",
+                "format": "\nCode Style:\n{value}\n",
                 "placeholder": "Any specific coding style or patterns you prefer",
                 "required": False,
             },
@@ -68,24 +78,27 @@ DEFAULT_TEMPLATES = {
                 "id": "include-tests",
                 "type": "checkbox",
                 "label": "Include unit tests",
+                "format": "\nPlease include unit tests.",
                 "defaultValue": True,
             },
             {
                 "id": "include-examples",
                 "type": "checkbox",
                 "label": "Include usage examples",
+                "format": "\nPlease include usage examples.",
                 "defaultValue": True,
             },
             {
                 "id": "additional-context",
                 "type": "textarea",
                 "label": "Additional Context",
+                "format": "\nAdditional Context:\n{value}\n",
                 "placeholder": "Any other information that might be helpful",
                 "required": False,
             },
         ],
         "prompt_template": """I need help with {programming-language} code{framework}.
-
+        
 Task: {task-description}
 
 {requirements}
@@ -104,6 +117,7 @@ Task: {task-description}
         "name": "Content Creation",
         "description": "Generate prompts for blog posts, articles, social media content, etc.",
         "icon": "file-text",
+        "keywords": ["write", "article", "blog", "post", "content", "essay", "email", "social media", "marketing", "copywriting", "story", "newsletter"],
         "questions": [
             {
                 "id": "content-type",
@@ -151,6 +165,7 @@ Task: {task-description}
                 "id": "key-points",
                 "type": "textarea",
                 "label": "Key Points",
+                "format": "\nKey Points:\n{value}\n",
                 "placeholder": "List the key points you want to include",
                 "required": False,
             },
@@ -170,6 +185,7 @@ Task: {task-description}
                 "id": "seo-keywords",
                 "type": "textarea",
                 "label": "SEO Keywords",
+                "format": "\nSeo Keywords:\n{value}\n",
                 "placeholder": "List any SEO keywords to include",
                 "required": False,
             },
@@ -177,12 +193,13 @@ Task: {task-description}
                 "id": "additional-instructions",
                 "type": "textarea",
                 "label": "Additional Instructions",
+                "format": "\nAdditional Instructions:\n{value}\n",
                 "placeholder": "Any other specific instructions",
                 "required": False,
             },
         ],
         "prompt_template": """Please write a {content-type} for {target-audience} with a {tone} tone.
-
+        
 Topic: {main-topic}
 
 {key-points}
@@ -210,6 +227,7 @@ Length: {content-length}
                 "id": "context",
                 "type": "textarea",
                 "label": "Context",
+                "format": "\nContext:\n{value}\n",
                 "placeholder": "Provide any relevant background information",
                 "required": False,
             },
@@ -217,6 +235,7 @@ Length: {content-length}
                 "id": "specific-requirements",
                 "type": "textarea",
                 "label": "Specific Requirements",
+                "format": "\nSpecific Requirements:\n{value}\n",
                 "placeholder": "List any specific requirements or constraints",
                 "required": False,
             },
@@ -224,6 +243,7 @@ Length: {content-length}
                 "id": "preferred-format",
                 "type": "text",
                 "label": "Preferred Format",
+                "format": "Preferred Format: {value}",
                 "placeholder": "How would you like the response formatted?",
                 "required": False,
             },
@@ -243,12 +263,13 @@ Length: {content-length}
                 "id": "additional-notes",
                 "type": "textarea",
                 "label": "Additional Notes",
+                "format": "\nAdditional Notes:\n{value}\n",
                 "placeholder": "Any other information that might be helpful",
                 "required": False,
             },
         ],
         "prompt_template": """I need help with the following:
-
+        
 Main Goal: {main-goal}
 
 {context}
@@ -263,51 +284,246 @@ Level of Detail: {level-of-detail}
     }
 }
 
+# Placeholders in prompt templates; unknown or unanswered ones render empty
+PLACEHOLDER_PATTERN = re.compile(r'\{([^{}]*)\}')
+
+class AnswerFormatter:
+    """
+    Renders a non-empty answer with the question's "format" rule.
+    
+    The rule is a string in which "{value}" stands for the answer, for
+    example " using {value}" or "Preferred Format: {value}". Rules without
+    "{value}" render their text whenever the answer is truthy, which suits
+    checkbox questions.
+    """
+    
+    def __init__(self, rule: str):
+        """
+        Initialize the formatter.
+        
+        Args:
+            rule: The format rule
+        """
+        self.before, marker, self.after = rule.partition("{value}")
+        self.uses_value = bool(marker)
+    
+    def format(self, answer: Any) -> str:
+        """
+        Format an answer.
+        
+        Args:
+            answer: The answer to format
+            
+        Returns:
+            The formatted answer
+        """
+        if self.uses_value:
+            return f"{self.before}{answer}{self.after}"
+        return self.before
+
+# Checkbox answers read as "yes"
+CHECKBOX_YES = frozenset(["yes", "true", "1", "y"])
+
+def normalize_option(text: str) -> str:
+    """Normalize an option label, value or answer for lookup."""
+    return " ".join(text.lower().replace("-", " ").replace("_", " ").split())
+
+class CompiledQuestion:
+    """
+    A questionnaire question with its text rendered and its options indexed.
+    """
+    
+    def __init__(self, question: Dict[str, Any]):
+        """
+        Compile a question.
+        
+        Args:
+            question: Question data from a template
+        """
+        self.id = question["id"]
+        self.type = question["type"]
+        self.text = self._render_text(question)
+        
+        # (lowercased label, lowercased value, value) for substring matching
+        self.options: List[Tuple[str, str, str]] = []
+        # Normalized label or value -> value
+        self.option_index: Dict[str, str] = {}
+        for option in question.get("options", []):
+            self.options.append((option["label"].lower(), option["value"].lower(), option["value"]))
+            self.option_index.setdefault(normalize_option(option["value"]), option["value"])
+            self.option_index.setdefault(normalize_option(option["label"]), option["value"])
+    
+    @staticmethod
+    def _render_text(question: Dict[str, Any]) -> str:
+        """Format the question based on its type."""
+        if question["type"] == "select":
+            options_text = "\n".join([f"- {option['label']}" for option in question["options"]])
+            return f"{question['label']}:\n{options_text}\n\nPlease select one of the options above."
+        elif question["type"] == "checkbox":
+            return f"{question['label']} (yes/no)"
+        else:
+            placeholder = question.get('placeholder', '')
+            if placeholder:
+                return f"{question['label']}\n({placeholder})"
+            else:
+                return question['label']
+    
+    def parse_answer(self, answer: str) -> Any:
+        """
+        Convert a user's reply into the stored answer.
+        
+        Args:
+            answer: The user's reply
+            
+        Returns:
+            A boolean for checkboxes, the option value for matched selects,
+            otherwise the stripped reply
+        """
+        if self.type == "checkbox":
+            return answer.strip().lower() in CHECKBOX_YES
+        
+        if self.type == "select":
+            matched_option = self.option_index.get(normalize_option(answer))
+            if matched_option is None:
+                # Fall back to finding an option mentioned within the reply
+                lowered = answer.lower()
+                for label, value, option_value in self.options:
+                    if label in lowered or value in lowered:
+                        matched_option = option_value
+                        break
+            return matched_option or answer
+        
+        return answer.strip()
+
+class CompiledTemplate:
+    """
+    A template with its questions precompiled and its prompt template split
+    into literal text and placeholder segments.
+    
+    Templates are compiled once when loaded, so questionnaire turns are
+    lookups and rendering a prompt is a single pass over the segments
+    followed by one pass over the output lines.
+    """
+    
+    def __init__(self, template: Dict[str, Any]):
+        """
+        Compile a template.
+        
+        Args:
+            template: Template data with "questions" and an optional "prompt_template"
+        """
+        self.questions = [CompiledQuestion(question) for question in template["questions"]]
+        
+        self.formatters: Dict[str, AnswerFormatter] = {
+            question["id"]: AnswerFormatter(question["format"])
+            for question in template.get("questions", [])
+            if question.get("format")
+        }
+        
+        # (literal text, question ID or None) pairs; None without a prompt template
+        self.segments: Optional[List[Tuple[str, Optional[str]]]] = None
+        prompt_template = template.get("prompt_template")
+        if prompt_template is None:
+            return
+        
+        self.segments = []
+        position = 0
+        for match in PLACEHOLDER_PATTERN.finditer(prompt_template):
+            self.segments.append((prompt_template[position:match.start()], match.group(1)))
+            position = match.end()
+        self.segments.append((prompt_template[position:], None))
+    
+    def render(self, answers: Dict[str, Any]) -> str:
+        """
+        Render the template with a set of answers.
+        
+        Empty answers and unknown placeholders are dropped, and blank lines
+        are removed; the remaining lines are separated by blank lines.
+        
+        Args:
+            answers: Answers keyed by question ID
+            
+        Returns:
+            The rendered prompt
+        """
+        parts = []
+        for literal, question_id in self.segments:
+            parts.append(literal)
+            if question_id is None:
+                continue
+            answer = answers.get(question_id)
+            if answer:
+                formatter = self.formatters.get(question_id)
+                parts.append(formatter.format(answer) if formatter else str(answer))
+        
+        lines = (line.strip() for line in "".join(parts).split('\n'))
+        return '\n\n'.join(line for line in lines if line)
+
 class PromptManager:
     """
     Manages prompt enhancement through questionnaires.
     """
     
-    def __init__(self, templates_dir: str = None):
+    def __init__(self, templates_dir: str = None, poll_interval: float = None, semantic_selection: bool = None):
         """
         Initialize the prompt manager.
         
+        Templates are loaded on first use and reloaded when their files change.
+        
         Args:
             templates_dir: Directory for storing prompt templates
+            poll_interval: Seconds between checks of the directory for changes
+            semantic_selection: Whether to select templates by embedding
+                similarity when no keyword matches
         """
         self.templates_dir = templates_dir or TEMPLATES_DIR
-        self._templates = {}
-        self._load_default_templates()
-        self._load_custom_templates()
-    
-    def _load_default_templates(self):
-        """Load the default templates."""
-        for template_id, template_data in DEFAULT_TEMPLATES.items():
-            self._templates[template_id] = template_data
-            
-            # Save default templates to disk if they don't exist
-            file_path = os.path.join(self.templates_dir, f"{template_id}.json")
-            if not os.path.exists(file_path):
-                os.makedirs(self.templates_dir, exist_ok=True)
-                with open(file_path, 'w') as f:
-                    json.dump(template_data, f, indent=2)
+        self.registry = TemplateRegistry(self.templates_dir, DEFAULT_TEMPLATES, poll_interval)
+        # Template ID -> (template data it was compiled from, compiled template)
+        self._compiled: Dict[str, Tuple[Dict[str, Any], CompiledTemplate]] = {}
+        self._matcher: Optional[KeywordMatcher] = None
+        self._matcher_templates: Optional[Dict[str, Dict[str, Any]]] = None
+        self.semantic_selection = SEMANTIC_SELECTION if semantic_selection is None else semantic_selection
+        self._selector: Optional[SemanticSelector] = None
+        self._selector_templates: Optional[Dict[str, Dict[str, Any]]] = None
     
-    def _load_custom_templates(self):
-        """Load custom templates from the templates directory."""
-        if not os.path.exists(self.templates_dir):
-            return
+    def _get_compiled(self, template_id: str) -> Optional[CompiledTemplate]:
+        """Get the compiled form of a template, compiling it on first use or after a reload."""
+        template = self.get_template(template_id)
+        if not template:
+            return None
+        
+        cached = self._compiled.get(template_id)
+        if cached and cached[0] is template:
+            return cached[1]
         
-        for filename in os.listdir(self.templates_dir):
-            if filename.endswith('.json'):
-                template_id = os.path.splitext(filename)[0]
-                if template_id not in self._templates:  # Don't overwrite default templates
-                    file_path = os.path.join(self.templates_dir, filename)
-                    try:
-                        with open(file_path, 'r') as f:
-                            template_data = json.load(f)
-                            self._templates[template_id] = template_data
-                    except Exception as e:
-                        logger.error(f"Error loading template from {file_path}: {e}")
+        compiled = CompiledTemplate(template)
+        self._compiled[template_id] = (template, compiled)
+        return compiled
+    
+    def _get_matcher(self) -> KeywordMatcher:
+        """Get the keyword matcher for the current templates, rebuilding it after a reload."""
+        templates = self.registry.templates()
+        if self._matcher_templates is not templates:
+            # Compile the "keywords" declared by the templates into one matcher
+            self._matcher = KeywordMatcher({
+                template_id: template_data.get("keywords", [])
+                for template_id, template_data in templates.items()
+            })
+            self._matcher_templates = templates
+        return self._matcher
+    
+    def _get_selector(self) -> Optional[SemanticSelector]:
+        """Get the semantic selector for the current templates, re-embedding them after a reload."""
+        templates = self.registry.templates()
+        if self._selector_templates is not templates:
+            try:
+                self._selector = SemanticSelector(templates)
+            except ImportError as e:
+                logger.warning(f"Semantic template selection disabled: {e}")
+                self.semantic_selection = False
+                return None
+            self._selector_templates = templates
+        return self._selector
     
     def select_template(self, message: str) -> str:
         """
@@ -319,30 +535,17 @@ class PromptManager:
         Returns:
             The ID of the selected template
         """
-        message = message.lower()
-        
-        # Define keywords for each template
-        template_keywords = {
-            "code-generation": ["code", "program", "function", "bug", "error", "debug", "algorithm", "python", "javascript", "java", "c++", "programming", "script", "api", "database"],
-            "content-creation": ["write", "article", "blog", "post", "content", "essay", "email", "social media", "marketing", "copywriting", "story", "newsletter"],
-        }
-        
-        # Count keyword matches for each template
-        template_scores = {template_id: 0 for template_id in self._templates.keys()}
-        
-        for template_id, keywords in template_keywords.items():
-            for keyword in keywords:
-                if keyword in message:
-                    template_scores[template_id] += 1
-        
-        # Find the template with the highest score
-        best_template_id = max(template_scores.items(), key=lambda x: x[1])[0]
+        template_id = self._get_matcher().best_match(message)
         
-        # If no keywords matched significantly, use the general template
-        if template_scores[best_template_id] == 0:
-            return "general"
+        if template_id is None and self.semantic_selection:
+            selector = self._get_selector()
+            selected = selector.select(message) if selector else None
+            if selected:
+                template_id, similarity = selected
+                logger.info(f"Selected template {template_id} by similarity {similarity:.2f}")
         
-        return best_template_id
+        # If nothing matched, use the general template
+        return template_id or "general"
     
     def get_template(self, template_id: str) -> Optional[Dict[str, Any]]:
         """
@@ -354,7 +557,7 @@ class PromptManager:
         Returns:
             Template data or None if not found
         """
-        return self._templates.get(template_id)
+        return self.registry.get(template_id)
     
     def list_templates(self) -> List[Dict[str, Any]]:
         """
@@ -363,7 +566,7 @@ class PromptManager:
         Returns:
             List of templates with their IDs
         """
-        return [{"id": template_id, **template_data} for template_id, template_data in self._templates.items()]
+        return [{"id": template_id, **template_data} for template_id, template_data in self.registry.templates().items()]
     
     def get_current_question(self, conversation: Any) -> str:
         """
@@ -378,31 +581,17 @@ class PromptManager:
         if not conversation.questionnaire:
             return "What can I help you with today?"
         
-        template_id = conversation.questionnaire.get("templateId")
-        template = self.get_template(template_id)
+        compiled = self._get_compiled(conversation.questionnaire.get("templateId"))
         
-        if not template:
+        if not compiled:
             return "I'm sorry, but I couldn't find the questionnaire template. How can I help you?"
         
         current_index = conversation.questionnaire.get("currentQuestionIndex", 0)
         
-        if current_index >= len(template["questions"]):
+        if current_index >= len(compiled.questions):
             return "Thank you for providing all the information. I'll generate a response for you now."
         
-        question = template["questions"][current_index]
-        
-        # Format the question based on its type
-        if question["type"] == "select":
-            options_text = "\n".join([f"- {option['label']}" for option in question["options"]])
-            return f"{question['label']}:\n{options_text}\n\nPlease select one of the options above."
-        elif question["type"] == "checkbox":
-            return f"{question['label']} (yes/no)"
-        else:
-            placeholder = question.get('placeholder', '')
-            if placeholder:
-                return f"{question['label']}\n({placeholder})"
-            else:
-                return question['label']
+        return compiled.questions[current_index].text
     
     def get_next_question(self, conversation: Any) -> str:
         """
@@ -436,15 +625,14 @@ class PromptManager:
         if not conversation.questionnaire:
             return False
         
-        template_id = conversation.questionnaire.get("templateId")
-        template = self.get_template(template_id)
+        compiled = self._get_compiled(conversation.questionnaire.get("templateId"))
         
-        if not template:
+        if not compiled:
             return False
         
         current_index = conversation.questionnaire.get("currentQuestionIndex", 0)
         
-        return current_index < len(template["questions"]) - 1
+        return current_index < len(compiled.questions) - 1
     
     def store_answer(self, conversation: Any, answer: str) -> None:
         """
@@ -457,37 +645,19 @@ class PromptManager:
         if not conversation.questionnaire:
             return
         
-        template_id = conversation.questionnaire.get("templateId")
-        template = self.get_template(template_id)
+        compiled = self._get_compiled(conversation.questionnaire.get("templateId"))
         
-        if not template:
+        if not compiled:
             return
         
         current_index = conversation.questionnaire.get("currentQuestionIndex", 0)
         
-        if current_index >= len(template["questions"]):
+        if current_index >= len(compiled.questions):
             return
         
-        question = template["questions"][current_index]
-        question_id = question["id"]
-        
-        # Process the answer based on the question type
-        if question["type"] == "checkbox":
-            # Convert string "yes"/"no"/"true"/"false" to boolean
-            processed_answer = answer.lower() in ["yes", "true", "1", "y"]
-        elif question["type"] == "select":
-            # Try to match the answer to one of the options
-            options = question.get("options", [])
-            matched_option = None
-            
-            for option in options:
-                if option["label"].lower() in answer.lower() or option["value"].lower() in answer.lower():
-                    matched_option = option["value"]
-                    break
-            
-            processed_answer = matched_option or answer
-        else:
-            processed_answer = answer.strip()
+        question = compiled.questions[current_index]
+        question_id = question.id
+        processed_answer = question.parse_answer(answer)
         
         # Store the answer
         if "answers" not in conversation.questionnaire:
@@ -511,10 +681,10 @@ class PromptManager:
             return conversation.original_message or "Please help me with my request."
         
         template_id = conversation.questionnaire.get("templateId")
-        template = self.get_template(template_id)
+        compiled = self._get_compiled(template_id)
         answers = conversation.questionnaire.get("answers", {})
         
-        if not template or "prompt_template" not in template:
+        if not compiled or compiled.segments is None:
             # Fallback to a simple concatenation of answers
             prompt_parts = [conversation.original_message or "Request:"]
             
@@ -524,47 +694,7 @@ class PromptManager:
             
             return "\n\n".join(prompt_parts)
         
-        # Use the template's prompt template
-        prompt_template = template["prompt_template"]
-        
-        # Replace placeholders in the template
-        for question_id, answer in answers.items():
-            placeholder = '{' + question_id + '}'
-            if placeholder in prompt_template:
-                if answer:  # Only replace if answer is not empty
-                    if question_id == "framework" and answer:
-                        replacement = f" using {answer}"
-                    elif question_id in ["requirements", "input-output", "code-style", "key-points", "seo-keywords", "context", "specific-requirements", "additional-context", "additional-instructions", "additional-notes"]:
-                        if answer:
-                            label = question_id.replace('-', ' ').title()
-                            replacement = f"\n{label}:\n{answer}\n"
-                        else:
-                            replacement = ""
-                    elif question_id == "include-tests" and answer:
-                        replacement = "\nPlease include unit tests."
-                    elif question_id == "include-examples" and answer:
-                        replacement = "\nPlease include usage examples."
-                    elif question_id == "preferred-format" and answer:
-                        replacement = f"Preferred Format: {answer}"
-                    else:
-                        replacement = str(answer)
-                else:
-                    replacement = ""
-                
-                prompt_template = prompt_template.replace(placeholder, replacement)
-        
-        # Clean up any remaining placeholders
-        prompt_template = re.sub(r'\{[^{}]*\}', '', prompt_template)
-        
-        # Clean up extra whitespace and newlines
-        lines = prompt_template.split('\n')
-        cleaned_lines = []
-        for line in lines:
-            line = line.strip()
-            if line:  # Only keep non-empty lines
-                cleaned_lines.append(line)
-        
-        enhanced_prompt = '\n\n'.join(cleaned_lines)
+        enhanced_prompt = compiled.render(answers)
         
         # Combine with original message if it exists
         if conversation.original_message:
@@ -572,6 +702,24 @@ class PromptManager:
         else:
             return enhanced_prompt
 
-# Initialize the prompt manager
-prompt_manager = PromptManager()
+_default_prompt_manager: Optional[PromptManager] = None
+
+def get_prompt_manager() -> PromptManager:
+    """
+    Get the shared prompt manager, creating it on first use.
+    
+    Returns:
+        The process-wide prompt manager
+    """
+    global _default_prompt_manager
+    if _default_prompt_manager is None:
+        _default_prompt_manager = PromptManager()
+    return _default_prompt_manager
+
+def __getattr__(name: str) -> Any:
+    # Keep `from prompt_manager import prompt_manager` working without
+    # building a manager at import time.
+    if name == "prompt_manager":
+        return get_prompt_manager()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
@@ -0,0 +1,329 @@
+"""
+Precomputed leading part of upstream chat requests, and the prefix-cache
+protocol for not resending it.
+
+Every single-turn chat request for a persona and model configuration has
+the same system message and options; only the user turn differs. A
+RequestPrefix encodes that shared part once, so a request body is built by
+concatenating the prefix, the encoded user turn and the options fragment.
+
+Gateways that implement the prefix cache keep the leading messages of a
+request under a stable ID. A request declares its prefix in a "prefix"
+object next to "messages":
+
+    {"prefix": {"id": "<hex>", "messages": 1, "included": true}, "messages": [...], ...}
+
+With "included" true, "messages" holds the whole conversation and the
+gateway stores its first "messages" entries under the ID. With "included"
+false, those entries are left out and the gateway prepends the stored
+ones. The gateway reports the outcome in the X-Prefix-Cache response
+header ("stored", "hit" or "miss"); a miss is answered with status 412 and
+the request has to be sent again in full. Prefixes are only referenced
+after the gateway confirmed storing them, so gateways without prefix
+caching, which ignore the "prefix" object, always get full requests.
+"""
+
+import os
+import json
+import threading
+from collections import OrderedDict
+from typing import Dict, List, Any, Optional
+
+from completion_cache import request_fingerprint
+
+PREFIX_CACHE_HEADER = "X-Prefix-Cache"
+PREFIX_STORED = "stored"
+PREFIX_HIT = "hit"
+PREFIX_MISS = "miss"
+# Status of a response to a request whose referenced prefix is not cached
+PREFIX_MISS_STATUS = 412
+
+DEFAULT_PREFIX_CACHE_SIZE = 4096
+
+def build_options(model: str, temperature: float, max_tokens: int, force_cloud: bool = False, stream: bool = False) -> Dict[str, Any]:
+    """
+    Build the options object of a chat request.
+    
+    Args:
+        model: Model to use for generation
+        temperature: Temperature for generation
+        max_tokens: Maximum number of tokens to generate
+        force_cloud: Whether to force using the cloud model
+        stream: Whether to ask for server-sent events
+        
+    Returns:
+        The options object
+    """
+    options = {
+        "model": model,
+        "temperature": temperature,
+        "maxTokens": max_tokens,
+        "forceCloud": force_cloud
+    }
+    if stream:
+        options["stream"] = True
+    return options
+
+def prefix_id(messages: List[Dict[str, str]], options: Dict[str, Any]) -> str:
+    """
+    Compute the stable ID of a request prefix.
+    
+    Args:
+        messages: Leading messages of the request
+        options: Options of the request, without "stream"
+        
+    Returns:
+        Hex digest identifying the messages for the given options
+    """
+    return request_fingerprint(*messages, options)
+
+def prefix_size(messages: List[Dict[str, str]]) -> int:
+    """
+    Get the number of body bytes a prefix takes up in a full request.
+    
+    Args:
+        messages: Leading messages of the request
+        
+    Returns:
+        Encoded size of the messages including their separators
+    """
+    # "[a, b]" is as long as "a, b, " inside a longer list
+    return len(json.dumps(messages).encode("utf-8"))
+
+class RequestPrefix:
+    """
+    The immutable system message and options of single-turn chat requests.
+    """
+    
+    def __init__(self, system_instruction: str, model: str, temperature: float, max_tokens: int, force_cloud: bool = False):
+        """
+        Encode the prefix.
+        
+        Args:
+            system_instruction: System instruction for the AI
+            model: Model to use for generation
+            temperature: Temperature for generation
+            max_tokens: Maximum number of tokens to generate
+            force_cloud: Whether to force using the cloud model
+        """
+        self.system_instruction = system_instruction
+        self.model = model
+        self.temperature = temperature
+        self.max_tokens = max_tokens
+        self.force_cloud = force_cloud
+        
+        self.system_message = {"role": "system", "content": system_instruction}
+        self.options = build_options(model, temperature, max_tokens, force_cloud)
+        
+        # Identifies the prefix upstream, in cache keys and in in-flight fingerprints
+        self.digest = prefix_id([self.system_message], self.options)
+        self.size = prefix_size([self.system_message])
+        
+        # Encoded exactly like json.dumps of the whole body
+        system_turn = json.dumps(self.system_message) + ', '
+        declared = '{"prefix": ' + json.dumps({"id": self.digest, "messages": 1, "included": True})
+        referenced = '{"prefix": ' + json.dumps({"id": self.digest, "messages": 1, "included": False})
+        self._head = '{"messages": [' + system_turn
+        self._declared_head = declared + ', "messages": [' + system_turn
+        self._referenced_head = referenced + ', "messages": ['
+        self._tail = '], "options": ' + json.dumps(self.options) + '}'
+        self._stream_tail = '], "options": ' + json.dumps(build_options(model, temperature, max_tokens, force_cloud, stream=True)) + '}'
+    
+    def messages(self, message: str) -> List[Dict[str, str]]:
+        """
+        Get the messages of a request.
+        
+        Args:
+            message: User message
+            
+        Returns:
+            The system message followed by the user turn
+        """
+        return [self.system_message, {"role": "user", "content": message}]
+    
+    def body(self, message: str, stream: bool = False) -> bytes:
+        """
+        Encode the request body for a user message.
+        
+        Args:
+            message: User message
+            stream: Whether to ask for server-sent events
+            
+        Returns:
+            UTF-8 encoded JSON request body
+        """
+        return self._encode(self._head, message, stream)
+    
+    def cached_body(self, message: str, stream: bool = False, referenced: bool = False) -> bytes:
+        """
+        Encode the request body for a user message with a prefix-cache declaration.
+        
+        Args:
+            message: User message
+            stream: Whether to ask for server-sent events
+            referenced: Whether to leave the system message out and refer to
+                the copy the gateway already holds
+                
+        Returns:
+            UTF-8 encoded JSON request body
+        """
+        return self._encode(self._referenced_head if referenced else self._declared_head, message, stream)
+    
+    def _encode(self, head: str, message: str, stream: bool) -> bytes:
+        """Concatenate a head, the encoded user turn and the options."""
+        user_turn = json.dumps({"role": "user", "content": message})
+        tail = self._stream_tail if stream else self._tail
+        return (head + user_turn + tail).encode("utf-8")
+    
+    def fingerprint(self, message: str, *parts: Any) -> str:
+        """
+        Identify a request built from this prefix.
+        
+        Args:
+            message: User message
+            *parts: Further values distinguishing the request
+            
+        Returns:
+            Hex digest of the prefix digest, the message and the parts
+        """
+        return request_fingerprint(self.digest, message, *parts)
+
+class PrefixCacheTracker:
+    """
+    Client-side record of the prefixes each upstream endpoint holds.
+    
+    Bounded LRU per endpoint; an entry is added when the gateway confirms
+    storing a prefix and removed when it reports a miss.
+    """
+    
+    def __init__(self, max_entries: int = None, include_history: bool = False):
+        """
+        Initialize the tracker.
+        
+        Args:
+            max_entries: Most prefixes remembered per endpoint
+            include_history: Whether the earlier conversation turns count as
+                part of the prefix, not only the leading system messages
+        """
+        self.max_entries = max_entries or DEFAULT_PREFIX_CACHE_SIZE
+        self.include_history = include_history
+        
+        # Endpoint -> prefix ID -> size of the prefix in bytes
+        self._known: Dict[str, "OrderedDict[str, int]"] = {}
+        self._lock = threading.Lock()
+        self.stored = 0
+        self.hits = 0
+        self.misses = 0
+        self.bytes_saved = 0
+    
+    def prefix_length(self, messages: List[Dict[str, str]]) -> int:
+        """
+        Get the number of leading messages that form a request's prefix.
+        
+        Args:
+            messages: Messages of the request
+            
+        Returns:
+            Number of prefix messages; the last message is never included
+        """
+        if self.include_history:
+            return max(len(messages) - 1, 0)
+        
+        length = 0
+        while length < len(messages) - 1 and messages[length]["role"] == "system":
+            length += 1
+        return length
+    
+    def is_known(self, endpoint: str, prefix_id: str) -> bool:
+        """
+        Check whether an endpoint is known to hold a prefix.
+        
+        Args:
+            endpoint: Base URL of the endpoint
+            prefix_id: ID of the prefix
+            
+        Returns:
+            True if the prefix can be referenced instead of sent
+        """
+        with self._lock:
+            known = self._known.get(endpoint)
+            if known is None or prefix_id not in known:
+                return False
+            known.move_to_end(prefix_id)
+            return True
+    
+    def record_stored(self, endpoint: str, prefix_id: str, size: int) -> None:
+        """
+        Remember that an endpoint stored a prefix.
+        
+        Args:
+            endpoint: Base URL of the endpoint
+            prefix_id: ID of the prefix
+            size: Bytes the prefix takes up in a full request
+        """
+        with self._lock:
+            known = self._known.setdefault(endpoint, OrderedDict())
+            if prefix_id not in known:
+                self.stored += 1
+            known[prefix_id] = size
+            known.move_to_end(prefix_id)
+            while len(known) > self.max_entries:
+                known.popitem(last=False)
+    
+    def record_hit(self, endpoint: str, prefix_id: str) -> None:
+        """
+        Count a request that was served from a referenced prefix.
+        
+        Args:
+            endpoint: Base URL of the endpoint
+            prefix_id: ID of the prefix
+        """
+        with self._lock:
+            self.hits += 1
+            self.bytes_saved += self._known.get(endpoint, {}).get(prefix_id, 0)
+    
+    def record_miss(self, endpoint: str, prefix_id: str) -> None:
+        """
+        Forget a prefix the endpoint no longer holds.
+        
+        Args:
+            endpoint: Base URL of the endpoint
+            prefix_id: ID of the prefix
+        """
+        with self._lock:
+            self.misses += 1
+            known = self._known.get(endpoint)
+            if known is not None:
+                known.pop(prefix_id, None)
+    
+    def stats(self) -> Dict[str, int]:
+        """
+        Get prefix cache counters.
+        
+        Returns:
+            Number of prefixes known upstream, stored, hits, misses and
+            request body bytes not sent thanks to hits
+        """
+        with self._lock:
+            return {
+                "known": sum(len(known) for known in self._known.values()),
+                "stored": self.stored,
+                "hits": self.hits,
+                "misses": self.misses,
+                "bytesSaved": self.bytes_saved
+            }
+
+def create_prefix_cache_tracker_from_env() -> Optional[PrefixCacheTracker]:
+    """
+    Create a prefix cache tracker from LLM_PREFIX_CACHE* environment variables.
+    
+    Returns:
+        The tracker, or None if LLM_PREFIX_CACHE is disabled
+    """
+    if os.environ.get("LLM_PREFIX_CACHE", "true").lower() not in ("1", "true", "yes"):
+        return None
+    
+    return PrefixCacheTracker(
+        max_entries=int(os.environ.get("LLM_PREFIX_CACHE_SIZE", DEFAULT_PREFIX_CACHE_SIZE)),
+        include_history=os.environ.get("LLM_PREFIX_CACHE_HISTORY", "false").lower() in ("1", "true", "yes")
+    )
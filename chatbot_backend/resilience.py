@@ -0,0 +1,691 @@
+"""
+Retries, hedging and circuit breaking for calls to the LLM gateway.
+
+A call is retried with exponential backoff and full jitter while the
+gateway fails in a way that may be transient (connection errors,
+timeouts, 429 and 5xx responses). A circuit breaker per endpoint counts
+consecutive failures; once open it fails calls immediately instead of
+piling more requests onto an unhealthy gateway, and lets a single probe
+through after a cool-down. With hedging enabled, a call that has not
+finished after the endpoint's recent p95 latency gets a second, identical
+request, and whichever answers first wins. Calls may pick their endpoint
+through a selector, so that retries and hedges go to other endpoints of a
+pool.
+"""
+
+import os
+import math
+import time
+import random
+import asyncio
+import logging
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from typing import Any, Awaitable, Callable, Dict, Optional, Set, Tuple, Union
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_RETRY_ATTEMPTS = 3
+DEFAULT_RETRY_BASE_DELAY = 0.2
+DEFAULT_RETRY_MAX_DELAY = 2.0
+DEFAULT_BREAKER_FAILURES = 5
+DEFAULT_BREAKER_RESET_TIMEOUT = 30.0
+DEFAULT_HEDGE_PERCENTILE = 0.95
+DEFAULT_HEDGE_MIN_DELAY = 0.05
+DEFAULT_HEDGE_WORKERS = 32
+# Latency samples kept per endpoint, and needed before hedging starts
+LATENCY_WINDOW = 256
+MIN_LATENCY_SAMPLES = 20
+
+# Seconds clients are asked to wait when the gateway did not say
+DEFAULT_UNAVAILABLE_RETRY_AFTER = 5
+
+# Response statuses worth retrying; anything else is the request's fault
+RETRYABLE_STATUSES = frozenset({408, 425, 429, 500, 502, 503, 504})
+
+# Chooses the endpoint for an attempt, given the endpoints that already failed
+EndpointSelector = Callable[[Set[str]], str]
+
+class UpstreamError(Exception):
+    """
+    A single failed attempt to call the gateway.
+    """
+    
+    def __init__(self, message: str, status_code: Optional[int] = None, retry_after: Optional[float] = None):
+        """
+        Initialize the error.
+        
+        Args:
+            message: Description of the failure
+            status_code: HTTP status of the response, or None if no response arrived
+            retry_after: Seconds the gateway asked to wait before retrying
+        """
+        super().__init__(message)
+        self.status_code = status_code
+        self.retry_after = retry_after
+    
+    @property
+    def retryable(self) -> bool:
+        """Whether another attempt may succeed."""
+        return self.status_code is None or self.status_code in RETRYABLE_STATUSES
+
+class LLMUnavailableError(Exception):
+    """
+    Raised when no completion could be obtained from the gateway.
+    """
+    
+    def __init__(self, message: str, retry_after: Optional[float] = None):
+        """
+        Initialize the error.
+        
+        Args:
+            message: Reason the gateway is unavailable
+            retry_after: Seconds after which a retry is likely to succeed, if known
+        """
+        super().__init__(message)
+        self.retry_after = retry_after
+    
+    @property
+    def retry_after_header(self) -> str:
+        """Retry-After header value, in whole seconds."""
+        if self.retry_after is None:
+            return str(DEFAULT_UNAVAILABLE_RETRY_AFTER)
+        return str(max(int(math.ceil(self.retry_after)), 1))
+
+class CircuitOpenError(LLMUnavailableError):
+    """
+    Raised without calling the gateway while its circuit breaker is open.
+    """
+    
+    def __init__(self, endpoint: str, retry_after: float):
+        """
+        Initialize the error.
+        
+        Args:
+            endpoint: Base URL of the endpoint
+            retry_after: Seconds until the breaker lets a probe through
+        """
+        super().__init__(f"Circuit open for {endpoint}; retry in {retry_after:.1f}s", retry_after)
+        self.endpoint = endpoint
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """
+    Parse a Retry-After header given in seconds.
+    
+    Args:
+        value: Header value
+        
+    Returns:
+        Seconds to wait, or None if absent or given as a date
+    """
+    try:
+        return max(float(value), 0.0) if value else None
+    except ValueError:
+        return None
+
+class RetryPolicy:
+    """
+    Exponential backoff with full jitter.
+    """
+    
+    def __init__(self, max_attempts: int = None, base_delay: float = None, max_delay: float = None):
+        """
+        Initialize the policy.
+        
+        Args:
+            max_attempts: Attempts per call, including the first
+            base_delay: Upper bound of the first backoff in seconds
+            max_delay: Upper bound of any backoff in seconds
+        """
+        self.max_attempts = max(max_attempts or DEFAULT_RETRY_ATTEMPTS, 1)
+        self.base_delay = DEFAULT_RETRY_BASE_DELAY if base_delay is None else base_delay
+        self.max_delay = DEFAULT_RETRY_MAX_DELAY if max_delay is None else max_delay
+    
+    def delay(self, attempt: int, retry_after: Optional[float] = None) -> float:
+        """
+        Get the backoff before the next attempt.
+        
+        Args:
+            attempt: Zero-based number of the attempt that just failed
+            retry_after: Seconds the gateway asked to wait, if any
+            
+        Returns:
+            Seconds to wait
+        """
+        # Full jitter spreads the retries of many clients failing together
+        delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+        if retry_after is not None:
+            delay = max(delay, min(retry_after, self.max_delay))
+        return delay
+
+class CircuitBreaker:
+    """
+    Consecutive-failure circuit breaker for one endpoint.
+    """
+    
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+    
+    def __init__(self, failure_threshold: int = None, reset_timeout: float = None):
+        """
+        Initialize a closed breaker.
+        
+        Args:
+            failure_threshold: Consecutive failures that open the breaker
+            reset_timeout: Seconds the breaker stays open before a probe
+        """
+        self.failure_threshold = failure_threshold or DEFAULT_BREAKER_FAILURES
+        self.reset_timeout = DEFAULT_BREAKER_RESET_TIMEOUT if reset_timeout is None else reset_timeout
+        
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.times_opened = 0
+        self._probing = False
+        self._lock = threading.Lock()
+    
+    def allow(self) -> bool:
+        """
+        Check whether a call may go through, claiming the probe if half open.
+        
+        Returns:
+            True if the call may be made
+        """
+        with self._lock:
+            if self.state == self.OPEN:
+                if time.monotonic() < self.opened_at + self.reset_timeout:
+                    return False
+                self.state = self.HALF_OPEN
+                self._probing = False
+            
+            if self.state == self.HALF_OPEN:
+                if self._probing:
+                    return False
+                self._probing = True
+            return True
+    
+    def available(self) -> bool:
+        """
+        Check whether a call would go through, without claiming the probe.
+        
+        Returns:
+            True if the breaker is closed or a probe is due and not yet taken
+        """
+        with self._lock:
+            if self.state == self.OPEN:
+                return time.monotonic() >= self.opened_at + self.reset_timeout
+            return self.state == self.CLOSED or not self._probing
+    
+    def release_probe(self) -> None:
+        """
+        Give up a claimed probe without counting a success or failure.
+        
+        For calls that end without an answer from the gateway, such as a
+        cancelled request, so that the next call can probe instead.
+        """
+        with self._lock:
+            if self.state == self.HALF_OPEN:
+                self._probing = False
+    
+    def record_success(self) -> None:
+        """
+        Close the breaker after a successful call.
+        """
+        with self._lock:
+            self.state = self.CLOSED
+            self.failures = 0
+            self._probing = False
+    
+    def record_failure(self) -> None:
+        """
+        Count a failed call, opening the breaker at the threshold or after a failed probe.
+        """
+        with self._lock:
+            self.failures += 1
+            self._probing = False
+            if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+                if self.state != self.OPEN:
+                    self.times_opened += 1
+                    logger.warning(f"Circuit breaker opened after {self.failures} consecutive failures")
+                self.state = self.OPEN
+                self.opened_at = time.monotonic()
+    
+    def retry_after(self) -> float:
+        """
+        Get the time until an open breaker lets a probe through.
+        
+        Returns:
+            Seconds to wait, 0 if calls are allowed
+        """
+        with self._lock:
+            if self.state != self.OPEN:
+                return 0.0
+            return max(self.opened_at + self.reset_timeout - time.monotonic(), 0.0)
+    
+    def stats(self) -> Dict[str, Any]:
+        """
+        Get the breaker's state.
+        
+        Returns:
+            State, consecutive failures and how often the breaker opened
+        """
+        with self._lock:
+            return {"state": self.state, "failures": self.failures, "opened": self.times_opened}
+
+class LatencyTracker:
+    """
+    Sliding window of recent successful call latencies.
+    """
+    
+    def __init__(self, window: int = LATENCY_WINDOW):
+        """
+        Initialize an empty window.
+        
+        Args:
+            window: Number of most recent samples kept
+        """
+        self._samples: "deque[float]" = deque(maxlen=window)
+        self._lock = threading.Lock()
+    
+    def record(self, seconds: float) -> None:
+        """
+        Add a sample.
+        
+        Args:
+            seconds: Latency of a successful call
+        """
+        with self._lock:
+            self._samples.append(seconds)
+    
+    def percentile(self, fraction: float) -> Optional[float]:
+        """
+        Get a latency percentile over the window.
+        
+        Args:
+            fraction: Percentile as a fraction, e.g. 0.95
+            
+        Returns:
+            The latency in seconds, or None without samples
+        """
+        with self._lock:
+            samples = sorted(self._samples)
+        if not samples:
+            return None
+        return samples[min(int(fraction * len(samples)), len(samples) - 1)]
+    
+    def __len__(self) -> int:
+        return len(self._samples)
+
+class Resilience:
+    """
+    Retry policy, per-endpoint circuit breakers and latency-based hedging.
+    """
+    
+    def __init__(
+        self,
+        retry: Optional[RetryPolicy] = None,
+        breaker_failures: int = None,
+        breaker_reset_timeout: float = None,
+        hedge: bool = False,
+        hedge_percentile: float = None,
+        hedge_min_delay: float = None,
+        hedge_workers: int = None
+    ):
+        """
+        Initialize the resilience settings.
+        
+        Args:
+            retry: Retry policy for failed attempts
+            breaker_failures: Consecutive failures that open an endpoint's breaker
+            breaker_reset_timeout: Seconds a breaker stays open before a probe
+            hedge: Whether to send a second request when the first one is slow
+            hedge_percentile: Latency percentile after which the hedge is sent
+            hedge_min_delay: Lower bound of the hedge delay in seconds
+            hedge_workers: Threads available to blocking hedged calls
+        """
+        self.retry = retry or RetryPolicy()
+        self.breaker_failures = breaker_failures
+        self.breaker_reset_timeout = breaker_reset_timeout
+        self.hedge = hedge
+        self.hedge_percentile = hedge_percentile or DEFAULT_HEDGE_PERCENTILE
+        self.hedge_min_delay = DEFAULT_HEDGE_MIN_DELAY if hedge_min_delay is None else hedge_min_delay
+        self.hedge_workers = hedge_workers or DEFAULT_HEDGE_WORKERS
+        
+        self._breakers: Dict[str, CircuitBreaker] = {}
+        self._latencies: Dict[Tuple[str, str], LatencyTracker] = {}
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._lock = threading.Lock()
+        self.retries = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+        self.rejected = 0
+    
+    def breaker(self, endpoint: str) -> CircuitBreaker:
+        """
+        Get the circuit breaker of an endpoint, creating it on first use.
+        
+        Args:
+            endpoint: Base URL of the endpoint
+            
+        Returns:
+            The endpoint's breaker
+        """
+        breaker = self._breakers.get(endpoint)
+        if breaker is None:
+            with self._lock:
+                breaker = self._breakers.setdefault(endpoint, CircuitBreaker(self.breaker_failures, self.breaker_reset_timeout))
+        return breaker
+    
+    def is_available(self, endpoint: str) -> bool:
+        """
+        Passive health check of an endpoint, based on its breaker.
+        
+        Args:
+            endpoint: Base URL of the endpoint
+            
+        Returns:
+            False while the endpoint's breaker rejects calls
+        """
+        breaker = self._breakers.get(endpoint)
+        return breaker is None or breaker.available()
+    
+    def latency(self, endpoint: str, operation: str) -> LatencyTracker:
+        """
+        Get the latency window of an endpoint and operation, creating it on first use.
+        
+        Args:
+            endpoint: Base URL of the endpoint
+            operation: Kind of call, such as "chat" or "stream"
+            
+        Returns:
+            The latency tracker
+        """
+        key = (endpoint, operation)
+        tracker = self._latencies.get(key)
+        if tracker is None:
+            with self._lock:
+                tracker = self._latencies.setdefault(key, LatencyTracker())
+        return tracker
+    
+    def hedge_delay(self, endpoint: str, operation: str) -> Optional[float]:
+        """
+        Get how long to wait before hedging a call.
+        
+        Args:
+            endpoint: Base URL of the endpoint
+            operation: Kind of call
+            
+        Returns:
+            Seconds to wait, or None if the call is not hedged
+        """
+        if not self.hedge:
+            return None
+        tracker = self.latency(endpoint, operation)
+        if len(tracker) < MIN_LATENCY_SAMPLES:
+            return None
+        return max(tracker.percentile(self.hedge_percentile), self.hedge_min_delay)
+    
+    def call(self, endpoint: Union[str, EndpointSelector], fn: Callable[[str], Any], operation: str = "chat", hedge: bool = False) -> Any:
+        """
+        Call the gateway with retries, circuit breaking and optional hedging.
+        
+        Args:
+            endpoint: Base URL of the endpoint, or a selector choosing one for
+                every attempt and hedge
+            fn: Makes one attempt against the given endpoint URL; raises
+                UpstreamError on failure
+            operation: Kind of call, for latency tracking
+            hedge: Whether the call may be hedged; fn must then be safe to
+                run twice concurrently
+                
+        Returns:
+            The result of the first successful attempt
+            
+        Raises:
+            CircuitOpenError: If the chosen endpoint's breaker is open
+            LLMUnavailableError: If every attempt failed
+        """
+        select = self._selector(endpoint)
+        failed: Set[str] = set()
+        for attempt in range(self.retry.max_attempts):
+            url = select(failed)
+            breaker = self.breaker(url)
+            self._check_breaker(url, breaker)
+            
+            started = time.monotonic()
+            try:
+                url, result = self._hedged(url, select, operation, fn) if hedge else (url, fn(url))
+            except UpstreamError as e:
+                failed.add(url)
+                delay = self._failed(url, breaker, attempt, e)
+                time.sleep(delay)
+                continue
+            except BaseException:
+                # Ended without an answer from the gateway, e.g. cancelled
+                breaker.release_probe()
+                raise
+            
+            self.breaker(url).record_success()
+            self.latency(url, operation).record(time.monotonic() - started)
+            return result
+    
+    async def acall(self, endpoint: Union[str, EndpointSelector], fn: Callable[[str], Awaitable[Any]], operation: str = "chat", hedge: bool = False) -> Any:
+        """
+        Awaitable counterpart of call; fn is a coroutine function.
+        
+        A hedged call cancels the slower request once the other one succeeds.
+        
+        Returns:
+            The result of the first successful attempt
+            
+        Raises:
+            CircuitOpenError: If the chosen endpoint's breaker is open
+            LLMUnavailableError: If every attempt failed
+        """
+        select = self._selector(endpoint)
+        failed: Set[str] = set()
+        for attempt in range(self.retry.max_attempts):
+            url = select(failed)
+            breaker = self.breaker(url)
+            self._check_breaker(url, breaker)
+            
+            started = time.monotonic()
+            try:
+                url, result = await self._ahedged(url, select, operation, fn) if hedge else (url, await fn(url))
+            except UpstreamError as e:
+                failed.add(url)
+                delay = self._failed(url, breaker, attempt, e)
+                await asyncio.sleep(delay)
+                continue
+            except BaseException:
+                # Ended without an answer from the gateway, e.g. cancelled
+                breaker.release_probe()
+                raise
+            
+            self.breaker(url).record_success()
+            self.latency(url, operation).record(time.monotonic() - started)
+            return result
+    
+    @staticmethod
+    def _selector(endpoint: Union[str, EndpointSelector]) -> EndpointSelector:
+        """Turn a fixed endpoint into a selector that always returns it."""
+        if callable(endpoint):
+            return endpoint
+        return lambda failed: endpoint
+    
+    def _hedge_target(self, endpoint: str, select: EndpointSelector) -> str:
+        """Choose where to send a hedge: another endpoint if one is healthy, else the same."""
+        target = select({endpoint})
+        breaker = self._breakers.get(target)
+        # Never spend a half-open breaker's single probe on a request that may be discarded
+        if breaker is not None and breaker.state != CircuitBreaker.CLOSED:
+            return endpoint
+        return target
+    
+    def _check_breaker(self, endpoint: str, breaker: CircuitBreaker) -> None:
+        """Raise CircuitOpenError if the breaker does not let a call through."""
+        if not breaker.allow():
+            with self._lock:
+                self.rejected += 1
+            raise CircuitOpenError(endpoint, breaker.retry_after())
+    
+    def _failed(self, endpoint: str, breaker: CircuitBreaker, attempt: int, error: UpstreamError) -> float:
+        """
+        Record a failed attempt.
+        
+        Returns:
+            Seconds to wait before the next attempt
+            
+        Raises:
+            LLMUnavailableError: If the call must not be retried
+        """
+        if error.retryable:
+            breaker.record_failure()
+        else:
+            # The gateway answered; the request itself was at fault
+            breaker.record_success()
+        
+        if not error.retryable or attempt + 1 >= self.retry.max_attempts:
+            raise LLMUnavailableError(
+                f"LLM gateway {endpoint} failed after {attempt + 1} attempt(s): {error}",
+                retry_after=error.retry_after
+            ) from error
+        
+        with self._lock:
+            self.retries += 1
+        delay = self.retry.delay(attempt, error.retry_after)
+        logger.warning(f"LLM gateway attempt {attempt + 1} failed ({error}); retrying in {delay:.2f}s")
+        return delay
+    
+    def _hedged(self, endpoint: str, select: EndpointSelector, operation: str, fn: Callable[[str], Any]) -> Tuple[str, Any]:
+        """
+        Run fn, starting a second copy if the first is slower than the hedge delay.
+        
+        Returns:
+            URL of the endpoint that answered first, and its result
+        """
+        delay = self.hedge_delay(endpoint, operation)
+        if delay is None or self.breaker(endpoint).state != CircuitBreaker.CLOSED:
+            return endpoint, fn(endpoint)
+        
+        executor = self._get_executor()
+        first = executor.submit(fn, endpoint)
+        done, _ = wait([first], timeout=delay)
+        if done:
+            return endpoint, first.result()
+        
+        with self._lock:
+            self.hedges += 1
+        target = self._hedge_target(endpoint, select)
+        second = executor.submit(fn, target)
+        
+        # The slower request cannot be cancelled; its result is discarded
+        pending = {first, second}
+        error: Optional[BaseException] = None
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    if future is second:
+                        with self._lock:
+                            self.hedge_wins += 1
+                        return target, future.result()
+                    return endpoint, future.result()
+                error = future.exception()
+        raise error
+    
+    async def _ahedged(self, endpoint: str, select: EndpointSelector, operation: str, fn: Callable[[str], Awaitable[Any]]) -> Tuple[str, Any]:
+        """
+        Await fn, starting a second copy if the first is slower than the hedge delay.
+        
+        Returns:
+            URL of the endpoint that answered first, and its result
+        """
+        delay = self.hedge_delay(endpoint, operation)
+        if delay is None or self.breaker(endpoint).state != CircuitBreaker.CLOSED:
+            return endpoint, await fn(endpoint)
+        
+        first = asyncio.ensure_future(fn(endpoint))
+        done, _ = await asyncio.wait({first}, timeout=delay)
+        if done:
+            return endpoint, first.result()
+        
+        with self._lock:
+            self.hedges += 1
+        target = self._hedge_target(endpoint, select)
+        second = asyncio.ensure_future(fn(target))
+        
+        pending = {first, second}
+        error: Optional[BaseException] = None
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if task is second:
+                            with self._lock:
+                                self.hedge_wins += 1
+                            return target, task.result()
+                        return endpoint, task.result()
+                    error = task.exception()
+            raise error
+        finally:
+            for task in pending:
+                task.cancel()
+    
+    def _get_executor(self) -> ThreadPoolExecutor:
+        """Create the hedging thread pool on first use."""
+        if self._executor is None:
+            with self._lock:
+                if self._executor is None:
+                    self._executor = ThreadPoolExecutor(max_workers=self.hedge_workers, thread_name_prefix="llm-hedge")
+        return self._executor
+    
+    def stats(self) -> Dict[str, Any]:
+        """
+        Get retry, hedging and circuit breaker statistics.
+        
+        Returns:
+            Counters, and per endpoint the breaker state and latency percentiles
+        """
+        endpoints: Dict[str, Dict[str, Any]] = {}
+        for endpoint, breaker in list(self._breakers.items()):
+            endpoints[endpoint] = {"breaker": breaker.stats()}
+        for (endpoint, operation), tracker in list(self._latencies.items()):
+            p50, p95 = tracker.percentile(0.5), tracker.percentile(0.95)
+            endpoints.setdefault(endpoint, {})[operation] = {
+                "samples": len(tracker),
+                "p50Ms": round(p50 * 1000, 1) if p50 is not None else None,
+                "p95Ms": round(p95 * 1000, 1) if p95 is not None else None
+            }
+        
+        with self._lock:
+            return {
+                "retries": self.retries,
+                "hedges": self.hedges,
+                "hedgeWins": self.hedge_wins,
+                "rejected": self.rejected,
+                "endpoints": endpoints
+            }
+
+def create_resilience_from_env() -> Resilience:
+    """
+    Create the resilience settings from LLM_RETRY_*, LLM_BREAKER_* and LLM_HEDGE* environment variables.
+    
+    Returns:
+        The configured settings
+    """
+    return Resilience(
+        retry=RetryPolicy(
+            max_attempts=int(os.environ.get("LLM_RETRY_ATTEMPTS", DEFAULT_RETRY_ATTEMPTS)),
+            base_delay=float(os.environ.get("LLM_RETRY_BASE_DELAY", DEFAULT_RETRY_BASE_DELAY)),
+            max_delay=float(os.environ.get("LLM_RETRY_MAX_DELAY", DEFAULT_RETRY_MAX_DELAY))
+        ),
+        breaker_failures=int(os.environ.get("LLM_BREAKER_FAILURES", DEFAULT_BREAKER_FAILURES)),
+        breaker_reset_timeout=float(os.environ.get("LLM_BREAKER_RESET_TIMEOUT", DEFAULT_BREAKER_RESET_TIMEOUT)),
+        hedge=os.environ.get("LLM_HEDGE", "false").lower() in ("1", "true", "yes"),
+        hedge_percentile=float(os.environ.get("LLM_HEDGE_PERCENTILE", DEFAULT_HEDGE_PERCENTILE)),
+        hedge_min_delay=float(os.environ.get("LLM_HEDGE_MIN_DELAY", DEFAULT_HEDGE_MIN_DELAY))
+    )
@@ -0,0 +1,223 @@
+"""
+Embedding-based template selection that runs offline on the CPU.
+
+Texts are embedded with a hashing-trick vectorizer: words and word pairs
+are hashed into a fixed number of signed buckets, so no model or
+vocabulary has to be loaded. Template embeddings are computed once into a
+matrix; selecting a template is one matrix-vector product of cosine
+similarities. Requires numpy.
+"""
+
+import os
+import re
+import math
+import zlib
+import logging
+import threading
+from collections import OrderedDict
+from typing import Dict, Any, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_DIMENSIONS = int(os.environ.get("PROMPT_SEMANTIC_DIMENSIONS", 2048))
+DEFAULT_CACHE_SIZE = int(os.environ.get("PROMPT_SEMANTIC_CACHE_SIZE", 4096))
+# Messages less similar than this to every template are not routed
+DEFAULT_MIN_SIMILARITY = float(os.environ.get("PROMPT_SEMANTIC_MIN_SIMILARITY", 0.08))
+
+WORD_PATTERN = re.compile(r"\w+")
+
+# Function words carry no signal about which template fits
+STOP_WORDS = frozenset(
+    "a about all also an and any are as at be but by can could do does e.g for from get "
+    "give has have how i i'm if in into is it it's its just like me more my of on or "
+    "other our should so some than that the then there this to us want was we what "
+    "which who why will with would you your need help please".split()
+)
+
+def template_text(template: Dict[str, Any]) -> str:
+    """
+    Get the text that describes a template for embedding.
+    
+    Args:
+        template: Template data
+        
+    Returns:
+        Name, description, keywords and question texts joined together
+    """
+    parts = [template.get("name", ""), template.get("description", "")]
+    parts.extend(template.get("keywords", []))
+    for question in template.get("questions", []):
+        parts.append(question.get("label", ""))
+        parts.append(question.get("placeholder", ""))
+        parts.extend(option.get("label", "") for option in question.get("options", []))
+    return "\n".join(part for part in parts if part)
+
+class HashingVectorizer:
+    """
+    Maps text to a fixed-size, L2-normalized vector of hashed word features.
+    """
+    
+    def __init__(self, dimensions: int = None):
+        """
+        Initialize the vectorizer.
+        
+        Args:
+            dimensions: Number of hash buckets
+        """
+        import numpy as np
+        
+        self.np = np
+        self.dimensions = dimensions or DEFAULT_DIMENSIONS
+    
+    def features(self, text: str) -> List[str]:
+        """
+        Extract the hashed features of a text.
+        
+        Args:
+            text: The text
+            
+        Returns:
+            Lowercased words other than stop words, and adjacent word pairs
+        """
+        words = [word for word in WORD_PATTERN.findall(text.lower()) if word not in STOP_WORDS]
+        return words + [f"{first} {second}" for first, second in zip(words, words[1:])]
+    
+    def transform(self, text: str):
+        """
+        Embed a text.
+        
+        Args:
+            text: The text
+            
+        Returns:
+            Unit-length float32 vector, or all zeros for text without words
+        """
+        counts: Dict[int, float] = {}
+        for feature in self.features(text):
+            # crc32 is stable across processes, unlike hash()
+            digest = zlib.crc32(feature.encode("utf-8"))
+            index = digest % self.dimensions
+            sign = 1.0 if digest & 0x80000000 else -1.0
+            counts[index] = counts.get(index, 0.0) + sign
+        
+        vector = self.np.zeros(self.dimensions, dtype=self.np.float32)
+        for index, count in counts.items():
+            # Sublinear term frequency keeps repeated words from dominating
+            vector[index] = math.copysign(1.0 + math.log(abs(count)), count) if count else 0.0
+        
+        norm = self.np.linalg.norm(vector)
+        if norm:
+            vector /= norm
+        return vector
+
+class SemanticSelector:
+    """
+    Picks the template whose description is most similar to a message.
+    """
+    
+    def __init__(self, templates: Dict[str, Dict[str, Any]], dimensions: int = None, cache_size: int = None, min_similarity: float = None):
+        """
+        Embed the templates.
+        
+        Args:
+            templates: Templates keyed by ID
+            dimensions: Number of hash buckets of the vectorizer
+            cache_size: Number of message embeddings kept in the LRU cache
+            min_similarity: Minimum cosine similarity for a template to be selected
+            
+        Raises:
+            ImportError: If numpy is not installed
+        """
+        try:
+            self.vectorizer = HashingVectorizer(dimensions)
+        except ImportError:
+            raise ImportError("The numpy package is required for semantic template selection")
+        
+        np = self.vectorizer.np
+        self.cache_size = cache_size or DEFAULT_CACHE_SIZE
+        self.min_similarity = DEFAULT_MIN_SIMILARITY if min_similarity is None else min_similarity
+        
+        self.template_ids = list(templates)
+        self.matrix = np.zeros((len(self.template_ids), self.vectorizer.dimensions), dtype=np.float32)
+        for row, template_id in enumerate(self.template_ids):
+            self.matrix[row] = self.vectorizer.transform(template_text(templates[template_id]))
+        
+        self._cache: "OrderedDict[str, Any]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.cache_hits = 0
+        self.cache_misses = 0
+    
+    def embed(self, message: str):
+        """
+        Embed a message, reusing the embedding of a recently seen identical message.
+        
+        Args:
+            message: The message
+            
+        Returns:
+            The message's embedding
+        """
+        with self._lock:
+            vector = self._cache.get(message)
+            if vector is not None:
+                self._cache.move_to_end(message)
+                self.cache_hits += 1
+                return vector
+            self.cache_misses += 1
+        
+        vector = self.vectorizer.transform(message)
+        
+        with self._lock:
+            self._cache[message] = vector
+            if len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return vector
+    
+    def similarities(self, message: str) -> Dict[str, float]:
+        """
+        Get the cosine similarity of a message to every template.
+        
+        Args:
+            message: The message
+            
+        Returns:
+            Similarity per template ID
+        """
+        scores = self.matrix @ self.embed(message)
+        return dict(zip(self.template_ids, scores.tolist()))
+    
+    def select(self, message: str) -> Optional[Tuple[str, float]]:
+        """
+        Select the template most similar to a message.
+        
+        Args:
+            message: The message
+            
+        Returns:
+            The template ID and its similarity, or None if no template is
+            similar enough
+        """
+        if not self.template_ids:
+            return None
+        
+        scores = self.matrix @ self.embed(message)
+        best = int(scores.argmax())
+        similarity = float(scores[best])
+        if similarity < self.min_similarity:
+            return None
+        return self.template_ids[best], similarity
+    
+    def stats(self) -> Dict[str, int]:
+        """
+        Get embedding cache counters.
+        
+        Returns:
+            Number of templates, cached embeddings, cache hits and misses
+        """
+        with self._lock:
+            return {
+                "templates": len(self.template_ids),
+                "cachedMessages": len(self._cache),
+                "hits": self.cache_hits,
+                "misses": self.cache_misses
+            }
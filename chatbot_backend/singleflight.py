@@ -0,0 +1,410 @@
+"""
+Single-flight deduplication of identical in-flight calls.
+
+Concurrent callers that present the same key share one execution of the
+underlying call: the first caller (the leader) runs it, later callers wait
+for and reuse its result. Streams are fanned out so every caller receives
+the full sequence of chunks, including the ones produced before it joined.
+Streams, and asyncio calls, keep running for the others when the caller
+that started them goes away; they are only abandoned once nobody is
+waiting for them.
+"""
+
+import asyncio
+import threading
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, Iterator, List, Optional
+
+class _Call:
+    """A call shared by every thread waiting on the same key."""
+    
+    def __init__(self):
+        self.done = threading.Event()
+        self.result: Any = None
+        self.error: Optional[BaseException] = None
+
+
+class _StreamCall:
+    """A stream shared by every thread consuming the same key."""
+    
+    def __init__(self):
+        self.chunks: List[Any] = []
+        self.finished = False
+        self.error: Optional[BaseException] = None
+        self.condition = threading.Condition()
+        # Consumers other than the leader still reading the stream
+        self.followers = 0
+
+
+class SingleFlight:
+    """
+    Thread-based single-flight group.
+    """
+    
+    def __init__(self):
+        """
+        Initialize the group.
+        """
+        self._calls: Dict[str, _Call] = {}
+        self._streams: Dict[str, _StreamCall] = {}
+        self._lock = threading.Lock()
+        self.leaders = 0
+        self.shared = 0
+    
+    def do(self, key: str, fn: Callable[[], Any]) -> Any:
+        """
+        Run fn once for all concurrent callers with the same key.
+        
+        Args:
+            key: Fingerprint of the call
+            fn: The call to run
+            
+        Returns:
+            The result of fn, possibly computed for another caller
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+                self.leaders += 1
+            else:
+                self.shared += 1
+        
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+        
+        try:
+            call.result = fn()
+            return call.result
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+    
+    def stream(self, key: str, fn: Callable[[], Iterator[Any]]) -> Iterator[Any]:
+        """
+        Iterate fn() once for all concurrent consumers with the same key.
+        
+        The leader drives the upstream iterator while it is consumed; other
+        consumers replay the chunks buffered so far and then follow along.
+        
+        Args:
+            key: Fingerprint of the stream
+            fn: Factory for the upstream iterator
+            
+        Yields:
+            Every chunk of the shared stream
+        """
+        with self._lock:
+            call = self._streams.get(key)
+            leader = call is None
+            if leader:
+                call = self._streams[key] = _StreamCall()
+                self.leaders += 1
+            else:
+                call.followers += 1
+                self.shared += 1
+        
+        if leader:
+            yield from self._lead_stream(key, call, fn)
+            return
+        
+        try:
+            yield from self._follow_stream(call)
+        finally:
+            with self._lock:
+                call.followers -= 1
+    
+    def _lead_stream(self, key: str, call: _StreamCall, fn: Callable[[], Iterator[Any]]) -> Iterator[Any]:
+        """Drive the upstream iterator, publishing each chunk to followers."""
+        upstream = fn()
+        handed_off = False
+        try:
+            for chunk in upstream:
+                self._publish(call, chunk)
+                yield chunk
+        except GeneratorExit:
+            # The leader's client went away; finish the stream in the
+            # background if anyone else is still reading it
+            with self._lock:
+                handed_off = call.followers > 0
+                if not handed_off:
+                    self._unregister(key, call)
+            if handed_off:
+                threading.Thread(target=self._drain, args=(key, call, upstream), name="singleflight-drain", daemon=True).start()
+            else:
+                call.error = RuntimeError("Shared stream was abandoned")
+            raise
+        except BaseException as e:
+            call.error = e if isinstance(e, Exception) else RuntimeError("Shared stream was abandoned")
+            raise
+        finally:
+            if not handed_off:
+                self._finish(key, call)
+    
+    def _drain(self, key: str, call: _StreamCall, upstream: Iterator[Any]) -> None:
+        """Finish a stream whose leader went away, for the followers still reading it."""
+        try:
+            for chunk in upstream:
+                self._publish(call, chunk)
+                with self._lock:
+                    if call.followers == 0:
+                        # The followers have gone too
+                        self._unregister(key, call)
+                        call.error = RuntimeError("Shared stream was abandoned")
+                        break
+        except Exception as e:
+            call.error = e
+        finally:
+            close = getattr(upstream, "close", None)
+            if close:
+                close()
+            self._finish(key, call)
+    
+    def _publish(self, call: _StreamCall, chunk: Any) -> None:
+        """Buffer a chunk and wake the followers."""
+        with call.condition:
+            call.chunks.append(chunk)
+            call.condition.notify_all()
+    
+    def _unregister(self, key: str, call: _StreamCall) -> None:
+        """Stop new consumers from joining a stream. Caller must hold the lock."""
+        if self._streams.get(key) is call:
+            del self._streams[key]
+    
+    def _finish(self, key: str, call: _StreamCall) -> None:
+        """Mark a stream as ended and wake the followers."""
+        with self._lock:
+            self._unregister(key, call)
+        with call.condition:
+            call.finished = True
+            call.condition.notify_all()
+    
+    def _follow_stream(self, call: _StreamCall) -> Iterator[Any]:
+        """Replay and then follow the chunks published by the leader."""
+        index = 0
+        while True:
+            with call.condition:
+                call.condition.wait_for(lambda: len(call.chunks) > index or call.finished)
+                chunks = call.chunks[index:]
+                finished = call.finished
+            
+            for chunk in chunks:
+                yield chunk
+            index += len(chunks)
+            
+            if finished and index >= len(call.chunks):
+                if call.error is not None:
+                    raise call.error
+                return
+    
+    def in_flight(self, key: str) -> bool:
+        """
+        Check whether a call or stream with the key is running.
+        
+        Args:
+            key: Fingerprint of the call
+            
+        Returns:
+            True if a caller presenting the key now would share a running call
+        """
+        with self._lock:
+            return key in self._calls or key in self._streams
+    
+    def stats(self) -> Dict[str, int]:
+        """
+        Get deduplication counters.
+        
+        Returns:
+            Number of calls in flight, upstream executions and shared results
+        """
+        with self._lock:
+            return {
+                "inFlight": len(self._calls) + len(self._streams),
+                "leaders": self.leaders,
+                "shared": self.shared
+            }
+
+
+class _AsyncCall:
+    """A call shared by every task waiting on the same key."""
+    
+    def __init__(self):
+        # Callers still waiting for the result, and the task running the call
+        self.callers = 0
+        self.task: Optional[asyncio.Task] = None
+
+
+class _AsyncStreamCall:
+    """A stream shared by every task consuming the same key."""
+    
+    def __init__(self):
+        self.chunks: List[Any] = []
+        self.finished = False
+        self.error: Optional[BaseException] = None
+        self.condition = asyncio.Condition()
+        # Consumers still reading the stream, and the task driving upstream
+        self.consumers = 0
+        self.task: Optional[asyncio.Task] = None
+
+
+class AsyncSingleFlight:
+    """
+    Asyncio single-flight group.
+    """
+    
+    def __init__(self):
+        """
+        Initialize the group.
+        """
+        self._calls: Dict[str, _AsyncCall] = {}
+        self._streams: Dict[str, _AsyncStreamCall] = {}
+        self.leaders = 0
+        self.shared = 0
+    
+    async def do(self, key: str, fn: Callable[[], Awaitable[Any]]) -> Any:
+        """
+        Await fn() once for all concurrent callers with the same key.
+        
+        The awaitable runs in a task of its own, so that a caller being
+        cancelled, including the one that started the call, never interrupts
+        it for the others; it is cancelled once no caller is left.
+        
+        Args:
+            key: Fingerprint of the call
+            fn: Factory for the awaitable to run
+            
+        Returns:
+            The result of fn, possibly computed for another caller
+        """
+        call = self._calls.get(key)
+        if call is None:
+            call = self._calls[key] = _AsyncCall()
+            self.leaders += 1
+            call.task = asyncio.ensure_future(self._run(key, call, fn))
+        else:
+            self.shared += 1
+        
+        call.callers += 1
+        try:
+            return await asyncio.shield(call.task)
+        finally:
+            call.callers -= 1
+            if call.callers == 0 and not call.task.done():
+                # Nobody is waiting any more; later callers start afresh
+                if self._calls.get(key) is call:
+                    del self._calls[key]
+                call.task.cancel()
+    
+    async def _run(self, key: str, call: _AsyncCall, fn: Callable[[], Awaitable[Any]]) -> Any:
+        """Await the shared call, unregistering it once it is done."""
+        try:
+            return await fn()
+        finally:
+            if self._calls.get(key) is call:
+                del self._calls[key]
+    
+    async def stream(self, key: str, fn: Callable[[], AsyncIterator[Any]]) -> AsyncIterator[Any]:
+        """
+        Iterate fn() once for all concurrent consumers with the same key.
+        
+        The upstream iterator is driven by a task of its own, so that a
+        consumer being cancelled, including the one that started the stream,
+        never interrupts it for the others; it is cancelled once no consumer
+        is left.
+        
+        Args:
+            key: Fingerprint of the stream
+            fn: Factory for the upstream async iterator
+            
+        Yields:
+            Every chunk of the shared stream
+        """
+        call = self._streams.get(key)
+        if call is None:
+            call = self._streams[key] = _AsyncStreamCall()
+            self.leaders += 1
+            call.task = asyncio.get_running_loop().create_task(self._pump(key, call, fn))
+        else:
+            self.shared += 1
+        
+        call.consumers += 1
+        try:
+            async for chunk in self._follow_stream(call):
+                yield chunk
+        finally:
+            call.consumers -= 1
+            if call.consumers == 0 and not call.finished:
+                # Nobody is reading any more; later callers start afresh
+                if self._streams.get(key) is call:
+                    del self._streams[key]
+                call.task.cancel()
+    
+    async def _pump(self, key: str, call: _AsyncStreamCall, fn: Callable[[], AsyncIterator[Any]]) -> None:
+        """Drive the upstream iterator, publishing each chunk to the consumers."""
+        try:
+            async for chunk in fn():
+                call.chunks.append(chunk)
+                async with call.condition:
+                    call.condition.notify_all()
+        except asyncio.CancelledError:
+            call.error = RuntimeError("Shared stream was abandoned")
+            raise
+        except Exception as e:
+            # Raised to the consumers rather than from the task
+            call.error = e
+        finally:
+            if self._streams.get(key) is call:
+                del self._streams[key]
+            call.finished = True
+            async with call.condition:
+                call.condition.notify_all()
+    
+    async def _follow_stream(self, call: _AsyncStreamCall) -> AsyncIterator[Any]:
+        """Replay and then follow the chunks published by the pump."""
+        index = 0
+        while True:
+            if index >= len(call.chunks) and not call.finished:
+                async with call.condition:
+                    await call.condition.wait_for(lambda: len(call.chunks) > index or call.finished)
+            
+            chunks = call.chunks[index:]
+            for chunk in chunks:
+                yield chunk
+            index += len(chunks)
+            
+            if call.finished and index >= len(call.chunks):
+                if call.error is not None:
+                    raise call.error
+                return
+    
+    def in_flight(self, key: str) -> bool:
+        """
+        Check whether a call or stream with the key is running.
+        
+        Args:
+            key: Fingerprint of the call
+            
+        Returns:
+            True if a caller presenting the key now would share a running call
+        """
+        return key in self._calls or key in self._streams
+    
+    def stats(self) -> Dict[str, int]:
+        """
+        Get deduplication counters.
+        
+        Returns:
+            Number of calls in flight, upstream executions and shared results
+        """
+        return {
+            "inFlight": len(self._calls) + len(self._streams),
+            "leaders": self.leaders,
+            "shared": self.shared
+        }
@@ -0,0 +1,272 @@
+"""
+Hot-reloading registries of JSON documents such as questionnaire templates.
+
+A registry's directory is read on first use rather than at startup, and
+then polled: each poll is a single scandir comparing file mtimes and sizes,
+and only new or modified files are parsed again. Every change produces a
+new mapping that replaces the previous one in a single assignment, so
+concurrent readers always see a complete, consistent set. Writes made
+through a registry go to disk and are served at once; writes by other
+processes are picked up by the next poll.
+"""
+
+import os
+import json
+import time
+import logging
+import tempfile
+import threading
+from typing import Dict, Any, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Seconds between checks of a registry's directory for changes
+DEFAULT_POLL_INTERVAL = float(os.environ.get("TEMPLATE_POLL_INTERVAL", 2.0))
+
+def write_json_atomic(file_path: str, data: Any) -> None:
+    """
+    Write a JSON file so that readers see either the old or the new content.
+    
+    The data goes to a temporary file in the same directory, which then
+    replaces the target in one rename.
+    
+    Args:
+        file_path: Path of the file to write
+        data: JSON-serializable data
+    """
+    directory = os.path.dirname(file_path) or "."
+    os.makedirs(directory, exist_ok=True)
+    fd, temp_path = tempfile.mkstemp(dir=directory, prefix=".", suffix=".tmp")
+    try:
+        with os.fdopen(fd, 'w') as f:
+            json.dump(data, f, indent=2)
+        os.replace(temp_path, file_path)
+    except BaseException:
+        try:
+            os.remove(temp_path)
+        except OSError:
+            pass
+        raise
+
+class JsonFileRegistry:
+    """
+    Documents loaded from a directory, with built-in defaults taking precedence.
+    """
+    
+    def __init__(
+        self,
+        directory: str,
+        defaults: Optional[Dict[str, Dict[str, Any]]] = None,
+        poll_interval: float = None,
+        write_defaults: bool = False
+    ):
+        """
+        Initialize the registry without touching the directory.
+        
+        Args:
+            directory: Directory holding one <id>.json file per document
+            defaults: Built-in documents, which files cannot override
+            poll_interval: Seconds between checks of the directory for changes
+            write_defaults: Whether to save missing defaults to the directory
+        """
+        self.directory = directory
+        self.defaults = defaults or {}
+        self.poll_interval = DEFAULT_POLL_INTERVAL if poll_interval is None else poll_interval
+        self.write_defaults = write_defaults
+        
+        self._documents: Optional[Dict[str, Dict[str, Any]]] = None
+        # File name -> ((mtime_ns, size), parsed document or None)
+        self._files: Dict[str, Tuple[Tuple[int, int], Optional[Dict[str, Any]]]] = {}
+        self._next_poll = 0.0
+        self._lock = threading.Lock()
+        self.reloads = 0
+    
+    def documents(self) -> Dict[str, Dict[str, Any]]:
+        """
+        Get the current documents, checking the directory if a poll is due.
+        
+        The returned mapping is replaced, never modified, on reload; callers
+        must not modify it either.
+        
+        Returns:
+            Documents keyed by ID, defaults first
+        """
+        if self._documents is None or time.monotonic() >= self._next_poll:
+            self.refresh()
+        return self._documents
+    
+    def get(self, document_id: str) -> Optional[Dict[str, Any]]:
+        """
+        Get a document by ID.
+        
+        Args:
+            document_id: ID of the document
+            
+        Returns:
+            Document data or None if not found
+        """
+        return self.documents().get(document_id)
+    
+    def refresh(self) -> None:
+        """
+        Check the directory and swap in a new mapping if it changed.
+        
+        While one thread refreshes, other threads keep using the current
+        documents instead of waiting; only the very first load blocks.
+        """
+        if not self._lock.acquire(blocking=self._documents is None):
+            return
+        
+        try:
+            if self._documents is None and self.write_defaults:
+                self._write_defaults()
+            
+            files, changed = self._scan()
+            
+            if changed or self._documents is None:
+                self._files = files
+                self._documents = self._build(files)
+                self.reloads += 1
+                logger.info(f"Loaded {len(self._documents)} documents from {self.directory}")
+            
+            self._next_poll = time.monotonic() + self.poll_interval
+        finally:
+            self._lock.release()
+    
+    def write(self, document_id: str, data: Dict[str, Any]) -> str:
+        """
+        Save a document to its file and serve it without waiting for a poll.
+        
+        Args:
+            document_id: ID of the document
+            data: Document data; must not be modified afterwards
+            
+        Returns:
+            Path to the saved file
+        """
+        filename = f"{document_id}.json"
+        file_path = os.path.join(self.directory, filename)
+        
+        with self._lock:
+            write_json_atomic(file_path, data)
+            stat = os.stat(file_path)
+            files = dict(self._files)
+            files[filename] = ((stat.st_mtime_ns, stat.st_size), None if document_id in self.defaults else data)
+            self._files = files
+            if self._documents is not None:
+                self._documents = self._build(files)
+        
+        return file_path
+    
+    def remove(self, document_id: str) -> bool:
+        """
+        Delete a document's file and stop serving it.
+        
+        Args:
+            document_id: ID of the document
+            
+        Returns:
+            True if the file was deleted, False if it did not exist
+        """
+        filename = f"{document_id}.json"
+        
+        with self._lock:
+            try:
+                os.remove(os.path.join(self.directory, filename))
+            except FileNotFoundError:
+                return False
+            files = dict(self._files)
+            files.pop(filename, None)
+            self._files = files
+            if self._documents is not None:
+                self._documents = self._build(files)
+        
+        return True
+    
+    def _build(self, files: Dict[str, Tuple[Tuple[int, int], Optional[Dict[str, Any]]]]) -> Dict[str, Dict[str, Any]]:
+        """Map document IDs to documents, defaults first and files in name order."""
+        documents = dict(self.defaults)
+        for filename in sorted(files):
+            data = files[filename][1]
+            if data is not None:
+                documents.setdefault(os.path.splitext(filename)[0], data)
+        return documents
+    
+    def _scan(self) -> Tuple[Dict[str, Tuple[Tuple[int, int], Optional[Dict[str, Any]]]], bool]:
+        """Stat every JSON file, parsing only those that are new or modified."""
+        files = {}
+        changed = False
+        
+        try:
+            entries = list(os.scandir(self.directory))
+        except FileNotFoundError:
+            entries = []
+        
+        for entry in entries:
+            if not entry.name.endswith('.json') or not entry.is_file():
+                continue
+            
+            stat = entry.stat()
+            signature = (stat.st_mtime_ns, stat.st_size)
+            known = self._files.get(entry.name)
+            if known and known[0] == signature:
+                files[entry.name] = known
+                continue
+            
+            changed = True
+            document_id = os.path.splitext(entry.name)[0]
+            if document_id in self.defaults:
+                # Defaults take precedence; no need to parse the file
+                files[entry.name] = (signature, None)
+                continue
+            
+            try:
+                with open(entry.path, 'r') as f:
+                    files[entry.name] = (signature, json.load(f))
+            except Exception as e:
+                logger.error(f"Error loading {entry.path}: {e}")
+                # Keep serving the last good version of the file
+                files[entry.name] = (signature, known[1] if known else None)
+        
+        if files.keys() != self._files.keys():
+            changed = True
+        
+        return files, changed
+    
+    def _write_defaults(self) -> None:
+        """Save defaults to disk if they don't exist."""
+        for document_id, data in self.defaults.items():
+            file_path = os.path.join(self.directory, f"{document_id}.json")
+            if not os.path.exists(file_path):
+                try:
+                    os.makedirs(self.directory, exist_ok=True)
+                    with open(file_path, 'w') as f:
+                        json.dump(data, f, indent=2)
+                except OSError as e:
+                    logger.warning(f"Could not save default to {file_path}: {e}")
+
+
+class TemplateRegistry(JsonFileRegistry):
+    """
+    Questionnaire templates; the default templates are also saved to disk.
+    """
+    
+    def __init__(self, templates_dir: str, defaults: Optional[Dict[str, Dict[str, Any]]] = None, poll_interval: float = None):
+        """
+        Initialize the registry without touching the directory.
+        
+        Args:
+            templates_dir: Directory holding one <template-id>.json file per template
+            defaults: Built-in templates, which files cannot override
+            poll_interval: Seconds between checks of the directory for changes
+        """
+        super().__init__(templates_dir, defaults, poll_interval, write_defaults=True)
+    
+    def templates(self) -> Dict[str, Dict[str, Any]]:
+        """
+        Get the current templates, checking the directory if a poll is due.
+        
+        Returns:
+            Templates keyed by ID, defaults first
+        """
+        return self.documents()